@@ -0,0 +1,214 @@
+'''
+benchmark of route-switcher function with local cloud API simulator
+measures time to failover and number of API requests per minute for configurations with different number of route tables and routes
+
+usage:
+    python benchmark/benchmark.py --route-tables 1 10 100 --routes 1000
+'''
+
+import argparse
+import contextlib
+import importlib
+import io
+import ipaddress
+import os
+import sys
+import time
+import uuid
+
+import yaml
+
+from simulator import CloudSimulator
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'route-switcher-function'))
+
+bucket = 'route-switcher-benchmark'
+config_path = 'route-switcher-config.yaml'
+# primary router A and backup router B, all routes use router A as next hop
+router_a = {'healthchecked_ip': '192.168.1.10', 'own_ip': '10.0.1.10'}
+router_b = {'healthchecked_ip': '192.168.1.20', 'own_ip': '10.0.1.20'}
+
+
+class Context:
+    '''
+    context of function invocation
+    '''
+
+    def __init__(self, life_time):
+        self.token = {'access_token': 'benchmark-token'}
+        self.request_id = str(uuid.uuid4())
+        self.deadline = time.time() + life_time + 60
+
+    def get_remaining_time_in_millis(self):
+        return max(self.deadline - time.time(), 0) * 1000
+
+
+def build_scenario(simulator, route_tables, routes):
+    '''
+    adds route tables and load balancer targets into simulator and uploads route-switcher config into bucket
+    :param simulator: cloud simulator
+    :param route_tables: number of route tables
+    :param routes: total number of routes in all route tables
+    :return: list of route table ids
+    '''
+
+    simulator.add_target(router_a['healthchecked_ip'])
+    simulator.add_target(router_b['healthchecked_ip'])
+    routes_per_table = max(routes // route_tables, 1)
+    first_prefix = int(ipaddress.IPv4Address('172.16.0.0'))
+    route_table_ids = list()
+    for table in range(route_tables):
+        route_table_id = 'rt-bench-%05d' % table
+        static_routes = [{'destinationPrefix': '%s/32' % ipaddress.IPv4Address(first_prefix + table * routes_per_table + route), 'nextHopAddress': router_a['own_ip']} for route in range(routes_per_table)]
+        simulator.add_route_table(route_table_id, route_table_id, static_routes)
+        route_table_ids.append(route_table_id)
+
+    config = {
+        'loadBalancerId': 'nlb-bench',
+        'targetGroupId': 'tg-bench',
+        'route_table_folders': ['folder-bench'],
+        'route_tables': [{'route_table_id': route_table_id} for route_table_id in route_table_ids],
+        'routers': [
+            {'healthchecked_ip': router_a['healthchecked_ip'], 'interfaces': [{'own_ip': router_a['own_ip'], 'backup_peer_ip': router_b['own_ip']}]},
+            {'healthchecked_ip': router_b['healthchecked_ip'], 'interfaces': [{'own_ip': router_b['own_ip'], 'backup_peer_ip': router_a['own_ip']}]},
+        ],
+    }
+    simulator.put_object(config_path, yaml.dump(config, default_flow_style=False))
+    return route_table_ids
+
+
+def load_function(base_url, args):
+    '''
+    imports route-switcher function with API endpoints of simulator, module is reloaded to reset its state between runs
+    :param base_url: url of simulator
+    :param args: benchmark arguments
+    :return: route-switcher function module
+    '''
+
+    os.environ.update({
+        'CONFIG_PATH': config_path,
+        'BUCKET_NAME': bucket,
+        'CRON_INTERVAL': '1',
+        'BACK_TO_PRIMARY': 'true',
+        'ROUTER_HCHK_INTERVAL': str(args.healthcheck_interval),
+        'ROUTER_HCHK_FAST_INTERVAL': str(args.healthcheck_fast_interval),
+        'FOLDER_NAME': 'folder-bench',
+        'FUNCTION_NAME': 'route-switcher-bench',
+        'AWS_ACCESS_KEY_ID': 'benchmark',
+        'AWS_SECRET_ACCESS_KEY': 'benchmark',
+        'AWS_DEFAULT_REGION': 'ru-central1',
+    })
+    with contextlib.redirect_stdout(sys.stdout if args.verbose else io.StringIO()):
+        main = importlib.reload(sys.modules['main']) if 'main' in sys.modules else importlib.import_module('main')
+        main.load_balancer_endpoint = base_url
+        main.vpc_endpoint = base_url
+        main.compute_endpoint = base_url
+        main.operation_endpoint = base_url
+        main.monitoring_endpoint = base_url
+        if args.s3_client == 'boto3':
+            import boto3
+            from botocore.config import Config
+            main.s3_client = boto3.session.Session().client(service_name='s3', endpoint_url=base_url, config=Config(s3={'addressing_style': 'path'}))
+        else:
+            main.get_s3_client(base_url)
+    # function life time is limited by benchmark run time instead of CRON_INTERVAL minutes
+    main.cron_interval = args.life_time / 60
+    return main
+
+
+def run_function(main, args):
+    '''
+    runs one invocation of function
+    :return: run time of function in seconds
+    '''
+
+    event = {'event_metadata': {'folder_id': 'folder-bench'}}
+    start_time = time.time()
+    output = io.StringIO()
+    with contextlib.redirect_stdout(sys.stdout if args.verbose else output):
+        main.handler(event, Context(args.life_time))
+    return time.time() - start_time
+
+
+def benchmark_failover(route_tables, routes, args):
+    '''
+    measures time from failure of router A until all route tables are switched to router B
+    :return: dictionary with results
+    '''
+
+    simulator = CloudSimulator(bucket=bucket, latency={api: args.latency for api in ('load-balancer', 'vpc', 'compute', 'operation', 'monitoring', 's3')}, error_rate=args.error_rate, throttle_rate=args.throttle_rate, operation_delay=args.operation_delay)
+    base_url = simulator.start()
+    try:
+        route_table_ids = build_scenario(simulator, route_tables, routes)
+        main = load_function(base_url, args)
+        simulator.script([(args.failure_delay, router_a['healthchecked_ip'], 'UNHEALTHY')])
+        run_time = run_function(main, args)
+        failure_time = next((change_time for change_time, address, status in simulator.status_changes if status == 'UNHEALTHY'), None)
+        switched_times = [simulator.route_table_switched_time(route_table_id, router_b['own_ip']) for route_table_id in route_table_ids]
+        first_patch_time = min((update[0] for update in simulator.route_table_updates), default=None)
+        result = {'run_time': run_time, 'switched_tables': len([switched_time for switched_time in switched_times if switched_time])}
+        if failure_time is not None and first_patch_time is not None:
+            result['time_to_first_patch'] = first_patch_time - failure_time
+        if failure_time is not None and all(switched_times):
+            result['time_to_failover'] = max(switched_times) - failure_time
+        return result
+    finally:
+        simulator.stop()
+
+
+def benchmark_steady_state(route_tables, routes, args):
+    '''
+    measures number of API requests per minute while all routers are HEALTHY
+    :return: dictionary with results
+    '''
+
+    simulator = CloudSimulator(bucket=bucket, latency={api: args.latency for api in ('load-balancer', 'vpc', 'compute', 'operation', 'monitoring', 's3')}, error_rate=args.error_rate, throttle_rate=args.throttle_rate, operation_delay=args.operation_delay)
+    base_url = simulator.start()
+    try:
+        build_scenario(simulator, route_tables, routes)
+        main = load_function(base_url, args)
+        run_time = run_function(main, args)
+        calls = simulator.api_calls()
+        return {'run_time': run_time, 'calls_per_minute': sum(calls.values()) / run_time * 60, 'calls': dict(calls)}
+    finally:
+        simulator.stop()
+
+
+def format_seconds(value):
+    return '%.2f' % value if value is not None else '-'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of route-switcher function with local cloud API simulator')
+    parser.add_argument('--route-tables', type=int, nargs='+', default=[1, 10, 100, 300], help='numbers of route tables')
+    parser.add_argument('--routes', type=int, nargs='+', default=[1000], help='total numbers of routes in all route tables')
+    parser.add_argument('--life-time', type=float, default=20, help='life time of function invocation in seconds')
+    parser.add_argument('--failure-delay', type=float, default=5, help='time in seconds from function start until router failure')
+    parser.add_argument('--healthcheck-interval', type=int, default=10, help='ROUTER_HCHK_INTERVAL of function')
+    parser.add_argument('--healthcheck-fast-interval', type=int, default=2, help='ROUTER_HCHK_FAST_INTERVAL of function')
+    parser.add_argument('--latency', type=float, default=0.02, help='latency in seconds of each API request')
+    parser.add_argument('--operation-delay', type=float, default=0.5, help='time in seconds until route table update operation is completed')
+    parser.add_argument('--error-rate', type=float, default=0, help='probability of 500 response for API request')
+    parser.add_argument('--throttle-rate', type=float, default=0, help='probability of 429 response for API request')
+    parser.add_argument('--s3-client', choices=['lightweight', 'boto3'], default='lightweight', help='S3 client of function')
+    parser.add_argument('--verbose', action='store_true', help='print output of function')
+    args = parser.parse_args()
+
+    print('%12s %8s %14s %18s %16s %14s  %s' % ('route_tables', 'routes', 'switched', 'first_patch_s', 'failover_s', 'calls/min', 'calls by API (steady state)'))
+    for routes in args.routes:
+        for route_tables in args.route_tables:
+            failover_result = benchmark_failover(route_tables, routes, args)
+            steady_result = benchmark_steady_state(route_tables, routes, args)
+            print('%12d %8d %14s %18s %16s %14.1f  %s' % (
+                route_tables,
+                max(routes // route_tables, 1) * route_tables,
+                '%d/%d' % (failover_result['switched_tables'], route_tables),
+                format_seconds(failover_result.get('time_to_first_patch')),
+                format_seconds(failover_result.get('time_to_failover')),
+                steady_result['calls_per_minute'],
+                steady_result['calls'],
+            ), flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,378 @@
+import json
+import random
+import re
+import threading
+import time
+import uuid
+import hashlib
+import collections
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+from xml.sax.saxutils import escape as xml_escape
+
+
+class CloudSimulator:
+    '''
+    local stand-in for Yandex Cloud API endpoints and Object Storage used by route-switcher function:
+    - load-balancer: getTargetStates
+    - vpc: get, list and update route tables
+    - compute: get instance, updateNetworkInterface
+    - operation: get operation
+    - monitoring: write metrics
+    - object storage: get and put objects with ETag conditions (path-style requests)
+    all endpoints are served on one local port, API is selected by first part of request path
+    '''
+
+    def __init__(self, bucket='route-switcher', latency=None, error_rate=0, throttle_rate=0, operation_delay=0.2, operation_error_rate=0, seed=0):
+        '''
+        :param bucket: name of bucket in object storage
+        :param latency: dictionary with latency in seconds for API as {key:value}, where key - API name ('load-balancer', 'vpc', 'compute', 'operation', 'monitoring', 's3'), value - latency
+        :param error_rate: probability of response with 500 status code for API request
+        :param throttle_rate: probability of response with 429 status code for API request
+        :param operation_delay: time in seconds until operation is completed
+        :param operation_error_rate: probability of operation to complete with error
+        :param seed: seed for random generator of injected errors
+        '''
+
+        self.bucket = bucket
+        self.latency = latency or {}
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.operation_delay = operation_delay
+        self.operation_error_rate = operation_error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        # targets of load balancers as {key:value}, where key - healthchecked IP address, value - status
+        self.targets = collections.OrderedDict()
+        # target groups of targets as {key:value}, where key - healthchecked IP address, value - target group id
+        self.target_groups = {}
+        self.route_tables = collections.OrderedDict()
+        self.instances = {}
+        self.operations = {}
+        self.objects = {}
+        self.metrics = []
+        # number of API requests as {key:value}, where key - (API name, HTTP method), value - number of requests
+        self.calls = collections.Counter()
+        # number of next API requests answered with 429 status code as {key:value}, where key - (API name, HTTP method), value - number of requests
+        self.throttled_requests = collections.Counter()
+        # number of next API requests answered with 500 status code as {key:value}, where key - (API name, HTTP method), value - number of requests
+        self.failed_requests = collections.Counter()
+        # history of route table updates: list of (time of request, time of operation completion, route table id, static routes, operation error)
+        self.route_table_updates = []
+        self.server = None
+        self.thread = None
+        self.timers = []
+        # history of target status changes: list of (time, healthchecked IP address, status)
+        self.status_changes = []
+
+    def start(self, host='127.0.0.1', port=0):
+        '''
+        starts HTTP server in background thread
+        :return: base url of simulator, e.g. 'http://127.0.0.1:8080'
+        '''
+
+        self.server = ThreadingHTTPServer((host, port), SimulatorRequestHandler)
+        self.server.daemon_threads = True
+        self.server.simulator = self
+        self.thread = threading.Thread(target=self.server.serve_forever, name='cloud-simulator', daemon=True)
+        self.thread.start()
+        return 'http://%s:%s' % self.server.server_address[:2]
+
+    def stop(self):
+        for timer in self.timers:
+            timer.cancel()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def add_target(self, address, status='HEALTHY', subnet_id='subnet-bench', target_group_id='tg-bench'):
+        self.targets[address] = {'address': address, 'subnetId': subnet_id, 'status': status}
+        self.target_groups[address] = target_group_id
+
+    def set_target_status(self, address, status):
+        with self.lock:
+            self.targets[address]['status'] = status
+            self.status_changes.append((time.time(), address, status))
+
+    def script(self, transitions):
+        '''
+        schedules changes of target status
+        :param transitions: list of (delay in seconds from now, healthchecked IP address, status)
+        :return:
+        '''
+
+        for delay, address, status in transitions:
+            timer = threading.Timer(delay, self.set_target_status, (address, status))
+            timer.daemon = True
+            timer.start()
+            self.timers.append(timer)
+
+    def add_route_table(self, route_table_id, name, static_routes, folder_id='folder-bench'):
+        self.route_tables[route_table_id] = {'id': route_table_id, 'folderId': folder_id, 'name': name, 'staticRoutes': static_routes}
+
+    def add_instance(self, instance_id, network_interfaces):
+        '''
+        :param network_interfaces: dictionary with network interfaces as {key:value}, where key - interface index, value - list of security group ids
+        '''
+
+        self.instances[instance_id] = {'id': instance_id, 'networkInterfaces': [{'index': str(index), 'securityGroupIds': list(security_group_ids)} for index, security_group_ids in network_interfaces.items()]}
+
+    def put_object(self, key, body):
+        if isinstance(body, str):
+            body = body.encode()
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        self.objects[key] = (body, etag)
+        return etag
+
+    def get_object(self, key):
+        return self.objects[key][0]
+
+    def start_operation(self, description, apply=None):
+        '''
+        creates operation which is completed after operation_delay seconds
+        :param description: operation description
+        :param apply: function which applies changes of operation, it is not called if operation fails
+        :return: operation dictionary
+        '''
+
+        operation_id = 'op-' + uuid.uuid4().hex[:16]
+        done_at = time.time() + self.operation_delay
+        error = None
+        if self.random.random() < self.operation_error_rate:
+            error = {'code': 10, 'message': 'Injected operation error'}
+        elif apply is not None:
+            apply()
+        self.operations[operation_id] = {'done_at': done_at, 'error': error}
+        return {'id': operation_id, 'description': description, 'done': False}
+
+    def get_operation(self, operation_id):
+        operation = self.operations[operation_id]
+        response = {'id': operation_id, 'done': time.time() >= operation['done_at']}
+        if response['done'] and operation['error']:
+            response['error'] = operation['error']
+        return response
+
+    def route_table_switched_time(self, route_table_id, next_hop):
+        '''
+        :return: time of completion of first successful operation which switched all routes of route table to next hop or None
+        '''
+
+        for request_time, done_at, updated_route_table_id, static_routes, error in self.route_table_updates:
+            if updated_route_table_id == route_table_id and not error and all(route.get('nextHopAddress') == next_hop for route in static_routes):
+                return done_at
+
+    def api_calls(self):
+        '''
+        :return: number of API requests as {key:value}, where key - API name, value - number of requests
+        '''
+
+        calls = collections.Counter()
+        for (api, method), number in self.calls.items():
+            calls[api] += number
+        return calls
+
+
+class SimulatorRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_PATCH(self):
+        self.dispatch('PATCH')
+
+    def do_PUT(self):
+        self.dispatch('PUT')
+
+    def do_HEAD(self):
+        self.dispatch('HEAD')
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_body(self, status, data=b'', headers=None):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+
+    def read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            data = b''
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                if size == 0:
+                    # skip trailers
+                    while self.rfile.readline() not in (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                data += self.rfile.read(size)
+                self.rfile.readline()
+        else:
+            data = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if 'aws-chunked' in self.headers.get('Content-Encoding', ''):
+            data = decode_aws_chunked(data)
+        return data
+
+    def dispatch(self, method):
+        simulator = self.server.simulator
+        url = urlsplit(self.path)
+        api = url.path.split('/')[1]
+        if api == 'operations':
+            api = 'operation'
+        if api not in ('load-balancer', 'vpc', 'compute', 'operation', 'monitoring'):
+            api = 's3'
+        body = self.read_body()
+        with simulator.lock:
+            simulator.calls[(api, method)] += 1
+            throttled = simulator.random.random() < simulator.throttle_rate or simulator.throttled_requests[(api, method)] > 0
+            if simulator.throttled_requests[(api, method)] > 0:
+                simulator.throttled_requests[(api, method)] -= 1
+            failed = simulator.random.random() < simulator.error_rate or simulator.failed_requests[(api, method)] > 0
+            if simulator.failed_requests[(api, method)] > 0:
+                simulator.failed_requests[(api, method)] -= 1
+        if simulator.latency.get(api):
+            time.sleep(simulator.latency[api])
+        if throttled:
+            return self.send_json(429, {'code': 8, 'message': 'Injected quota error'}, {'Retry-After': '1'})
+        if failed:
+            return self.send_json(500, {'code': 13, 'message': 'Injected internal error'})
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        if api == 's3':
+            return self.handle_s3(method, url.path, query, body)
+        request = json.loads(body) if body else {}
+        with simulator.lock:
+            status, response = handle_api(simulator, method, url.path, query, request)
+        self.send_json(status, response)
+
+    def handle_s3(self, method, path, query, body):
+        simulator = self.server.simulator
+        parts = path.lstrip('/').split('/', 1)
+        if parts[0] != simulator.bucket:
+            return self.send_body(404, b'<Error><Code>NoSuchBucket</Code></Error>')
+        key = parts[1] if len(parts) == 2 else ''
+        if method == 'GET' and not key and query.get('list-type') == '2':
+            return self.list_objects(query)
+        if not key:
+            return self.send_body(404, b'<Error><Code>NoSuchKey</Code></Error>')
+        with simulator.lock:
+            current = simulator.objects.get(key)
+            if method in ('GET', 'HEAD'):
+                if current is None:
+                    return self.send_body(404, b'<Error><Code>NoSuchKey</Code><Message>The specified key does not exist.</Message></Error>')
+                if self.headers.get('If-None-Match') == current[1]:
+                    return self.send_body(304, headers={'ETag': current[1]})
+                return self.send_body(200, current[0], {'ETag': current[1]})
+            if method == 'PUT':
+                if self.headers.get('If-None-Match') == '*' and current is not None:
+                    return self.send_body(412, b'<Error><Code>PreconditionFailed</Code></Error>')
+                if self.headers.get('If-Match') is not None and (current is None or current[1] != self.headers.get('If-Match')):
+                    return self.send_body(412, b'<Error><Code>PreconditionFailed</Code></Error>')
+                etag = simulator.put_object(key, body)
+                return self.send_body(200, headers={'ETag': etag})
+        return self.send_body(405)
+
+    def list_objects(self, query, max_keys=1000):
+        '''
+        lists objects in bucket (ListObjectsV2) with prefix, start-after and continuation-token parameters
+        '''
+
+        simulator = self.server.simulator
+        start_after = query.get('continuation-token') or query.get('start-after') or ''
+        with simulator.lock:
+            keys = sorted(key for key in simulator.objects if key.startswith(query.get('prefix', '')) and key > start_after)
+        contents = ''.join('<Contents><Key>%s</Key></Contents>' % xml_escape(key) for key in keys[:max_keys])
+        truncated = '<IsTruncated>true</IsTruncated><NextContinuationToken>%s</NextContinuationToken>' % xml_escape(keys[max_keys - 1]) if len(keys) > max_keys else '<IsTruncated>false</IsTruncated>'
+        self.send_body(200, ('<?xml version="1.0" encoding="UTF-8"?><ListBucketResult>%s%s</ListBucketResult>' % (contents, truncated)).encode(), {'Content-Type': 'application/xml'})
+
+
+def decode_aws_chunked(data):
+    '''
+    decodes body with 'aws-chunked' content encoding used by S3 clients for streaming uploads
+    '''
+
+    decoded = b''
+    while data:
+        header, _, data = data.partition(b'\r\n')
+        size = int(header.split(b';')[0], 16)
+        if size == 0:
+            break
+        decoded += data[:size]
+        data = data[size + 2:]
+    return decoded
+
+
+def handle_api(simulator, method, path, query, request):
+    '''
+    handles request to Yandex Cloud API
+    :return: tuple (status code, response dictionary)
+    '''
+
+    match = re.fullmatch(r'/load-balancer/v1/networkLoadBalancers/([^/:]+):getTargetStates', path)
+    if match and method == 'GET':
+        return 200, {'targetStates': [dict(target) for address, target in simulator.targets.items() if simulator.target_groups[address] == query.get('targetGroupId')]}
+
+    if path == '/vpc/v1/routeTables' and method == 'GET':
+        route_tables = [route_table for route_table in simulator.route_tables.values() if route_table['folderId'] == query.get('folderId')]
+        page_size = int(query.get('pageSize', 100))
+        offset = int(query.get('pageToken') or 0)
+        response = {'routeTables': [json.loads(json.dumps(route_table)) for route_table in route_tables[offset:offset + page_size]]}
+        if offset + page_size < len(route_tables):
+            response['nextPageToken'] = str(offset + page_size)
+        return 200, response
+
+    match = re.fullmatch(r'/vpc/v1/routeTables/([^/]+)', path)
+    if match:
+        route_table = simulator.route_tables.get(match.group(1))
+        if route_table is None:
+            return 404, {'code': 5, 'message': 'Route table %s not found' % match.group(1)}
+        if method == 'GET':
+            return 200, json.loads(json.dumps(route_table))
+        if method == 'PATCH':
+            static_routes = json.loads(json.dumps(request.get('staticRoutes', [])))
+            operation = simulator.start_operation('Update route table', lambda: route_table.update({'staticRoutes': static_routes}))
+            operation_state = simulator.operations[operation['id']]
+            simulator.route_table_updates.append((time.time(), operation_state['done_at'], route_table['id'], static_routes, operation_state['error']))
+            return 200, operation
+
+    match = re.fullmatch(r'/compute/v1/instances/([^/:]+)(/updateNetworkInterface|:updateNetworkInterface)?', path)
+    if match:
+        instance = simulator.instances.get(match.group(1))
+        if instance is None:
+            return 404, {'code': 5, 'message': 'Instance %s not found' % match.group(1)}
+        if match.group(2) is None and method == 'GET':
+            return 200, json.loads(json.dumps(instance))
+        if match.group(2) is not None and method in ('PATCH', 'POST'):
+            for interface in instance['networkInterfaces']:
+                if interface['index'] == str(request.get('networkInterfaceIndex')):
+                    security_group_ids = list(request.get('securityGroupIds', []))
+                    return 200, simulator.start_operation('Update network interface', lambda interface=interface: interface.update({'securityGroupIds': security_group_ids}))
+            return 400, {'code': 3, 'message': 'Network interface not found'}
+
+    match = re.fullmatch(r'/operations/([^/]+)', path)
+    if match and method == 'GET':
+        if match.group(1) not in simulator.operations:
+            return 404, {'code': 5, 'message': 'Operation %s not found' % match.group(1)}
+        return 200, simulator.get_operation(match.group(1))
+
+    if path == '/monitoring/v2/data/write' and method == 'POST':
+        simulator.metrics.extend(request.get('metrics', []))
+        return 200, {'writtenMetricsCount': len(request.get('metrics', []))}
+
+    return 404, {'code': 5, 'message': 'Unknown API request %s %s' % (method, path)}
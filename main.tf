@@ -46,6 +46,51 @@ resource "yandex_lb_network_load_balancer" "route_switcher_lb" {
   }
 }
 
+resource "yandex_lb_target_group" "route_switcher_cluster_tg" {
+  for_each  = var.router_clusters
+  folder_id = var.folder_id
+  name      = "route-switcher-tg-${each.key}-${random_string.prefix.result}"
+  region_id = "ru-central1"
+
+  dynamic "target" {
+    for_each = each.value.routers
+    content {
+      address = target.value["healthchecked_ip"]
+      subnet_id   = target.value["healthchecked_subnet_id"]
+    }
+  }
+}
+
+resource "yandex_lb_network_load_balancer" "route_switcher_cluster_lb" {
+  for_each  = var.router_clusters
+  folder_id = var.folder_id
+  name = "route-switcher-lb-${each.key}-${random_string.prefix.result}"
+  type = "internal"
+
+  listener {
+    name = "route-switcher-listener"
+    port = 9999
+    internal_address_spec {
+      subnet_id = each.value.routers[0]["healthchecked_subnet_id"]
+    }
+  }
+
+  attached_target_group {
+    target_group_id = yandex_lb_target_group.route_switcher_cluster_tg[each.key].id
+
+    healthcheck {
+      name = "tcp"
+      timeout = 1
+      interval = 2
+      unhealthy_threshold = 3
+      healthy_threshold = 3
+      tcp_options {
+        port = var.router_healthcheck_port
+      }
+    }
+  }
+}
+
 resource "random_string" "prefix" {
   length  = 10
   upper   = false
@@ -111,7 +156,17 @@ resource "yandex_storage_object" "route_switcher_config" {
       load_balancer_id      = yandex_lb_network_load_balancer.route_switcher_lb.id
       target_group_id       = yandex_lb_target_group.route_switcher_tg.id
       route_tables          = var.route_table_list
+      route_table_folders   = var.route_table_folder_list
+      route_table_priorities = var.route_table_priorities
       routers = var.routers
+      clusters = [
+        for name, cluster in var.router_clusters : {
+          name             = name
+          load_balancer_id = yandex_lb_network_load_balancer.route_switcher_cluster_lb[name].id
+          target_group_id  = yandex_lb_target_group.route_switcher_cluster_tg[name].id
+          routers          = cluster.routers
+        }
+      ]
     }
   )
 }
@@ -3,6 +3,11 @@ output "route-switcher_nlb" {
   value  = yandex_lb_network_load_balancer.route_switcher_lb.name
 }
 
+output "route-switcher_cluster_nlbs" {
+  description = "Internal NLBs for checking status of routers of clusters from router_clusters"
+  value  = { for name, lb in yandex_lb_network_load_balancer.route_switcher_cluster_lb : name => lb.name }
+}
+
 output "route-switcher_bucket" {
   description = "Bucket for storing route-switcher module configuration"
   value        = yandex_storage_bucket.route_switcher_bucket.bucket
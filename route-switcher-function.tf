@@ -22,9 +22,20 @@ resource "yandex_function" "route-switcher" {
     CONFIG_PATH           = "route-switcher-config.yaml"
     CRON_INTERVAL         = var.cron_interval
     ROUTER_HCHK_INTERVAL  = var.router_healthcheck_interval
+    ROUTER_HCHK_FAST_INTERVAL = var.router_healthcheck_fast_interval
+    ROUTER_PROBE_PORT     = var.router_probe_network_id == null ? "" : var.router_healthcheck_port
+    ROUTER_PROBE_FAILURES = var.router_probe_failures
+    SG_RECONCILE_INTERVAL = var.security_groups_reconcile_interval
+    JOURNAL_FLUSH_INTERVAL = var.journal_flush_interval
+    FAILBACK_MIN_CHECKS   = var.failback_min_checks
+    FAILBACK_HOLD_DOWN    = var.failback_hold_down
+    FLAP_HALF_LIFE        = var.flap_half_life
+    API_CONCURRENCY       = join(",", [for api, limit in var.api_concurrency : "${api}=${limit}"])
+    API_RATE_LIMITS       = join(",", [for api, limit in var.api_rate_limits : "${api}=${limit}"])
     BACK_TO_PRIMARY       = var.back_to_primary
     FOLDER_NAME           = data.yandex_resourcemanager_folder.folder.name
     FUNCTION_NAME         = "route-switcher-${random_string.prefix.result}"
+    SHARD_COUNT           = var.shard_count
   }
   secrets {
     id                   = yandex_lockbox_secret.s3_keys.id
@@ -38,6 +49,13 @@ resource "yandex_function" "route-switcher" {
     key                  = "AWS_SECRET_ACCESS_KEY"
     environment_variable = "AWS_SECRET_ACCESS_KEY"
   }
+  # connect function to network for direct probes of routers
+  dynamic "connectivity" {
+    for_each = var.router_probe_network_id == null ? [] : [var.router_probe_network_id]
+    content {
+      network_id = connectivity.value
+    }
+  }
   user_hash = data.archive_file.route_switcher_function.output_base64sha256
   content {
     zip_filename = data.archive_file.route_switcher_function.output_path
@@ -47,8 +65,9 @@ resource "yandex_function" "route-switcher" {
 resource "yandex_function_trigger" "route_switcher_trigger" {
   depends_on = [yandex_storage_object.route_switcher_config]
   folder_id = var.folder_id
-  name = "route-switcher-trigger-${random_string.prefix.result}"
-  count = var.start_module ? 1 : 0
+  name = count.index == 0 ? "route-switcher-trigger-${random_string.prefix.result}" : "route-switcher-trigger-${random_string.prefix.result}-${count.index}"
+  # one trigger for each shard of route tables, shard index is passed to function in payload
+  count = var.start_module ? var.shard_count : 0
 
   function {
     id                 = yandex_function.route-switcher.id
@@ -57,5 +76,6 @@ resource "yandex_function_trigger" "route_switcher_trigger" {
 
   timer {
     cron_expression = "* * * * ? *"
+    payload         = jsonencode({ shard_index = count.index })
   }
 }
@@ -0,0 +1,159 @@
+'''
+long-running route-switcher process, alternative to launching route-switcher function by timer trigger
+runs the same checks of router status and failover as route-switcher function, but keeps connections, cached config and route index between checks
+and does not spend time on cold start and reading of config and route tables at each launch, route tables are read again once per DAEMON_CYCLE_TIME
+
+environment variables are the same as for route-switcher function, additionally:
+FOLDER_ID - folder id for writing metrics in Yandex Monitoring
+IAM_KEY_FILE - path to authorized key file of service account, if not set IAM token is received from metadata service of VM
+DAEMON_CYCLE_TIME - time in seconds after which config and route tables are read again, default 600 seconds
+SHARD_COUNT, SHARD_INDEX - number of shards and index of shard of this process if route tables are partitioned across several route-switcher processes
+
+usage: python daemon.py
+'''
+
+import os
+import signal
+import json
+import time
+import uuid
+import datetime
+
+# route-switcher function reads these variables at import, set defaults for long-running process
+os.environ.setdefault('CONFIG_PATH', 'route-switcher-config.yaml')
+os.environ.setdefault('CRON_INTERVAL', '1')
+os.environ.setdefault('BACK_TO_PRIMARY', 'true')
+os.environ.setdefault('ROUTER_HCHK_INTERVAL', '10')
+
+import requests
+import main
+
+metadata_token_url = 'http://169.254.169.254/computeMetadata/v1/instance/service-accounts/default/token'
+iam_token_url = 'https://iam.api.cloud.yandex.net/iam/v1/tokens'
+iam_key_file = os.getenv('IAM_KEY_FILE')
+# time in seconds after which config and route tables are read again
+daemon_cycle_time = int(os.getenv('DAEMON_CYCLE_TIME', '600'))
+# time in seconds before expiration of IAM token to refresh it
+token_refresh_margin = 3600
+
+
+def get_metadata_token():
+    '''
+    gets IAM token of service account linked to VM from metadata service
+    :return: tuple (IAM token, expiration time)
+    '''
+
+    r = requests.get(metadata_token_url, headers={'Metadata-Flavor': 'Google'}, timeout=main.api_timeout)
+    r.raise_for_status()
+    return r.json()['access_token'], time.time() + r.json()['expires_in']
+
+
+def get_key_file_token(key_file):
+    '''
+    gets IAM token for service account by exchanging JWT signed with authorized key of service account
+    requires PyJWT and cryptography packages
+    :param key_file: path to authorized key file of service account
+    :return: tuple (IAM token, expiration time)
+    '''
+
+    import jwt
+
+    with open(key_file) as f:
+        key = json.load(f)
+    current_time = int(time.time())
+    encoded_token = jwt.encode({'aud': iam_token_url, 'iss': key['service_account_id'], 'iat': current_time, 'exp': current_time + 3600}, key['private_key'], algorithm='PS256', headers={'kid': key['id']})
+    r = requests.post(iam_token_url, json={'jwt': encoded_token}, timeout=main.api_timeout)
+    r.raise_for_status()
+    # expiresAt is in RFC3339 format, e.g. 2024-01-01T12:00:00.123456Z
+    expires_at = datetime.datetime.strptime(r.json()['expiresAt'][:19], '%Y-%m-%dT%H:%M:%S').replace(tzinfo=datetime.timezone.utc).timestamp()
+    return r.json()['iamToken'], expires_at
+
+
+def refresh_iam_token(token_state):
+    '''
+    refreshes IAM token for API requests if it expires during token_refresh_margin
+    :param token_state: dictionary with expiration time of current IAM token, updated by function
+    :return: True if IAM token is valid, otherwise False
+    '''
+
+    if token_state['expires_at'] - time.time() > token_refresh_margin:
+        return True
+    try:
+        if iam_key_file:
+            token, expires_at = get_key_file_token(iam_key_file)
+        else:
+            token, expires_at = get_metadata_token()
+    except Exception as e:
+        print(f"Request to get IAM token failed due to: {e}. Retrying in {main.router_healthcheck_interval} seconds...")
+        return token_state['expires_at'] > time.time()
+    main.set_iam_token(token)
+    token_state['expires_at'] = expires_at
+    return True
+
+
+def stop(signum, frame):
+    '''
+    handler of SIGTERM and SIGINT signals, stops checking router status after current check
+    :param signum: signal number
+    :param frame: current stack frame
+    :return:
+    '''
+
+    print(f"Received signal {signum}. Stopping route-switcher...")
+    main.stop_event.set()
+
+
+def run():
+    '''
+    checks router status and fails over if router fails until process receives SIGTERM or SIGINT
+    :return:
+    '''
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    main.folder_id = os.getenv('FOLDER_ID')
+    if not main.set_shard(main.default_shard_index):
+        return
+    holder_id = 'daemon-' + str(uuid.uuid4())
+    token_state = {'expires_at': 0}
+    # number of consecutive checks of router status which were finished due to errors
+    error_count = 0
+    while not main.stop_event.is_set():
+        if not refresh_iam_token(token_state):
+            main.stop_event.wait(main.router_healthcheck_interval)
+            continue
+
+        cycle_start = time.time()
+        if main.lease_state['holder'] is None:
+            # route tables are protected by another route-switcher, wait for release of its lease
+            if not main.acquire_lease(holder_id, cycle_start + daemon_cycle_time):
+                main.stop_event.wait(main.router_healthcheck_interval)
+                continue
+        else:
+            main.lease_state['ends'] = cycle_start + daemon_cycle_time
+
+        completed = None
+        try:
+            # route tables and route index are read again only once per cycle time, not after each failover or error
+            completed = main.route_switcher(cycle_start, daemon_cycle_time, route_tables_max_age=daemon_cycle_time)
+        except Exception as e:
+            print(f"Checking router status failed due to: {e}.")
+        main.write_timing_metrics()
+        main.flush_journal()
+        error_count = 0 if completed else error_count + 1
+        if time.time() - cycle_start < daemon_cycle_time:
+            # checking was finished before end of cycle (failover was executed or error happened), start next cycle after short pause
+            # pause after errors is doubled after each error up to interval of router status checks
+            pause = min(main.router_healthcheck_fast_interval * 2 ** max(error_count - 1, 0), main.router_healthcheck_interval)
+            if error_count:
+                print(f"Checking router status was finished due to errors. Retrying in {pause} seconds...")
+            main.stop_event.wait(pause)
+
+    main.flush_state()
+    main.flush_journal(urgent=True)
+    main.release_lease()
+    main.flush_metrics()
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,120 @@
+'''
+reader of route-switcher journal: router status changes, failover decisions and update operations of route tables and network interfaces with their timings
+events are read from journal segments in bucket for time range and printed as JSON lines sorted by time
+
+environment variables: BUCKET_NAME and static access key of service account for reading bucket (AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY)
+
+usage: python journal.py [--from 2024-01-01T12:00:00] [--to 2024-01-01T13:00:00] [--type failover_completed] [--shard 0] > events.jsonl
+'''
+
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import sys
+import time
+
+# route-switcher function reads these variables at import, they are not used by reader of journal
+os.environ.setdefault('CONFIG_PATH', 'route-switcher-config.yaml')
+os.environ.setdefault('CRON_INTERVAL', '1')
+os.environ.setdefault('BACK_TO_PRIMARY', 'true')
+os.environ.setdefault('ROUTER_HCHK_INTERVAL', '10')
+
+# log of route-switcher is printed into stderr, only events are printed into stdout
+with contextlib.redirect_stdout(sys.stderr):
+    import main
+
+# max time in seconds between first and last event of journal segment: events are written at least once per journal flush interval,
+# at the end of launch of function and at the end of cycle of long-running route-switcher process (DAEMON_CYCLE_TIME)
+segment_max_age = max(main.journal_flush_interval, main.cron_interval * 60, int(os.getenv('DAEMON_CYCLE_TIME', '600')))
+
+
+def parse_time(value):
+    '''
+    parses time in ISO format, time without timezone is UTC
+    :param value: time, e.g. '2024-01-01T12:00:00' or '2024-01-01 12:00'
+    :return: time in seconds since epoch
+    '''
+
+    parsed_time = datetime.datetime.fromisoformat(value)
+    if parsed_time.tzinfo is None:
+        parsed_time = parsed_time.replace(tzinfo=datetime.timezone.utc)
+    return parsed_time.timestamp()
+
+
+def get_segment_keys(start_time, end_time):
+    '''
+    gets keys of journal segments with events in time range
+    segments are partitioned by hour of first event, so segments which were started segment_max_age seconds before time range are also listed for events at start of time range
+    first and last event times in segment key are used to skip segments out of time range without reading them
+    :param start_time: start of time range in seconds since epoch
+    :param end_time: end of time range in seconds since epoch
+    :return: list of segment keys
+    '''
+
+    segment_keys = list()
+    hour_time = start_time - segment_max_age
+    hour_time -= hour_time % 3600
+    while hour_time <= end_time:
+        prefix = main.get_journal_hour_prefix(hour_time)
+        continuation_token = None
+        while True:
+            list_arguments = {'Bucket': main.bucket, 'Prefix': prefix}
+            if continuation_token:
+                list_arguments['ContinuationToken'] = continuation_token
+            response = main.get_s3_client().list_objects_v2(**list_arguments)
+            for segment in response.get('Contents', []):
+                # segment key is '<prefix><first event ms>-<last event ms>-<shard>-<id>.jsonl'
+                first_ms, last_ms = segment['Key'][len(prefix):].split('-')[:2]
+                if int(first_ms) <= end_time * 1000 and int(last_ms) >= start_time * 1000:
+                    segment_keys.append(segment['Key'])
+            if not response.get('IsTruncated'):
+                break
+            continuation_token = response['NextContinuationToken']
+        hour_time += 3600
+    return segment_keys
+
+
+def read_segment(segment_key):
+    '''
+    reads events from journal segment
+    :param segment_key: key of segment in bucket
+    :return: list of events
+    '''
+
+    body = main.get_s3_client().get_object(Bucket=main.bucket, Key=segment_key)['Body'].read()
+    return [json.loads(line) for line in body.decode().splitlines() if line]
+
+
+def run():
+    '''
+    prints events of journal for time range
+    :return: exit code
+    '''
+
+    parser = argparse.ArgumentParser(description='Reader of route-switcher journal')
+    parser.add_argument('--from', dest='start', help='start of time range in ISO format, UTC if timezone is not set, default is one hour ago')
+    parser.add_argument('--to', dest='end', help='end of time range in ISO format, UTC if timezone is not set, default is now')
+    parser.add_argument('--type', nargs='+', help='types of events, e.g. router_status failover_decision failover_completed')
+    parser.add_argument('--shard', type=int, help='index of shard of route-switcher')
+    args = parser.parse_args()
+
+    end_time = parse_time(args.end) if args.end else time.time()
+    start_time = parse_time(args.start) if args.start else end_time - 3600
+    with contextlib.redirect_stdout(sys.stderr):
+        try:
+            segment_keys = get_segment_keys(start_time, end_time)
+            # read segments concurrently
+            segments = list(main.get_executor().map(read_segment, segment_keys))
+        except Exception as e:
+            print(f"Request to read journal in bucket {main.bucket} failed due to: {e}.")
+            return 1
+    events = [event for segment in segments for event in segment if start_time <= event['time'] <= end_time and (not args.type or event['type'] in args.type) and (args.shard is None or event['shard'] == args.shard)]
+    for event in sorted(events, key=lambda event: event['time']):
+        print(json.dumps(event, sort_keys=True))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(run())
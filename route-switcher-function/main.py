@@ -1,13 +1,147 @@
+import time
+# start time of module import, import and initialization time is recorded as metric at cold start of function
+module_import_start = time.time()
 import yaml
 import os
-import boto3
 import requests
+import json
+import uuid
 import concurrent.futures as pool
-import time
+import threading
+import queue
 import datetime
+import hashlib
+import hmac
+import io
+import re
+import urllib.parse
+import html
+import bisect
+import random
+import socket
+import selectors
+import errno
 
 iam_token = ""
 endpoint_url='https://storage.yandexcloud.net'
+# Yandex Cloud API endpoints used by function
+load_balancer_endpoint = 'https://load-balancer.api.cloud.yandex.net'
+vpc_endpoint = 'https://vpc.api.cloud.yandex.net'
+compute_endpoint = 'https://compute.api.cloud.yandex.net'
+operation_endpoint = 'https://operation.api.cloud.yandex.net'
+monitoring_endpoint = 'https://monitoring.api.cloud.yandex.net'
+# max number of parallel requests for each API as {key:value}, where key - API name, value - max number of parallel requests
+# also used as size of connection pool for API endpoint, can be changed by API_CONCURRENCY environment variable, e.g. 'vpc=64,compute=16'
+api_concurrency = {'load-balancer': 4, 'vpc': 32, 'compute': 8, 'operation': 32, 'monitoring': 2}
+for api_limit in filter(None, os.getenv('API_CONCURRENCY', '').split(',')):
+    api_concurrency[api_limit.split('=')[0].strip()] = max(int(api_limit.split('=')[1]), 1)
+# semaphores which limit number of parallel requests for each API
+api_semaphores = {api: threading.BoundedSemaphore(api_limit) for api, api_limit in api_concurrency.items()}
+# max rate of requests per second for each API as {key:value}, where key - API name, value - max number of requests per second
+# rate is not limited for API which is not in dictionary, can be set by API_RATE_LIMITS environment variable, e.g. 'vpc=20,compute=10'
+api_rate_limits = {}
+for api_limit in filter(None, os.getenv('API_RATE_LIMITS', '').split(',')):
+    api_rate_limits[api_limit.split('=')[0].strip()] = float(api_limit.split('=')[1])
+# token buckets for each API, created on first request to API
+api_rate_buckets = {}
+api_rate_buckets_lock = threading.Lock()
+# max number of attempts of API request if API returns 429 or 5xx status code or request fails
+api_request_attempts = 3
+# initial and max delay in seconds between attempts of API request (delay is randomized with full jitter), Retry-After header of response is used if it exists
+api_retry_delay = 0.5
+api_retry_max_delay = 8
+# max number of threads for parallel API requests
+max_workers = max(api_concurrency.values())
+# thread pool for parallel API requests, created once and reused between checks of router status and warm invocations of function
+executor = None
+# timeouts in seconds (connect timeout, read timeout) for API requests
+api_timeout = (3, 10)
+# keep-alive HTTP sessions for API endpoints as {key:value}, where key - API endpoint, value - requests session
+api_sessions = {}
+api_sessions_lock = threading.Lock()
+# S3 client for object storage, created once and reused between warm invocations of function
+s3_client = None
+# C-accelerated YAML loader is used if PyYAML is built with LibYAML
+yaml_loader = getattr(yaml, 'CFullLoader', yaml.FullLoader)
+# compiled config model from bucket with ETag of config file, config is parsed and validated only when ETag of config file in bucket is changed
+config_cache = {'etag': None, 'model': None}
+# max number of attempts to update route table within one launch of function, route table is updated again if its update operation fails
+route_table_update_attempts = 3
+# initial and max interval in seconds between requests of operation status
+operation_poll_interval = 0.5
+operation_poll_max_interval = 4
+# max time in seconds to wait for completion of update operations, it is also limited by remaining time of function execution
+operation_timeout = 60
+# route table updates which operations are not completed yet, completion of operations is checked between checks of router status without blocking them
+# list of dictionaries with 'route_table' (route table dictionary for failover function), 'attempt' (number of update requests), 'deadline' (time until operation is waited),
+# 'operation' (dictionary returned by failover function) and 'failover' (dictionary with time of router status check, number of route tables, failed and superseded route table ids of failover)
+route_table_updates = list()
+# route tables which were not updated (request or operation failed or operation was not completed until its deadline), next hops of their modified routes
+# are returned to previous next hops in route index at next check of router status, so that these routes are switched again
+failed_route_tables = list()
+# config, state, route tables and route index returned by get_config_route_tables_and_routers function with time when route tables were read,
+# reused by long-running route-switcher process (daemon.py) when checking of router status is started again before route tables should be read again
+route_tables_cache = {'route_tables': None, 'read_time': 0}
+# network interfaces of routers which security groups are not updated yet as last operation of updating them is in progress, they are updated at next checks of router status
+# as soon as last operation is completed, as {key:value}, where key - (vm id, network interface index), value - router network interface dictionary
+waiting_network_interfaces = {}
+# time when function execution is stopped (execution timeout of function), time in seconds before it is reserved for writing state and journal and releasing lease
+execution_deadline = float('inf')
+execution_exit_time = 10
+# status of operations kept in memory between checks of router status as {key:value}, where key - operation id, value - True if operation is completed
+# completed operations are not requested again, only last operation_tracker_size operations are kept
+operation_tracker = {}
+operation_tracker_size = 1000
+# lease object in bucket, only launch of function which holds the lease checks router status and updates route tables
+lease_path = 'route-switcher-lease.json'
+# lease held by this launch of function: holder id, ETag of lease object, lease expiration time and end time of this launch of function
+lease_state = {'holder': None, 'etag': None, 'expires': 0, 'ends': 0}
+# runtime state of route-switcher in bucket: primary next hops of routes, operation ids of security groups updates and last router status
+# config file in bucket is not modified by function
+state_path = 'route-switcher-state.json'
+# cached state with ETag of state object, 'dirty' is True if state was changed and is not written to bucket yet
+state_cache = {'etag': None, 'state': None, 'dirty': False, 'write_time': 0}
+# min interval in seconds between writes of state changes which do not affect failover, e.g. changes of router status
+state_write_interval = 60
+# append-only journal of router status changes, failover decisions and update operations in bucket
+# events are buffered in memory and written as new segment objects '<journal_prefix>/<YYYY-MM-DD>/<HH>/<first event ms>-<last event ms>-<shard>-<id>.jsonl', segment objects are never changed
+journal_prefix = 'route-switcher-journal'
+journal_events = list()
+journal_lock = threading.Lock()
+journal_state = {'flush_time': 0}
+# min interval in seconds between writes of journal segments, events of failover are written immediately
+journal_flush_interval = int(os.getenv('JOURNAL_FLUSH_INTERVAL', '60'))
+# max number of events in memory if journal can not be written, oldest events are dropped
+journal_max_events = 10000
+# queue of metrics batches for writing in Yandex Monitoring by background thread
+metrics_queue = queue.Queue(maxsize=100)
+metrics_writer = None
+# last written values of metrics as {key:value}, where key - metric name and labels, value - (metric value, time of writing)
+# values are stored by background thread after metrics are written in Yandex Monitoring
+metrics_last_values = {}
+metrics_last_values_lock = threading.Lock()
+# interval in seconds for writing metrics which values were not changed
+metrics_resend_interval = 60
+# max number of attempts to write metrics batch
+metrics_write_attempts = 3
+# time in seconds to write metrics from queue before function exit if remaining time of function execution is unknown
+metrics_flush_timeout = 10
+# max latencies in ms of API requests and phases of function as {key:value}, where key - (metric name, labels), value - max latency since last writing of metrics
+timings = {}
+timings_lock = threading.Lock()
+# set to stop checking router status, used by long-running route-switcher process (daemon.py) to shut down on signals
+stop_event = threading.Event()
+# set by preview of failover plans (plans.py): state, journal and metrics are not written, so preview does not change state of route-switcher without its lease
+dry_run = False
+# state of checking router status, kept between warm invocations of function: last router status from NLB and time until router status is checked with router_healthcheck_fast_interval
+poll_state = {'routerStatus': None, 'fast_until': 0}
+# state of direct TCP probes of routers: number of consecutive failed probes as {key:value}, where key - healthchecked IP address of router, value - number of failed probes
+# 'suspect' - True if some router is not reachable by last probe while other router of the same cluster is reachable, 'addresses' - healthchecked IP addresses of routers to probe,
+# 'clusters' - lists of healthchecked IP addresses of routers of each cluster
+probe_state = {'failures': {}, 'suspect': False, 'addresses': [], 'clusters': []}
+# cached security groups of router network interfaces as {key:value}, where key - router vm id, value - dictionary with 'security_group_ids' ({interface index: list of security group ids}), 'read_time'
+# and 'router_status' (status of routers of cluster when security groups were read, security groups are read again after change of status of routers of cluster)
+security_groups_cache = {'instances': {}}
 path = os.getenv('CONFIG_PATH')
 bucket = os.getenv('BUCKET_NAME')
 cron_interval = int(os.getenv('CRON_INTERVAL'))
@@ -19,75 +153,1008 @@ router_healthcheck_interval = int(os.getenv('ROUTER_HCHK_INTERVAL'))
 # validate if router_healthcheck_interval less than 10 seconds, than increase it to 10 seconds
 if router_healthcheck_interval < 10:
     router_healthcheck_interval = 10
+router_healthcheck_fast_interval = int(os.getenv('ROUTER_HCHK_FAST_INTERVAL', '2'))
+# validate if router_healthcheck_fast_interval is between 1 second and router_healthcheck_interval
+if router_healthcheck_fast_interval < 1:
+    router_healthcheck_fast_interval = 1
+if router_healthcheck_fast_interval > router_healthcheck_interval:
+    router_healthcheck_fast_interval = router_healthcheck_interval
+# time in seconds of checking router status with router_healthcheck_fast_interval after router status was changed
+router_healthcheck_fast_duration = 30
+# direct TCP probes of healthchecked IP addresses of routers in addition to NLB healthcheck, disabled if port is not set
+# router is considered UNHEALTHY after router_probe_failures consecutive failed probes even if NLB still reports it HEALTHY
+router_probe_port = int(os.getenv('ROUTER_PROBE_PORT') or 0)
+router_probe_timeout = float(os.getenv('ROUTER_PROBE_TIMEOUT', '0.5'))
+router_probe_failures = max(int(os.getenv('ROUTER_PROBE_FAILURES', '2')), 1)
+# interval in seconds between direct probes of routers while waiting for next check of router status
+router_probe_interval = max(float(os.getenv('ROUTER_PROBE_INTERVAL', '1')), router_probe_timeout)
+# interval in seconds for reading security groups of router network interfaces from Compute API when router status does not change, cached security groups are used between reads
+security_groups_reconcile_interval = max(int(os.getenv('SG_RECONCILE_INTERVAL', '300')), 0)
+# hysteresis of returning routes to primary router after its recovery: min number of consecutive checks with HEALTHY status of router
+# and min time in seconds since last change of status of any router, so that several changes of router status result in one update of each route table
+failback_min_checks = max(int(os.getenv('FAILBACK_MIN_CHECKS', '3')), 1)
+failback_hold_down = max(int(os.getenv('FAILBACK_HOLD_DOWN', '30')), 0)
+# flap damping: each change of router status adds penalty which decays with half life in seconds (0 disables flap damping)
+# routes are not returned to flapping router while its penalty is more than reuse limit after it reached suppress limit
+flap_half_life = max(int(os.getenv('FLAP_HALF_LIFE', '300')), 0)
+flap_penalty = 1000
+flap_suppress_limit = 3000
+flap_reuse_limit = 750
+# max penalty limits time of suppression of flapping router to 3 half lives
+flap_max_penalty = 6000
+# time in seconds until lease expires if it is not renewed by its holder
+lease_duration = max(3 * router_healthcheck_interval, 30)
 folder_name = os.getenv('FOLDER_NAME')
 function_name = os.getenv('FUNCTION_NAME')
+# number of route-switcher shards, route tables are partitioned across shards by consistent hashing of route table id
+# each shard has its own lease and state in bucket, security groups of routers are switched by shard 0
+shard_count = max(int(os.getenv('SHARD_COUNT', '1')), 1)
+# index of shard of long-running route-switcher process, for function shard index is set by payload of timer trigger
+default_shard_index = int(os.getenv('SHARD_INDEX', '0'))
+shard_index = 0
+# number of points of each shard on hash ring
+shard_ring_points = 64
+# hash ring of shards: sorted points and shard index of each point
+shard_ring = {'points': [], 'shards': []}
+
+def get_hash_point(key):
+    '''
+    gets point of key on hash ring, the same in all route-switcher shards
+    :param key: key, e.g. route table id
+    :return: integer point on hash ring
+    '''
+
+    return int(hashlib.md5(key.encode()).hexdigest()[:16], 16)
+
+def get_route_table_shard(route_table_id):
+    '''
+    gets shard which owns route table by consistent hashing of route table id
+    only part of route tables is moved to another shard if number of shards is changed
+    :param route_table_id: route table id
+    :return: shard index
+    '''
+
+    if shard_count == 1:
+        return 0
+    if not shard_ring['points']:
+        ring = sorted((get_hash_point('shard-%s-%s' % (shard, point)), shard) for shard in range(shard_count) for point in range(shard_ring_points))
+        shard_ring['points'] = [point for point, shard in ring]
+        shard_ring['shards'] = [shard for point, shard in ring]
+    return shard_ring['shards'][bisect.bisect(shard_ring['points'], get_hash_point(route_table_id)) % len(shard_ring['points'])]
+
+def get_shard_object_path(object_path, shard):
+    '''
+    gets path of object in bucket for shard, objects of shard 0 have the same paths as without sharding
+    :param object_path: path of object, e.g. 'route-switcher-lease.json'
+    :param shard: shard index
+    :return: path of object for shard, e.g. 'route-switcher-lease-shard-1.json'
+    '''
+
+    if shard == 0:
+        return object_path
+    name, extension = os.path.splitext(object_path)
+    return '%s-shard-%s%s' % (name, shard, extension)
+
+def set_shard(index):
+    '''
+    sets shard of this launch of function, cached state of another shard is reset as warm instance of function can be launched by trigger of another shard
+    :param index: shard index
+    :return: True if shard index is valid, otherwise False
+    '''
+
+    global shard_index, lease_path, state_path
+    if index < 0 or index >= shard_count:
+        print(f"Shard index {index} is not valid for {shard_count} shards. Please check 'shard_count' input variable for Terraform route-switcher module.")
+        return False
+    if index != shard_index:
+        shard_index = index
+        lease_path = get_shard_object_path('route-switcher-lease.json', shard_index)
+        state_path = get_shard_object_path('route-switcher-state.json', shard_index)
+        state_cache.update({'etag': None, 'state': None, 'dirty': False, 'write_time': 0})
+        poll_state.update({'routerStatus': None, 'fast_until': 0})
+    return True
+
+def get_event_shard_index(event):
+    '''
+    gets shard index from payload of timer trigger, e.g. '{"shard_index": 1}'
+    :param event: event of function invocation
+    :return: shard index from payload or default_shard_index if payload does not have shard index
+    '''
+
+    details = event.get('details') or (event.get('messages') or [{}])[0].get('details') or {}
+    try:
+        return int(json.loads(details['payload'])['shard_index'])
+    except (KeyError, TypeError, ValueError):
+        return default_shard_index
+
+def set_iam_token(token):
+    '''
+    sets IAM token for API requests and updates Authorization header in already opened API sessions
+    :param token: IAM token of function service account
+    :return:
+    '''
+
+    global iam_token
+    iam_token = token
+    with api_sessions_lock:
+        for session in api_sessions.values():
+            session.headers['Authorization'] = 'Bearer %s' % iam_token
+
+def get_executor():
+    '''
+    gets thread pool for parallel API requests, thread pool is created once and reused (also between warm invocations of function)
+    :return: thread pool executor
+    '''
+
+    global executor
+    if executor is None:
+        executor = pool.ThreadPoolExecutor(max_workers=max_workers)
+    return executor
+
+def get_api_name(api_path):
+    '''
+    gets API name by path of API request, e.g. for '/vpc/v1/routeTables/<id>' API name is 'vpc'
+    :param api_path: path of API request
+    :return: API name
+    '''
+
+    api = api_path.split('/')[1]
+    if api == 'operations':
+        return 'operation'
+    return api
+
+def get_api_session(api_endpoint, api=None):
+    '''
+    gets keep-alive HTTP session for API endpoint, session is created once and reused by all requests to this endpoint (also between warm invocations of function)
+    :param api_endpoint: url of API endpoint
+    :param api: API name, used to set size of connection pool
+    :return: requests session with connection pool and Authorization header
+    '''
+
+    with api_sessions_lock:
+        session = api_sessions.get(api_endpoint)
+        if session is None:
+            session = requests.Session()
+            # connection pool should be not less than number of parallel requests to API endpoint
+            session.mount(api_endpoint, requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=api_concurrency.get(api, max_workers)))
+            session.headers['Authorization'] = 'Bearer %s' % iam_token
+            api_sessions[api_endpoint] = session
+    return session
+
+class TokenBucket:
+    '''
+    token bucket which limits rate of requests to API, requests to API are also paused until time from Retry-After header of throttled request
+    '''
+
+    def __init__(self, rate=None):
+        # max number of requests per second or None if rate is not limited
+        self.rate = rate
+        self.capacity = max(rate, 1) if rate else 0
+        self.tokens = self.capacity
+        self.update_time = time.time()
+        # time until requests to API are paused after API returned 429 status code
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        '''
+        waits until request to API is allowed
+        :return:
+        '''
+
+        while True:
+            with self.lock:
+                current_time = time.time()
+                delay = self.paused_until - current_time
+                if delay <= 0:
+                    if not self.rate:
+                        return
+                    self.tokens = min(self.capacity, self.tokens + (current_time - self.update_time) * self.rate)
+                    self.update_time = current_time
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+    def pause(self, delay):
+        '''
+        pauses requests to API after API returned 429 status code
+        :param delay: time in seconds of pause
+        :return:
+        '''
+
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.time() + delay)
+
+
+def get_rate_bucket(api):
+    '''
+    gets token bucket of API, token bucket is created once and reused (also between warm invocations of function)
+    :param api: API name
+    :return: token bucket
+    '''
+
+    with api_rate_buckets_lock:
+        if api not in api_rate_buckets:
+            api_rate_buckets[api] = TokenBucket(api_rate_limits.get(api))
+        return api_rate_buckets[api]
+
+def get_retry_delay(r, attempt):
+    '''
+    gets delay before next attempt of API request: value of Retry-After header of response or exponential backoff with full jitter
+    :param r: response of API request or None if request failed
+    :param attempt: number of attempt
+    :return: delay in seconds
+    '''
+
+    if r is not None:
+        try:
+            return min(float(r.headers.get('Retry-After')), api_retry_max_delay)
+        except (TypeError, ValueError):
+            pass
+    return random.uniform(0, min(api_retry_delay * 2 ** attempt, api_retry_max_delay))
+
+def api_request(method, api_endpoint, api_path, timeout=api_timeout, attempts=api_request_attempts, **kwargs):
+    '''
+    sends request to API endpoint using keep-alive HTTP session
+    rate of requests is limited by token bucket of API, request is retried if API returns 429 or 5xx status code or request fails
+    :param method: HTTP method, e.g. 'GET'
+    :param api_endpoint: url of API endpoint
+    :param api_path: path of API request, e.g. '/vpc/v1/routeTables/<id>'
+    :param timeout: timeout in seconds (connect timeout, read timeout) for API request
+    :param attempts: max number of attempts of API request
+    :param kwargs: other parameters of request, e.g. json
+    :return: response of API request
+    '''
+
+    api = get_api_name(api_path)
+    rate_bucket = get_rate_bucket(api)
+    for attempt in range(1, attempts + 1):
+        r = None
+        try:
+            r = send_api_request(api, method, api_endpoint, api_path, rate_bucket, timeout=timeout, **kwargs)
+        except requests.exceptions.RequestException as e:
+            if attempt == attempts:
+                raise
+            print(f"Request {method} {api_path} failed due to: {e}. Retrying (attempt {attempt + 1} of {attempts})...")
+        else:
+            if r.status_code != 429 and r.status_code < 500 or attempt == attempts:
+                return r
+            print(f"Unexpected status code {r.status_code} for request {method} {api_path}. Retrying (attempt {attempt + 1} of {attempts})...")
+        delay = get_retry_delay(r, attempt)
+        if r is not None and r.status_code == 429:
+            # API quota is exceeded, pause all requests to API
+            rate_bucket.pause(delay)
+        else:
+            time.sleep(delay)
+
+def send_api_request(api, method, api_endpoint, api_path, rate_bucket, timeout=api_timeout, **kwargs):
+    '''
+    sends one attempt of API request when it is allowed by token bucket and number of parallel requests to API
+    :return: response of API request
+    '''
+
+    rate_bucket.acquire()
+    semaphore = api_semaphores.get(api)
+    if semaphore is not None:
+        # wait until number of parallel requests to API is less than limit
+        semaphore.acquire()
+    request_start = time.time()
+    try:
+        return get_api_session(api_endpoint, api).request(method, api_endpoint + api_path, timeout=timeout, **kwargs)
+    finally:
+        if semaphore is not None:
+            semaphore.release()
+        # record latency of API request
+        record_timing('route_switcher.api_latency_ms', {'api': api, 'method': method}, (time.time() - request_start) * 1000, log=False)
+
+def record_timing(metric_name, labels, latency_ms, log=True):
+    '''
+    records latency of API request or phase of function for writing in Yandex Monitoring and prints it as structured JSON log record
+    :param metric_name: name of metric, e.g. 'route_switcher.phase_latency_ms'
+    :param labels: dictionary with labels of metric
+    :param latency_ms: latency in ms
+    :param log: print JSON log record
+    :return:
+    '''
+
+    labels = dict(labels, route_switcher_name=function_name, folder_name=folder_name)
+    timing_key = (metric_name, tuple(sorted(labels.items())))
+    with timings_lock:
+        timings[timing_key] = max(timings.get(timing_key, 0), latency_ms)
+    if log:
+        print(json.dumps({'metric': metric_name, 'labels': labels, 'latency_ms': round(latency_ms, 1)}))
+
+def record_phase(phase, phase_start, **labels):
+    '''
+    records latency of phase of function as 'route_switcher.phase_latency_ms' metric
+    :param phase: name of phase, e.g. 'config'
+    :param phase_start: start time of phase
+    :param labels: additional labels of metric
+    :return:
+    '''
+
+    record_timing('route_switcher.phase_latency_ms', dict(labels, phase=phase), (time.time() - phase_start) * 1000)
+
+def write_timing_metrics():
+    '''
+    writes recorded latencies in Yandex Monitoring
+    :return:
+    '''
+
+    with timings_lock:
+        recorded_timings = list(timings.items())
+        timings.clear()
+    if recorded_timings:
+        write_metrics([{"name": metric_name, "labels": dict(labels), "type": "DGAUGE", "value": round(latency_ms, 1)} for (metric_name, labels), latency_ms in recorded_timings])
+
+class StorageError(Exception):
+    '''
+    error response of object storage, has the same 'response' attribute as botocore ClientError
+    '''
+
+    def __init__(self, status_code, code, message=''):
+        super().__init__(f"{code} ({status_code}): {message}")
+        self.response = {'Error': {'Code': code, 'Message': message}, 'ResponseMetadata': {'HTTPStatusCode': status_code}}
+
+
+class StorageClient:
+    '''
+    lightweight S3 client for getting and putting objects in object storage with AWS Signature Version 4
+    used instead of boto3 to avoid import of boto3 and botocore at cold start of function
+    '''
+
+    def __init__(self, endpoint_url, access_key_id, secret_access_key, session_token=None, region='ru-central1'):
+        self.endpoint_url = endpoint_url.rstrip('/')
+        self.host = urllib.parse.urlparse(self.endpoint_url).netloc
+        self.access_key_id = access_key_id
+        self.secret_access_key = secret_access_key
+        self.session_token = session_token
+        self.region = region
+
+    def sign(self, method, path, query_string, signed_headers, request_time):
+        '''
+        calculates AWS Signature Version 4 of request
+        :param method: HTTP method, e.g. 'GET'
+        :param path: encoded path of request, e.g. '/bucket/key'
+        :param query_string: encoded query string of request with sorted parameters
+        :param signed_headers: dictionary with lowercase names and values of signed headers, including 'host', 'x-amz-content-sha256' and 'x-amz-date'
+        :param request_time: time of request in UTC (datetime)
+        :return: value of Authorization header
+        '''
+
+        amz_date = request_time.strftime('%Y%m%dT%H%M%SZ')
+        scope = '%s/%s/s3/aws4_request' % (request_time.strftime('%Y%m%d'), self.region)
+        signed_header_names = ';'.join(sorted(signed_headers))
+        canonical_request = '\n'.join([method, path, query_string, ''.join('%s:%s\n' % (name, signed_headers[name]) for name in sorted(signed_headers)), signed_header_names, signed_headers['x-amz-content-sha256']])
+        string_to_sign = '\n'.join(['AWS4-HMAC-SHA256', amz_date, scope, hashlib.sha256(canonical_request.encode()).hexdigest()])
+        signing_key = ('AWS4' + self.secret_access_key).encode()
+        for scope_part in scope.split('/'):
+            signing_key = hmac.new(signing_key, scope_part.encode(), hashlib.sha256).digest()
+        signature = hmac.new(signing_key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+        return 'AWS4-HMAC-SHA256 Credential=%s/%s, SignedHeaders=%s, Signature=%s' % (self.access_key_id, scope, signed_header_names, signature)
+
+    def request(self, method, bucket_name, key, body=b'', headers=None, query=None):
+        '''
+        sends signed path-style request to object storage
+        :return: response of object storage
+        '''
+
+        request_time = datetime.datetime.now(datetime.timezone.utc)
+        object_path = urllib.parse.quote('/%s/%s' % (bucket_name, key), safe='/-_.~')
+        signed_headers = {'host': self.host, 'x-amz-content-sha256': hashlib.sha256(body).hexdigest(), 'x-amz-date': request_time.strftime('%Y%m%dT%H%M%SZ')}
+        if self.session_token:
+            signed_headers['x-amz-security-token'] = self.session_token
+        # query parameters are sorted and encoded in the same way in canonical request and in url
+        query_string = '&'.join('%s=%s' % (urllib.parse.quote(name, safe='-_.~'), urllib.parse.quote(str(value), safe='-_.~')) for name, value in sorted((query or {}).items()))
+        request_headers = dict(headers or {}, **signed_headers)
+        request_headers['Authorization'] = self.sign(method, object_path, query_string, signed_headers, request_time)
+        session = get_api_session(self.endpoint_url)
+        # keep-alive session of storage endpoint is used, Authorization header of session is replaced with signature of request
+        r = session.request(method, self.endpoint_url + object_path + ('?' + query_string if query_string else ''), data=body or None, headers=request_headers, timeout=api_timeout)
+        if r.status_code >= 300:
+            error_code = re.search(r'<Code>(.*?)</Code>', r.text)
+            error_message = re.search(r'<Message>(.*?)</Message>', r.text)
+            raise StorageError(r.status_code, error_code.group(1) if error_code else str(r.status_code), error_message.group(1) if error_message else '')
+        return r
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None):
+        r = self.request('GET', Bucket, Key, headers={'If-None-Match': IfNoneMatch} if IfNoneMatch else None)
+        return {'Body': io.BytesIO(r.content), 'ETag': r.headers.get('ETag')}
+
+    def put_object(self, Bucket, Key, Body, ContentType='application/octet-stream', IfMatch=None, IfNoneMatch=None):
+        headers = {'Content-Type': ContentType}
+        if IfMatch:
+            headers['If-Match'] = IfMatch
+        if IfNoneMatch:
+            headers['If-None-Match'] = IfNoneMatch
+        r = self.request('PUT', Bucket, Key, body=Body, headers=headers)
+        return {'ETag': r.headers.get('ETag')}
+
+    def list_objects_v2(self, Bucket, Prefix='', StartAfter=None, ContinuationToken=None):
+        query = {'list-type': '2', 'prefix': Prefix}
+        if StartAfter:
+            query['start-after'] = StartAfter
+        if ContinuationToken:
+            query['continuation-token'] = ContinuationToken
+        r = self.request('GET', Bucket, '', query=query)
+        response = {'Contents': [{'Key': html.unescape(key)} for key in re.findall(r'<Key>(.*?)</Key>', r.text)], 'IsTruncated': '<IsTruncated>true</IsTruncated>' in r.text}
+        continuation_token = re.search(r'<NextContinuationToken>(.*?)</NextContinuationToken>', r.text)
+        if continuation_token:
+            response['NextContinuationToken'] = html.unescape(continuation_token.group(1))
+        return response
+
+
+def get_storage_error_code(e):
+    '''
+    gets error code of object storage from exception of StorageClient or boto3 client
+    :param e: exception
+    :return: error code, e.g. 'NoSuchKey' or '304', or None if exception is not an error response of object storage
+    '''
+
+    response = getattr(e, 'response', None)
+    if isinstance(response, dict):
+        return response.get('Error', {}).get('Code')
+
+def get_s3_client(endpoint_url='https://storage.yandexcloud.net'):
+    '''
+    gets S3 client for object storage, client is created once and reused between warm invocations of function
+    lightweight client is used if static access key is set in environment variables, otherwise boto3 is imported and its client is used
+    boto3 client is also used if S3_CLIENT environment variable is 'boto3'
+    :param endpoint_url: url of object storage
+    :return: S3 client
+    '''
+
+    global s3_client
+    if s3_client is None:
+        phase_start = time.time()
+        if os.getenv('S3_CLIENT', 'lightweight') != 'boto3' and os.getenv('AWS_ACCESS_KEY_ID') and os.getenv('AWS_SECRET_ACCESS_KEY'):
+            s3_client = StorageClient(endpoint_url, os.getenv('AWS_ACCESS_KEY_ID'), os.getenv('AWS_SECRET_ACCESS_KEY'), os.getenv('AWS_SESSION_TOKEN'), os.getenv('AWS_DEFAULT_REGION', 'ru-central1'))
+        else:
+            # import boto3 only if it is used as it takes most of import time of function
+            import boto3
+            session = boto3.session.Session()
+            s3_client = session.client(
+                service_name='s3',
+                endpoint_url=endpoint_url
+            )
+        record_phase('s3_client_init', phase_start)
+    return s3_client
+
+class RouterModel:
+    '''
+    router configuration compiled from config file
+    '''
+
+    __slots__ = ('healthchecked_ip', 'vm_id', 'primary', 'interfaces', 'nexthops', 'interfaces_by_index')
+
+    def __init__(self, router):
+        self.healthchecked_ip = router.get('healthchecked_ip')
+        self.vm_id = router.get('vm_id')
+        self.primary = router.get('primary') == True
+        # list of interface dictionaries from config file
+        self.interfaces = router.get('interfaces') or list()
+        # dictionary with router nexthops as {key:value}, where key - nexthop address, value - nexthop address of backup router
+        self.nexthops = {}
+        # dictionary with router interfaces which have security groups as {key:value}, where key - interface index, value - interface dictionary from config file
+        self.interfaces_by_index = {}
+
+
+class ClusterModel:
+    '''
+    cluster of routers checked by its own NLB target group, next hops of routes and security groups are switched only between routers of the same cluster
+    '''
+
+    __slots__ = ('name', 'load_balancer_id', 'target_group_id', 'routers', 'primary_router', 'backup_router')
+
+    def __init__(self, cluster):
+        self.load_balancer_id = cluster.get('loadBalancerId')
+        self.target_group_id = cluster.get('targetGroupId')
+        self.name = cluster.get('name') or self.load_balancer_id
+        # list of routers of cluster
+        self.routers = list()
+        # primary and backup routers with 'vm_id' configuration for switching of security groups
+        self.primary_router = None
+        self.backup_router = None
+
+
+class ConfigModel:
+    '''
+    config file compiled into clusters of routers, nexthops and primary/backup router pairs, config is compiled once for each ETag of config file
+    '''
+
+    __slots__ = ('config', 'etag', 'config_error', 'router_errors', 'clusters', 'router_clusters', 'routers', 'routers_by_ip', 'nexthops', 'nexthop_routers', 'route_table_priorities')
+
+    def __init__(self, config, etag):
+        # configuration dictionary from bucket, it is not modified by function
+        self.config = config
+        self.etag = etag
+        # error which does not allow to check router status, e.g. there are no routers in config file
+        self.config_error = None
+        # list of errors in routers configuration
+        self.router_errors = list()
+        # list of clusters of routers
+        self.clusters = list()
+        # dictionary with clusters of routers as {key:value}, where key - router healthcheck IP address, value - cluster
+        self.router_clusters = {}
+        # list of routers of all clusters
+        self.routers = list()
+        # dictionary with routers as {key:value}, where key - router healthcheck IP address, value - router
+        self.routers_by_ip = {}
+        # dictionary with nexthops of all routers as {key:value}, where key - nexthop address, value - nexthop address of backup router
+        self.nexthops = {}
+        # dictionary with router healthcheck IP addresses as {key:value}, where key - nexthop address, value - router healthcheck IP address of this nexthop address
+        self.nexthop_routers = {}
+        # dictionary with priorities of route tables as {key:value}, where key - route table id, value - priority, route tables with higher priority are updated first
+        self.route_table_priorities = {}
+
+
+def compile_config(config, etag=None):
+    '''
+    validates config and compiles it into config model
+    :param config: configuration dictionary from bucket
+    :param etag: ETag of config file in bucket
+    :return: config model
+    '''
+
+    model = ConfigModel(config, etag)
+
+    # check whether we have routers in config
+    if not isinstance(config, dict) or (config.get('routers') is None and not config.get('clusters')):
+        model.config_error = f"Routers configuration does not exist. Please add 'routers' input variable for Terraform route-switcher module. Retrying in {cron_interval} minutes..."
+        return model
+    # check whether we have route tables in config
+    if config.get('route_tables') is None:
+        model.config_error = f"There are no route tables in config file in bucket. Please add at least one route table. Retrying in {cron_interval} minutes..."
+        return model
+
+    for config_route_table in config['route_tables']:
+        model.route_table_priorities[config_route_table['route_table_id']] = config_route_table.get('priority') or 0
+
+    # routers in 'routers' of config are checked by NLB 'loadBalancerId', routers of each item of 'clusters' are checked by NLB of cluster
+    cluster_configs = ([config] if config.get('routers') is not None else list()) + list(config.get('clusters') or list())
+    for cluster_config in cluster_configs:
+        cluster = ClusterModel(cluster_config)
+        if not cluster.load_balancer_id or not cluster.target_group_id:
+            model.config_error = f"Cluster of routers {cluster.name} does not have 'loadBalancerId' or 'targetGroupId' configuration. Please check configuration file in bucket. Retrying in {cron_interval} minutes..."
+            return model
+        # cluster is named in errors if config has several clusters of routers
+        cluster_label = f" in cluster {cluster.name}" if len(cluster_configs) > 1 else ""
+        security_groups = False
+        vm_routers = list()
+        for router_config in cluster_config.get('routers') or list():
+            router = RouterModel(router_config)
+            router_hc_address = router.healthchecked_ip
+            if not router_hc_address:
+                model.router_errors.append(f"Router does not have 'healthchecked_ip' configuration. Please add 'healthchecked_ip' value in 'routers' input variable for Terraform route-switcher module.")
+                continue
+            if router_hc_address in model.routers_by_ip:
+                model.router_errors.append(f"Router {router_hc_address} is configured more than once. Please use each router in only one cluster of routers in 'routers' or 'router_clusters' input variables for Terraform route-switcher module.")
+                continue
+            model.router_clusters[router_hc_address] = cluster
+            if not router.interfaces:
+                model.router_errors.append(f"Router {router_hc_address} does not have 'interfaces' configuration. Please add 'interfaces' list in 'routers' input variable for Terraform route-switcher module.")
+                model.routers_by_ip[router_hc_address] = router
+                continue
+
+            for interface in router.interfaces:
+                has_index = interface.get('index') is not None
+                has_security_groups = bool(interface.get('security_group_ids'))
+                if has_index and has_security_groups:
+                    if not router.vm_id:
+                        model.router_errors.append(f"Router {router_hc_address} does not have 'vm_id' configuration and has 'index' and 'security groups' configuration for interfaces. Please add 'vm_id' value in 'routers' input variable for Terraform route-switcher module. Retrying in {cron_interval} minutes...")
+                    else:
+                        security_groups = True
+                    router.interfaces_by_index[interface['index']] = interface
+                elif has_index:
+                    model.router_errors.append(f"Router {router_hc_address} does not have 'security groups' configuration for interface with {interface['index']} index. Please add 'security_group_ids' value in 'interfaces' input variable for Terraform route-switcher module.")
+                elif has_security_groups:
+                    model.router_errors.append(f"Router {router_hc_address} does not have 'index' configuration for interface with {interface['security_group_ids']} security groups. Please add 'index' value in 'interfaces' input variable for Terraform route-switcher module.")
+                # prepare dictionaries with router nexthops and router healthcheck IP addresses of nexthops
+                if interface.get('own_ip') and interface.get('backup_peer_ip'):
+                    router.nexthops[interface['own_ip']] = interface['backup_peer_ip']
+                    model.nexthop_routers[interface['own_ip']] = router_hc_address
+                elif interface.get('backup_peer_ip'):
+                    model.router_errors.append(f"Router {router_hc_address} does not have 'own_ip' configuration for interface. Please add 'own_ip' value in 'interfaces' input variable for Terraform route-switcher module.")
+                elif interface.get('own_ip'):
+                    model.router_errors.append(f"Router {router_hc_address} does not have 'backup_peer_ip' configuration for interface. Please add 'backup_peer_ip' value in 'interfaces' input variable for Terraform route-switcher module.")
+            model.nexthops.update(router.nexthops)
+
+            if router.vm_id:
+                vm_routers.append(router)
+                if not security_groups:
+                    model.router_errors.append(f"Router {router_hc_address} has 'vm_id' configuration and does not have 'index' and 'security groups' configuration for interfaces. Please add 'index' and 'security_group_ids' value in 'interfaces' input variable for Terraform route-switcher module or remove 'vm_id' value for router {router_hc_address} configuration.")
+            cluster.routers.append(router)
+            model.routers.append(router)
+            model.routers_by_ip[router_hc_address] = router
+
+        if vm_routers:
+            primary_routers = [router for router in vm_routers if router.primary]
+            if len(primary_routers) != 1:
+                model.router_errors.append(f"There should be one router with 'primary = true' configuration{cluster_label}. Please add 'primary = true' value to only one router with 'vm_id' value in 'routers' input variable for Terraform route-switcher module. Retrying in {cron_interval} minutes...")
+            if len(vm_routers) != 2:
+                model.router_errors.append(f"There should be two routers with 'vm_id' configuration{cluster_label}. Please add 'vm_id' value to only two routers in 'routers' input variable for Terraform route-switcher module. Retrying in {cron_interval} minutes...")
+            if len(primary_routers) == 1 and len(vm_routers) == 2:
+                cluster.primary_router = primary_routers[0]
+                cluster.backup_router = vm_routers[0] if vm_routers[1] is cluster.primary_router else vm_routers[1]
+        model.clusters.append(cluster)
+
+    for nexthop, backup_nexthop in model.nexthops.items():
+        # next hops of routes are switched only between routers of the same cluster
+        if backup_nexthop in model.nexthop_routers and model.router_clusters[model.nexthop_routers[backup_nexthop]] is not model.router_clusters[model.nexthop_routers[nexthop]]:
+            model.router_errors.append(f"Router {model.nexthop_routers[nexthop]} has 'backup_peer_ip' {backup_nexthop} of router {model.nexthop_routers[backup_nexthop]} from another cluster of routers. Please use 'backup_peer_ip' of router from the same cluster.")
+
+    return model
 
 def get_config(endpoint_url='https://storage.yandexcloud.net'):
     '''
-    gets config in special format from bucket
+    gets config in special format from bucket and compiles it into config model
+    config file is downloaded, parsed and validated only if it was changed in bucket (conditional request with ETag of cached config file)
     :param endpoint_url: url of object storage
-    :return: configuration dictionary from bucket with route tables and load balancer id and list with route table ids and its actual routes in VPC 
+    :return: config model with configuration dictionary from bucket, it is shared between checks of router status and warm invocations of function
     '''
 
-    session = boto3.session.Session()
-    s3_client = session.client(
-        service_name='s3',
-        endpoint_url=endpoint_url
-    )
+    s3_client = get_s3_client(endpoint_url)
 
-    try:    
-        response = s3_client.get_object(Bucket=bucket, Key=path)
-        config = yaml.load(response["Body"], Loader=yaml.FullLoader)
+    try:
+        if config_cache['etag'] is not None:
+            response = s3_client.get_object(Bucket=bucket, Key=path, IfNoneMatch=config_cache['etag'])
+        else:
+            response = s3_client.get_object(Bucket=bucket, Key=path)
+        config = yaml.load(response["Body"], Loader=yaml_loader)
     except Exception as e:
+        if get_storage_error_code(e) in ('304', 'NotModified'):
+            # config file was not changed in bucket, use cached config model
+            return config_cache['model']
         print(f"Request to get configuration file {path} in bucket failed due to: {e}. Please check that the configuration file exists in bucket {bucket}. Retrying in {cron_interval} minutes...")
         return
-    
-    return config
 
-def get_router_status(config):
+    # store compiled config model with ETag of config file in cache
+    model = compile_config(config, response.get('ETag'))
+    config_cache['etag'] = model.etag
+    config_cache['model'] = model
+    return model
+
+def get_cluster_router_status(cluster):
     '''
-    get routers status from NLB 
-    :param config: configuration dictionary with route tables and load balancer id
-    :return: dictionary (targetStatus) with healthchecked IP address of routers and its state
+    get status of routers of cluster from NLB
+    :param cluster: cluster of routers with load balancer id and target group id
+    :return: dictionary (targetStatus) with healthchecked IP address of routers and its state, or None if error happened
     '''
 
     targetStatus = {}
-    metrics = list()
-
-    # get router status from NLB
     try:    
-        r = requests.get("https://load-balancer.api.cloud.yandex.net/load-balancer/v1/networkLoadBalancers/%s:getTargetStates?targetGroupId=%s" % (config['loadBalancerId'], config['targetGroupId']), headers={'Authorization': 'Bearer %s'  % iam_token})
+        r = api_request('GET', load_balancer_endpoint, "/load-balancer/v1/networkLoadBalancers/%s:getTargetStates?targetGroupId=%s" % (cluster.load_balancer_id, cluster.target_group_id))
     except Exception as e:
-        print(f"Request to get target states in load balancer {config['loadBalancerId']} failed due to: {e}. Retrying in {cron_interval} minutes...")
+        print(f"Request to get target states in load balancer {cluster.load_balancer_id} failed due to: {e}. Retrying in {cron_interval} minutes...")
         return 
     
     if r.status_code != 200:
-        print(f"Unexpected status code {r.status_code} for getting target states in load balancer {config['loadBalancerId']}. More details: {r.json().get('message')}. Retrying in {cron_interval} minutes...")
+        print(f"Unexpected status code {r.status_code} for getting target states in load balancer {cluster.load_balancer_id}. More details: {r.json().get('message')}. Retrying in {cron_interval} minutes...")
         return 
 
     if 'targetStates' in r.json():
         if len(r.json()['targetStates']) < 2:
             # check whether we have at least two routers configured, if not return and generate an error
-            print(f"At least two routers should be in load balancer {config['loadBalancerId']}. Please add one more router. Retrying in {cron_interval} minute...")
+            print(f"At least two routers should be in load balancer {cluster.load_balancer_id}. Please add one more router. Retrying in {cron_interval} minute...")
             return 
-        else:
-            # prepare targetStatus dictionary (targetStatus) with {key:value}, where key - healthchecked IP address of router, value - HEALTHY or other state
-            for target in r.json()['targetStates']:
-                targetStatus[target['address']] = target['status']
-            if 'HEALTHY' not in targetStatus.values():
-                # all routers are not healthy, exit from function 
-                print(f"All routers are not healthy. Can not switch next hops for route tables. Retrying in {cron_interval} minutes...")
-                for target in r.json()['targetStates']:
-                    # add custom metric 'route_switcher.router_state' into metric list for Yandex Monitoring that router state is not healthy
-                    metrics.append({"name": "route_switcher.router_state", "labels": {"router_ip": target['address'], "folder_name": folder_name}, "type": "IGAUGE", "value": 0, "ts": str(datetime.datetime.now(datetime.timezone.utc).isoformat())})
-                # write metrics into Yandex Monitoring
-                write_metrics(metrics)
-                return
-            return targetStatus 
+        # prepare targetStatus dictionary (targetStatus) with {key:value}, where key - healthchecked IP address of router, value - HEALTHY or other state
+        for target in r.json()['targetStates']:
+            targetStatus[target['address']] = target['status']
+        return targetStatus
     else:
-        print(f"There are no target endpoints in load balancer {config['loadBalancerId']}. Please add two endpoints. Retrying in {cron_interval} minutes...")
+        print(f"There are no target endpoints in load balancer {cluster.load_balancer_id}. Please add two endpoints. Retrying in {cron_interval} minutes...")
         return    
 
+def get_router_status(model):
+    '''
+    get routers status from NLBs of all clusters of routers, target states of clusters are requested concurrently
+    routers of cluster are not in router status if target states of its NLB could not be read or all routers of cluster are not healthy,
+    so routes and security groups of this cluster are not switched while routers of other clusters are checked and switched as usual
+    :param model: config model with clusters of routers
+    :return: dictionary (targetStatus) with healthchecked IP address of routers and its state, or None if status of routers of all clusters could not be checked
+    '''
+
+    targetStatus = {}
+    metrics = list()
+
+    if router_probe_port:
+        # probe routers directly while waiting for response from NLB
+        probe_state['addresses'] = [router.healthchecked_ip for router in model.routers]
+        probe_state['clusters'] = [[router.healthchecked_ip for router in cluster.routers] for cluster in model.clusters]
+        probe_future = get_executor().submit(probe_routers, probe_state['addresses'], router_probe_port, router_probe_timeout)
+    # get router status from NLBs of clusters concurrently
+    if len(model.clusters) == 1:
+        cluster_statuses = [get_cluster_router_status(model.clusters[0])]
+    else:
+        cluster_statuses = list(get_executor().map(get_cluster_router_status, model.clusters))
+    probes_applied = False
+    if router_probe_port and any(clusterStatus is not None for clusterStatus in cluster_statuses):
+        try:
+            update_probe_state(probe_future.result())
+            probes_applied = True
+        except Exception as e:
+            print(f"Direct probes of routers failed due to: {e}. Router status from NLB is used.")
+
+    for cluster, clusterStatus in zip(model.clusters, cluster_statuses):
+        if clusterStatus is None:
+            continue
+        if probes_applied:
+            apply_router_probes(clusterStatus)
+        if 'HEALTHY' not in clusterStatus.values():
+            # all routers of cluster are not healthy, routes of cluster are not switched
+            print(f"All routers are not healthy{' in cluster ' + cluster.name if len(model.clusters) > 1 else ''}. Can not switch next hops for route tables. Retrying in {cron_interval} minutes...")
+            for router_hc_address in clusterStatus:
+                # add custom metric 'route_switcher.router_state' into metric list for Yandex Monitoring that router state is not healthy
+                metrics.append({"name": "route_switcher.router_state", "labels": {"router_ip": router_hc_address, "folder_name": folder_name}, "type": "IGAUGE", "value": 0})
+            continue
+        targetStatus.update(clusterStatus)
+    if metrics:
+        # write metrics into Yandex Monitoring
+        write_metrics(metrics)
+    if not targetStatus:
+        # exit from function as router status of all clusters could not be checked
+        return
+    return targetStatus
+
+
+def probe_routers(addresses, port, timeout):
+    '''
+    checks whether TCP port of routers accepts connections, connections to all routers are established concurrently with non-blocking sockets
+    :param addresses: list of healthchecked IP addresses of routers
+    :param port: TCP port
+    :param timeout: time in seconds to wait for connections
+    :return: dictionary with healthchecked IP address of router and True if connection was established, otherwise False
+    '''
+
+    probes = {}
+    selector = selectors.DefaultSelector()
+    deadline = time.time() + timeout
+    for address in addresses:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        error = sock.connect_ex((address, port))
+        if error in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+            selector.register(sock, selectors.EVENT_WRITE, address)
+        else:
+            probes[address] = error == 0
+            sock.close()
+    while selector.get_map() and time.time() < deadline:
+        for key, events in selector.select(deadline - time.time()):
+            probes[key.data] = key.fileobj.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0
+            selector.unregister(key.fileobj)
+            key.fileobj.close()
+    # connection was not established during timeout
+    for key in list(selector.get_map().values()):
+        probes[key.data] = False
+        key.fileobj.close()
+    selector.close()
+    return probes
+
+def update_probe_state(probes):
+    '''
+    counts consecutive failed probes of routers
+    probes of cluster are ignored if all routers of cluster are not reachable (e.g. function has no network access to network of cluster)
+    :param probes: dictionary with healthchecked IP address of router and result of probe
+    :return: True if some router, which was HEALTHY by last check of router status, reached router_probe_failures consecutive failed probes by this probe
+             while other router of the same cluster is reachable
+    '''
+
+    failed_routers = False
+    probe_state['suspect'] = False
+    for cluster_addresses in probe_state['clusters'] or [list(probes)]:
+        cluster_probes = {address: probes[address] for address in cluster_addresses if address in probes}
+        if not any(cluster_probes.values()):
+            for address in cluster_probes:
+                probe_state['failures'].pop(address, None)
+            continue
+        for address, reachable in cluster_probes.items():
+            probe_state['failures'][address] = 0 if reachable else probe_state['failures'].get(address, 0) + 1
+            # router which is already not HEALTHY or has been failing for longer does not require unscheduled check of router status
+            if probe_state['failures'][address] == router_probe_failures and (poll_state['routerStatus'] or {}).get(address) == 'HEALTHY':
+                failed_routers = True
+        probe_state['suspect'] = probe_state['suspect'] or not all(cluster_probes.values())
+    return failed_routers
+
+def apply_router_probes(targetStatus):
+    '''
+    combines router status from NLB with results of direct TCP probes of routers
+    HEALTHY router is considered UNHEALTHY after router_probe_failures consecutive failed probes, other states from NLB are not changed
+    :param targetStatus: dictionary with healthchecked IP address of routers and its state from NLB, updated by function
+    :return:
+    '''
+
+    for address, status in targetStatus.items():
+        failures = probe_state['failures'].get(address, 0)
+        if status == 'HEALTHY' and failures >= router_probe_failures:
+            targetStatus[address] = 'UNHEALTHY'
+            print(f"Router {address} is not reachable on TCP port {router_probe_port} during {failures} consecutive probes. Router is considered UNHEALTHY before NLB healthcheck.")
+
+def get_route_table(route_table_id):
+    '''
+    get route table from VPC
+    :param route_table_id: route table id
+    :return: route table dictionary from VPC API or None if error happened
+    '''
+
+    try:
+        r = api_request('GET', vpc_endpoint, "/vpc/v1/routeTables/%s" % route_table_id)
+    except Exception as e:
+        print(f"Request to get route table {route_table_id} failed due to: {e}. Retrying in {cron_interval} minutes...")
+        return
+
+    if r.status_code != 200:
+        print(f"Unexpected status code {r.status_code} for getting route table {route_table_id}. More details: {r.json().get('message')}. Retrying in {cron_interval} minutes...")
+        return
+
+    return r.json()
+
+def list_folder_route_tables(route_table_folder_id):
+    '''
+    get all route tables in folder from VPC using list API request with pagination
+    :param route_table_folder_id: folder id with route tables
+    :return: dictionary with route tables as {key:value}, where key - route table id, value - route table dictionary from VPC API, or None if error happened
+    '''
+
+    folder_routeTables = {}
+    page_token = None
+    while True:
+        params = {'folderId': route_table_folder_id, 'pageSize': 1000}
+        if page_token:
+            params['pageToken'] = page_token
+        try:
+            r = api_request('GET', vpc_endpoint, "/vpc/v1/routeTables", params=params)
+        except Exception as e:
+            print(f"Request to list route tables in folder {route_table_folder_id} failed due to: {e}.")
+            return
+
+        if r.status_code != 200:
+            print(f"Unexpected status code {r.status_code} for listing route tables in folder {route_table_folder_id}. More details: {r.json().get('message')}.")
+            return
+
+        response = r.json()
+        for vpc_routeTable in response.get('routeTables', []):
+            folder_routeTables[vpc_routeTable['id']] = vpc_routeTable
+        page_token = response.get('nextPageToken')
+        if not page_token:
+            return folder_routeTables
+
+def get_route_tables(route_table_ids, route_table_folder_ids=None):
+    '''
+    get route tables from VPC concurrently
+    if list of folders with route tables is less than list of route tables, route tables are listed per folder, other route tables are requested one by one
+    :param route_table_ids: list of route table ids
+    :param route_table_folder_ids: list of folder ids with route tables
+    :return: dictionary with route tables as {key:value}, where key - route table id, value - route table dictionary from VPC API or None if error happened
+    '''
+
+    vpc_routeTables = dict.fromkeys(route_table_ids)
+    executer = get_executor()
+    if route_table_folder_ids and len(route_table_folder_ids) < len(route_table_ids):
+        # list route tables in all folders with a few paginated API requests
+        for folder_routeTables in executer.map(list_folder_route_tables, route_table_folder_ids):
+            if folder_routeTables:
+                for route_table_id in vpc_routeTables:
+                    if route_table_id in folder_routeTables:
+                        vpc_routeTables[route_table_id] = folder_routeTables[route_table_id]
+    # get route tables which were not found in folders one by one
+    missing_route_table_ids = [route_table_id for route_table_id in vpc_routeTables if vpc_routeTables[route_table_id] is None]
+    for route_table_id, vpc_routeTable in zip(missing_route_table_ids, executer.map(get_route_table, missing_route_table_ids)):
+        vpc_routeTables[route_table_id] = vpc_routeTable
+
+    return vpc_routeTables
+
+def get_router_healthcheck_interval(routerStatus, current_time):
+    '''
+    get interval until next check of router status
+    router status is checked with router_healthcheck_fast_interval during router_healthcheck_fast_duration seconds after status of some router was changed
+    or while some router is in intermediate state in NLB or is not reachable by direct probe, otherwise router status is checked with router_healthcheck_interval
+    :param routerStatus: dictionary with healthchecked IP address of routers and its state
+    :param current_time: time of router status check
+    :return: interval in seconds until next check of router status
+    '''
+
+    if poll_state['routerStatus'] is not None and routerStatus != poll_state['routerStatus']:
+        print(f"Router status changed from {poll_state['routerStatus']} to {routerStatus}. Checking router status every {router_healthcheck_fast_interval} seconds during {router_healthcheck_fast_duration} seconds.")
+        poll_state['fast_until'] = current_time + router_healthcheck_fast_duration
+    elif set(routerStatus.values()) & {'INITIAL', 'DRAINING'} or probe_state['suspect']:
+        poll_state['fast_until'] = current_time + router_healthcheck_fast_duration
+    poll_state['routerStatus'] = dict(routerStatus)
+
+    if current_time < poll_state['fast_until']:
+        return router_healthcheck_fast_interval
+    return router_healthcheck_interval
+
+def dampen_router_status(routerStatus, damping, current_time, router_clusters):
+    '''
+    gets routers which routes should not be returned to yet after recovery of router (flap damping and hysteresis of returning routes to primary router)
+    switching of routes from UNHEALTHY router is never delayed, changes of status of routers of other clusters do not delay returning routes to router
+    :param routerStatus: dictionary with healthchecked IP address of routers and its state
+    :param damping: dictionary with damping state of routers from state of route-switcher, updated by function
+    :param current_time: time of router status check
+    :param router_clusters: dictionary with clusters of routers as {key:value}, where key - router healthcheck IP address, value - cluster
+    :return: tuple (set of healthchecked IP addresses of routers which routes should not be returned to, True if damping state was changed)
+    '''
+
+    failback_blocked = set()
+    damping_changed = False
+    for router_hc_address, status in routerStatus.items():
+        router = damping['routers'].get(router_hc_address)
+        if router is None:
+            router = damping['routers'][router_hc_address] = {'status': status, 'penalty': 0, 'update_time': current_time, 'transition_time': 0, 'healthy_checks': 0, 'recovering': False, 'suppressed': False}
+            damping_changed = True
+        if flap_half_life:
+            # penalty decays exponentially
+            router['penalty'] *= 0.5 ** (max(current_time - router['update_time'], 0) / flap_half_life)
+        router['update_time'] = current_time
+        if status != router['status']:
+            router['status'] = status
+            router['healthy_checks'] = 0
+            router['transition_time'] = current_time
+            damping_changed = True
+            if flap_half_life:
+                router['penalty'] = min(router['penalty'] + flap_penalty, flap_max_penalty)
+        if flap_half_life and not router['suppressed'] and router['penalty'] >= flap_suppress_limit:
+            router['suppressed'] = True
+            damping_changed = True
+            print(f"Router {router_hc_address} is flapping. Routes will not be returned to router until it is stable.")
+            record_event('router_flapping', router=router_hc_address, suppressed=True, penalty=round(router['penalty']))
+        elif router['suppressed'] and router['penalty'] < flap_reuse_limit:
+            router['suppressed'] = False
+            damping_changed = True
+            print(f"Router {router_hc_address} is stable again.")
+            record_event('router_flapping', router=router_hc_address, suppressed=False, penalty=round(router['penalty']))
+
+    for router_hc_address, status in routerStatus.items():
+        router = damping['routers'][router_hc_address]
+        if status != 'HEALTHY':
+            if not router['recovering']:
+                router['recovering'] = True
+                damping_changed = True
+            continue
+        router['healthy_checks'] += 1
+        if router['recovering']:
+            # hold down is counted from last change of status of any router of the same cluster
+            cluster = router_clusters.get(router_hc_address)
+            peers = [peer.healthchecked_ip for peer in cluster.routers] if cluster else [router_hc_address]
+            transition_time = max(damping['routers'][peer]['transition_time'] for peer in peers if peer in damping['routers'])
+            if router['suppressed'] or router['healthy_checks'] < failback_min_checks or current_time - transition_time < failback_hold_down:
+                failback_blocked.add(router_hc_address)
+            else:
+                router['recovering'] = False
+                damping_changed = True
+    return failback_blocked, damping_changed
+
+def wait_for_next_check(start_time, last_check_time, healthcheck_interval, function_life_time):
+    '''
+    sleep until next check of router status
+    if direct probes of routers are enabled, routers are probed every router_probe_interval seconds during sleep and next check starts immediately if router failure is detected
+    if next check does not fit in function life time, it is moved to the end of function life time so that time until next launch of function is not wasted
+    :param start_time: start time of function
+    :param last_check_time: start time of last check of router status
+    :param healthcheck_interval: interval in seconds between checks of router status
+    :param function_life_time: function life time in seconds
+    :return: True if next check should be done, False if function life time is over
+    '''
+
+    current_time = time.time()
+    # latest time to start next check so that it completes (if it lasts as long as the last one) within function life time
+    last_check_deadline = start_time + function_life_time - (current_time - last_check_time)
+    next_check_time = min(last_check_time + healthcheck_interval, last_check_deadline)
+    if next_check_time - last_check_time < router_healthcheck_fast_interval:
+        return False
+    while next_check_time > current_time:
+        # sleep is interrupted if route-switcher is stopped
+        if stop_event.wait(min(next_check_time - current_time, router_probe_interval) if router_probe_port else next_check_time - current_time):
+            return False
+        current_time = time.time()
+        if router_probe_port and probe_state['addresses'] and next_check_time > current_time:
+            # router failure detected by direct probes, check router status without waiting for end of interval
+            if update_probe_state(probe_routers(probe_state['addresses'], router_probe_port, router_probe_timeout)):
+                break
+            current_time = time.time()
+    return not stop_event.is_set()
 
 def get_config_route_tables_and_routers():
     '''
@@ -96,283 +1163,1134 @@ def get_config_route_tables_and_routers():
     :return: configuration dictionary from bucket with route tables and load balancer id and list with route table ids and its actual routes in VPC 
     '''
 
-    # get config from bucket 
-    config = get_config()
-    if config is None:
+    # get config model from bucket 
+    model = get_config()
+    if model is None:
         return
-
-    # check whether we have routers in config
-    if 'routers' in config:
-        if config['routers'] is None:        
-            print(f"Routers configuration does not exist. Please add 'routers' input variable for Terraform route-switcher module. Retrying in {cron_interval} minute...")
-            return
-    else:
-        print(f"Routers configuration does not exist. Please add 'routers' input variable for Terraform route-switcher module. Retrying in {cron_interval} minutes...")
-        return
-    
-    # check whether we have route tables in config
-    if 'route_tables' in config:
-        if config['route_tables'] is None:
-            # check whether we have at least one route table in config
-            print(f"There are no route tables in config file in bucket. Please add at least one route table. Retrying in {cron_interval} minutes...")
-            return
-    else:
-        print(f"There are no route tables in config file in bucket. Please add at least one route table. Retrying in {cron_interval} minutes...")
+    if model.config_error is not None:
+        print(model.config_error)
         return
+    config = model.config
     
-    # get routers status from NLB 
-    routerStatus = get_router_status(config)
+    # get routers status from NLBs of clusters
+    routerStatus = get_router_status(model)
     if routerStatus is None:
         # exit from function as some errors happened when checking router status
         return
     
-    nexthops = {}
-    router_error = False
-    security_groups = False
-    vm_id_counter = 0
-    primary_counter = 0
-    routers = {}
-    for router in config['routers']:
-        if 'healthchecked_ip' in router and router['healthchecked_ip']:
-            router_hc_address = router['healthchecked_ip']
-        else:
-            print(f"Router does not have 'healthchecked_ip' configuration. Please add 'healthchecked_ip' value in 'routers' input variable for Terraform route-switcher module.")
-            router_error = True
-            continue
-        if router_hc_address in routerStatus:
-            if 'interfaces' in router and router['interfaces']:
-                router_interfaces = router['interfaces']
-            else:
-                print(f"Router {router_hc_address} does not have 'interfaces' configuration. Please add 'interfaces' list in 'routers' input variable for Terraform route-switcher module.")
-                router_error = True
-                continue
-            
-            for interface in router_interfaces:
-                if ('index' in interface and interface['index'] is not None) or ('security_group_ids' in interface and interface['security_group_ids']):
-                    if ('index' in interface and interface['index'] is not None) and ('security_group_ids' in interface and interface['security_group_ids']):
-                        if 'vm_id' not in router or not router['vm_id']:
-                            print(f"Router {router_hc_address} does not have 'vm_id' configuration and has 'index' and 'security groups' configuration for interfaces. Please add 'vm_id' value in 'routers' input variable for Terraform route-switcher module. Retrying in {cron_interval} minutes...")
-                            router_error = True
-                        else:
-                            security_groups = True
-                    else:
-                        if 'index' in interface and interface['index'] is not None:
-                            print(f"Router {router_hc_address} does not have 'security groups' configuration for interface with {interface['index']} index. Please add 'security_group_ids' value in 'interfaces' input variable for Terraform route-switcher module.")
-                            router_error = True
-                        if 'security_group_ids' in interface and interface['security_group_ids']:
-                            print(f"Router {router_hc_address} does not have 'index' configuration for interface with {interface['security_group_ids']} security groups. Please add 'index' value in 'interfaces' input variable for Terraform route-switcher module.")
-                            router_error = True
-                # prepare dictionary with router nexthops as {key:value}, where key - nexthop address, value - nexthop address of backup router
-                if ('own_ip' in interface and interface['own_ip']) or ('backup_peer_ip' in interface and interface['backup_peer_ip']):
-                    if ('own_ip' in interface and interface['own_ip']) and ('backup_peer_ip' in interface and interface['backup_peer_ip']):
-                        nexthops[interface['own_ip']] = interface['backup_peer_ip']
-                        # prepare dictionary with router healthcheck IP addresses as {key:value}, where key - nexthop address, value - router healthcheck IP address of this nexthop address
-                        routers[interface['own_ip']] = router_hc_address      
-                    else:
-                        if 'backup_peer_ip' in interface and interface['backup_peer_ip']:
-                            print(f"Router {router_hc_address} does not have 'own_ip' configuration for interface. Please add 'own_ip' value in 'interfaces' input variable for Terraform route-switcher module.")
-                            router_error = True
-                        if 'own_ip' in interface and interface['own_ip']:
-                            print(f"Router {router_hc_address} does not have 'backup_peer_ip' configuration for interface. Please add 'backup_peer_ip' value in 'interfaces' input variable for Terraform route-switcher module.")
-                            router_error = True                    
-            if 'vm_id' in router and router['vm_id']:
-                vm_id_counter += 1
-                if not security_groups:
-                    print(f"Router {router_hc_address} has 'vm_id' configuration and does not have 'index' and 'security groups' configuration for interfaces. Please add 'index' and 'security_group_ids' value in 'interfaces' input variable for Terraform route-switcher module or remove 'vm_id' value for router {router_hc_address} configuration.")
-                    router_error = True
-                if 'primary' in router and router['primary']:
-                    primary_counter += 1
-        else:
-            print(f"Router {router_hc_address} is not in target endpoints of load balancer {config['loadBalancerId']}. Please check load balancer configuration or 'routers' input variable for Terraform route-switcher module.")
+    for error in model.router_errors:
+        print(error)
+    router_error = bool(model.router_errors)
+    # routers of clusters which status could not be checked are checked at next launch of function
+    checked_clusters = set(model.router_clusters[router_hc_address] for router_hc_address in routerStatus if router_hc_address in model.router_clusters)
+    for router_hc_address in model.routers_by_ip:
+        cluster = model.router_clusters[router_hc_address]
+        if router_hc_address not in routerStatus and cluster in checked_clusters:
+            print(f"Router {router_hc_address} is not in target endpoints of load balancer {cluster.load_balancer_id}. Please check load balancer configuration or 'routers' input variable for Terraform route-switcher module.")
             router_error = True
+    nexthops = model.nexthops
+    routers = model.nexthop_routers
 
-    if vm_id_counter:
-        if primary_counter != 1:
-            print(f"There should be one router with 'primary = true' configuration. Please add 'primary = true' value to only one router with 'vm_id' value in 'routers' input variable for Terraform route-switcher module. Retrying in {cron_interval} minutes...")
-            router_error = True
-        if vm_id_counter != 2:
-            print(f"There should be two routers with 'vm_id' configuration. Please add 'vm_id' value to only two routers in 'routers' input variable for Terraform route-switcher module. Retrying in {cron_interval} minutes...")
-            router_error = True
+    # get state with primary next hops of routes from bucket
+    state = get_state(config)
+    if state is None:
+        return
+
+    # route tables owned by this shard
+    shard_route_tables = [config_route_table for config_route_table in config['route_tables'] if get_route_table_shard(config_route_table['route_table_id']) == shard_index]
+    if shard_count > 1:
+        print(f"Shard {shard_index} of {shard_count} protects {len(shard_route_tables)} of {len(config['route_tables'])} route tables.")
+    # route tables moved from other shards keep their primary next hops, also after number of shards was reduced
+    import_shard_routes(state, [config_route_table['route_table_id'] for config_route_table in shard_route_tables if config_route_table['route_table_id'] not in state['routes']])
 
     all_routeTables = {}
-    config_changed = False
+    routes_added = False
+    routes_deleted = False
+    route_tables_added = False
     route_table_error = False
-    for config_route_table in config['route_tables']:
-        try:    
-            r = requests.get("https://vpc.api.cloud.yandex.net/vpc/v1/routeTables/%s" % config_route_table['route_table_id'], headers={'Authorization': 'Bearer %s'  % iam_token})
-        except Exception as e:
-            print(f"Request to get route table {config_route_table['route_table_id']} failed due to: {e}. Retrying in {cron_interval} minutes...")
-            route_table_error = True
-            continue
-        
-        if r.status_code != 200:
-            print(f"Unexpected status code {r.status_code} for getting route table {config_route_table['route_table_id']}. More details: {r.json().get('message')}. Retrying in {cron_interval} minutes...")
+    # get route tables from VPC concurrently
+    phase_start = time.time()
+    vpc_routeTables = get_route_tables([config_route_table['route_table_id'] for config_route_table in shard_route_tables], config.get('route_table_folders'))
+    record_phase('route_tables', phase_start)
+    for config_route_table in shard_route_tables:
+        vpc_routeTable = vpc_routeTables.get(config_route_table['route_table_id'])
+        if vpc_routeTable is None:
+            # error happened when getting route table, error is printed in get_route_tables function
             route_table_error = True
             continue
 
-        if 'staticRoutes' in r.json():
-            routeTable = r.json()['staticRoutes']
+        if 'staticRoutes' in vpc_routeTable:
+            routeTable = vpc_routeTable['staticRoutes']
             if not len(routeTable):
                 # check whether we have at least one route configured
                 print(f"There are no routes in route table {config_route_table['route_table_id']}. Please add at least one route.")
                 route_table_error = True
                 continue
 
+            if config_route_table['route_table_id'] not in state['routes']:
+                # route table is stored in state even without routes with next hops of routers, so primary next hops are not imported from states of other shards at next launch of function
+                route_tables_added = True
+            # dictionary with primary next hops of routes in route table as {key:value}, where key - destination prefix, value - primary next hop address
+            primary_routes = state['routes'].setdefault(config_route_table['route_table_id'], {})
             routeTable_prefixes = set()
             for ip_route in routeTable: 
                 # checking if next hop is one of a router addresses
-                if 'nextHopAddress' in ip_route:
-                    if ip_route['nextHopAddress'] in nexthops:
-                        # populate routeTable_prefixes set with route table prefixes
-                        routeTable_prefixes.add(ip_route['destinationPrefix'])
-                    
-                        if 'routes' in config_route_table:
-                            if ip_route['destinationPrefix'] not in config_route_table['routes']:
-                                # insert route in config file stored in bucket
-                                config_route_table['routes'].update({ip_route['destinationPrefix']:ip_route['nextHopAddress']}) 
-                                config_changed = True
-                        else:
-                            # insert route in config file stored in bucket
-                            config_route_table['routes'] = {}
-                            config_route_table['routes'].update({ip_route['destinationPrefix']:ip_route['nextHopAddress']}) 
-                            config_changed = True
+                if 'nextHopAddress' in ip_route and ip_route['nextHopAddress'] in nexthops:
+                    # populate routeTable_prefixes set with route table prefixes
+                    routeTable_prefixes.add(ip_route['destinationPrefix'])
+                    if ip_route['destinationPrefix'] not in primary_routes:
+                        # insert route with its current next hop as primary next hop in state
+                        primary_routes[ip_route['destinationPrefix']] = ip_route['nextHopAddress']
+                        routes_added = True
                 
-            if 'routes' in config_route_table:
-                if len(set(config_route_table['routes'].keys())) != len(routeTable_prefixes):
-                    # if there are some routes left in config file but deleted from actual route table
-                    for prefix in set(config_route_table['routes'].keys()).difference(routeTable_prefixes):
-                        # delete route from config file as it does not exist in actual route table
-                        config_route_table['routes'].pop(prefix)
-                    config_changed = True
-
-            # add route table to all_routeTables dictionary
-            all_routeTables.update({config_route_table['route_table_id']:{'name':r.json()['name'],'staticRoutes':sorted(routeTable, key=lambda i: i['destinationPrefix'])}})
+            for prefix in set(primary_routes).difference(routeTable_prefixes):
+                # delete route from state as it does not exist in actual route table
+                primary_routes.pop(prefix)
+                routes_deleted = True
+
+            # version of route table is used to detect changes of route table in VPC before its update
+            routeTable = sorted(routeTable, key=lambda i: i['destinationPrefix'])
+            all_routeTables.update({config_route_table['route_table_id']:{'name':vpc_routeTable['name'],'staticRoutes':routeTable,'version':get_routes_version(routeTable)}})
         else:
             print(f"There are no routes in route table {config_route_table['route_table_id']}. Please add at least one route.")
             route_table_error = True
             continue
 
-    if config_changed:
-        # if routes were inserted or deleted from config file need to update it in bucket 
-        print(f"Store updated route tables config file in bucket: {config['route_tables']}")
-        put_config(config)
+    for route_table_id in set(state['routes']).difference(config_route_table['route_table_id'] for config_route_table in config['route_tables']):
+        # delete route table from state as it is not protected by route-switcher anymore
+        # route tables of other shards are kept in state, so they keep primary next hops if they are moved back to this shard
+        state['routes'].pop(route_table_id)
+        routes_deleted = True
+    if routes_added:
+        # primary next hops of new routes should be stored before next hops of routes are switched
+        print(f"Store primary next hops of routes in state {state_path} in bucket: {state['routes']}")
+        save_state(urgent=True)
+    elif routes_deleted or route_tables_added:
+        save_state()
+
+    error_message = None
+    if router_error:
+        error_message = f"Some routers have errors in configuration file in bucket (see more details in log). Waiting for correct routers configuration. Retrying in {cron_interval} minutes..."
+    elif route_table_error:
+        error_message = f"Some route tables have errors in configuration file in bucket or during VPC API request (see more details in log). Waiting for correct route tables configuration. Retrying in {cron_interval} minutes..."
+
+    # build route index for routes with next hops of routers
+    route_index = build_route_index(state['routes'], all_routeTables, routers)
+
+    return {'config':config, 'model':model, 'state':state, 'all_routeTables':all_routeTables, 'routers':routers, 'route_index':route_index, 'error_message':error_message}
+
+
+def build_route_index(primary_routes, all_routeTables, routers):
+    '''
+    build route index for routes with next hops of routers to avoid walking all routes in all route tables during each router status check
+    :param primary_routes: dictionary with primary next hops of routes as {key:value}, where key - route table id, value - {destination prefix: primary next hop address}
+    :param all_routeTables: dictionary with route tables and its actual routes in VPC
+    :param routers: dictionary with router next hops as {key:value}, where key - nexthop address, value - router healthcheck IP address of this nexthop address
+    :return: route index dictionary, where route is identified by key (route table id, destination prefix):
+        'routes' - route dictionary from all_routeTables (changed in place when next hop is switched)
+        'primary' - primary next hop address of route from state
+        'nexthop' - {next hop address: set of routes with this next hop address}
+        'router' - {router healthcheck IP address: set of routes with next hop address of this router}
+        'displaced' - {router healthcheck IP address: set of routes with primary next hop address of this router which use next hop address of another router}
+        'plans' - precompiled failover plans (see compile_failover_plans), reset when next hop of some route is changed
+    '''
+
+    route_index = {'routes': {}, 'primary': {}, 'nexthop': {}, 'router': {}, 'displaced': {}, 'plans': None}
+    for route_table_id in all_routeTables:
+        if route_table_id not in primary_routes:
+            continue
+        for ip_route in all_routeTables[route_table_id]['staticRoutes']:
+            if 'nextHopAddress' in ip_route and ip_route['nextHopAddress'] in routers:
+                route_key = (route_table_id, ip_route['destinationPrefix'])
+                route_index['routes'][route_key] = ip_route
+                route_index['primary'][route_key] = primary_routes[route_table_id][ip_route['destinationPrefix']]
+                add_route_to_index(route_index, routers, route_key)
+    return route_index
+
+
+def rebuild_route_index(state, all_routeTables, routers):
+    '''
+    build route index again after routers were changed in config, routes with next hops of new routers are added into state with their current next hop as primary next hop
+    :param state: state with primary next hops of routes
+    :param all_routeTables: dictionary with route tables and its actual routes in VPC
+    :param routers: dictionary with router next hops of changed config and router healthcheck IP addresses
+    :return: route index dictionary
+    '''
+
+    routes_added = False
+    for route_table_id in all_routeTables:
+        primary_routes = state['routes'].setdefault(route_table_id, {})
+        for ip_route in all_routeTables[route_table_id]['staticRoutes']:
+            if 'nextHopAddress' in ip_route and ip_route['nextHopAddress'] in routers and ip_route['destinationPrefix'] not in primary_routes:
+                # insert route with its current next hop as primary next hop in state
+                primary_routes[ip_route['destinationPrefix']] = ip_route['nextHopAddress']
+                routes_added = True
+    if routes_added:
+        # primary next hops of new routes should be stored before next hops of routes are switched
+        print(f"Store primary next hops of routes in state {state_path} in bucket: {state['routes']}")
+        save_state(urgent=True)
+    return build_route_index(state['routes'], all_routeTables, routers)
+
+
+def add_route_to_index(route_index, routers, route_key):
+    '''
+    add route with its current next hop address to route index
+    :param route_index: route index dictionary
+    :param routers: dictionary with router next hops and router healthcheck IP addresses
+    :param route_key: (route table id, destination prefix) of route
+    :return:
+    '''
+
+    nexthop = route_index['routes'][route_key]['nextHopAddress']
+    primary_nexthop = route_index['primary'][route_key]
+    route_index['plans'] = None
+    route_index['nexthop'].setdefault(nexthop, set()).add(route_key)
+    route_index['router'].setdefault(routers[nexthop], set()).add(route_key)
+    if nexthop != primary_nexthop and primary_nexthop in routers:
+        route_index['displaced'].setdefault(routers[primary_nexthop], set()).add(route_key)
+
+
+def update_route_index(route_index, routers, route_key, new_nexthop):
+    '''
+    change next hop address of route and update route index accordingly
+    :param route_index: route index dictionary
+    :param routers: dictionary with router next hops and router healthcheck IP addresses
+    :param route_key: (route table id, destination prefix) of route
+    :param new_nexthop: new next hop address of route
+    :return:
+    '''
+
+    nexthop = route_index['routes'][route_key]['nextHopAddress']
+    primary_nexthop = route_index['primary'][route_key]
+    route_index['nexthop'][nexthop].discard(route_key)
+    route_index['router'][routers[nexthop]].discard(route_key)
+    if primary_nexthop in routers:
+        route_index['displaced'].get(routers[primary_nexthop], set()).discard(route_key)
+    route_index['routes'][route_key].update({'nextHopAddress':new_nexthop})
+    add_route_to_index(route_index, routers, route_key)
+
+
+def remove_route_from_index(route_index, routers, route_key):
+    '''
+    remove route which was deleted from route table in VPC from route index
+    :param route_index: route index dictionary
+    :param routers: dictionary with router next hops and router healthcheck IP addresses
+    :param route_key: (route table id, destination prefix) of route
+    :return:
+    '''
+
+    nexthop = route_index['routes'][route_key]['nextHopAddress']
+    primary_nexthop = route_index['primary'].pop(route_key)
+    route_index['plans'] = None
+    route_index['nexthop'][nexthop].discard(route_key)
+    route_index['router'][routers[nexthop]].discard(route_key)
+    if primary_nexthop in routers:
+        route_index['displaced'].get(routers[primary_nexthop], set()).discard(route_key)
+    route_index['routes'].pop(route_key)
+
+
+def get_route_changes(route_index, routers, healthy_nexthops, unhealthy_nexthops, routerStatus, failback_blocked):
+    '''
+    get routes which require switching of next hop for router status, route index is not changed
+    :param route_index: route index dictionary
+    :param routers: dictionary with router next hops and router healthcheck IP addresses
+    :param healthy_nexthops: dictionary with next hops of HEALTHY routers as {key:value}, where key - nexthop address, value - nexthop address of backup router
+    :param unhealthy_nexthops: dictionary with next hops of not HEALTHY routers as {key:value}, where key - nexthop address, value - nexthop address of backup router
+    :param routerStatus: dictionary with healthchecked IP address of routers and its state
+    :param failback_blocked: set of healthchecked IP addresses of routers which routes are not returned to yet
+    :return: tuple (dictionary with modified route tables as {key:value}, where key - route table id, value - {destination prefix: new next hop address}, list of messages about changes of router status)
+    '''
+
+    router_with_changed_status = ""
+    modified_routeTables = {}
+    messages = list()
+    # get routes which may require switching of next hop from route index instead of walking all routes in all route tables:
+    # routes with next hop of UNHEALTHY routers and (if 'back_to_primary' is 'true') routes with next hop of backup router while primary router is HEALTHY
+    candidate_routes = set()
+    for router_hc_address in routerStatus:
+        if routerStatus[router_hc_address] != 'HEALTHY':
+            candidate_routes.update(route_index['router'].get(router_hc_address, ()))
+        elif back_to_primary == 'true' and router_hc_address not in failback_blocked:
+            candidate_routes.update(route_index['displaced'].get(router_hc_address, ()))
+
+    for route_key in sorted(candidate_routes):
+        ip_route = route_index['routes'][route_key]
+        primary_router = route_index['primary'][route_key]
+        if ip_route['nextHopAddress'] in unhealthy_nexthops:
+            if primary_router in healthy_nexthops and ip_route['nextHopAddress'] != primary_router: 
+                # if primary router became healthy and backup router is still used as next hop, change next hop address to primary router                     
+                if router_with_changed_status != routers[primary_router]:
+                    router_with_changed_status = routers[primary_router]
+                    messages.append(f"Router {router_with_changed_status} became HEALTHY.")
+                modified_routeTables.setdefault(route_key[0], {})[route_key[1]] = primary_router
+            else:
+                # if primary router is not healthy change next hop address to backup router  
+                backup_router = unhealthy_nexthops[ip_route['nextHopAddress']]                                
+                # also check whether backup router address is in healthy next hops
+                if backup_router in healthy_nexthops:
+                    if router_with_changed_status != routers[ip_route['nextHopAddress']]:
+                        router_with_changed_status = routers[ip_route['nextHopAddress']]
+                        messages.append(f"Router {router_with_changed_status} is UNHEALTHY.")
+                    modified_routeTables.setdefault(route_key[0], {})[route_key[1]] = backup_router
+                else:
+                    messages.append(f"Backup next hop {backup_router} is not healthy. Can not switch next hop {ip_route['nextHopAddress']} for route {ip_route['destinationPrefix']} in route table {route_key[0]}. Retrying in {cron_interval} minutes...")
+        elif primary_router in healthy_nexthops and ip_route['nextHopAddress'] != primary_router and routers[primary_router] not in failback_blocked:
+            # route-switcher module has 'back_to_primary' input variable set as 'true' and we back to primary router after its recovery
+            # if primary router became healthy and backup router is still used as next hop, change next hop address to primary router                     
+            if router_with_changed_status != routers[primary_router]:
+                router_with_changed_status = routers[primary_router]
+                messages.append(f"Router {router_with_changed_status} became HEALTHY.")
+            modified_routeTables.setdefault(route_key[0], {})[route_key[1]] = primary_router
+    return modified_routeTables, messages
+
+
+def get_route_table_payload(routes):
+    '''
+    get body of request to update routes of route table in VPC API
+    :param routes: list of static routes
+    :return: JSON body of request
+    '''
+
+    return json.dumps({"updateMask": "staticRoutes", "staticRoutes": routes})
+
+
+def compile_failover_plans(model, route_index, all_routeTables, routers):
+    '''
+    precompile changes of route tables for each expected scenario of router status, so that after change of router status only requests with precompiled bodies are sent
+    scenarios are: one router is not HEALTHY while other routers are HEALTHY, and all routers are HEALTHY (routes are returned to primary routers)
+    plans are compiled for actual next hops of routes and should be compiled again after next hop of any route is changed
+    :param model: compiled config model
+    :param route_index: route index dictionary
+    :param all_routeTables: dictionary with route tables and its actual routes in VPC
+    :param routers: dictionary with router next hops and router healthcheck IP addresses
+    :return: dictionary with 'model' (config model of plans) and 'scenarios' as {key:value}, where key - frozenset of healthchecked IP addresses of not HEALTHY routers,
+        value - dictionary with 'modified_routeTables' ({route table id: {destination prefix: new next hop address}}), 'messages' and 'payloads' ({route table id: body of update request})
+    '''
+
+    scenarios = {}
+    for unhealthy_routers in [frozenset()] + [frozenset([router.healthchecked_ip]) for router in model.routers]:
+        routerStatus = {router.healthchecked_ip: 'UNHEALTHY' if router.healthchecked_ip in unhealthy_routers else 'HEALTHY' for router in model.routers}
+        healthy_nexthops = {}
+        unhealthy_nexthops = {}
+        for router in model.routers:
+            (unhealthy_nexthops if router.healthchecked_ip in unhealthy_routers else healthy_nexthops).update(router.nexthops)
+        modified_routeTables, messages = get_route_changes(route_index, routers, healthy_nexthops, unhealthy_nexthops, routerStatus, set())
+        payloads = {}
+        for route_table_id, modified_routes in modified_routeTables.items():
+            routes = [dict(ip_route, nextHopAddress=modified_routes[ip_route['destinationPrefix']]) if ip_route['destinationPrefix'] in modified_routes else ip_route for ip_route in all_routeTables[route_table_id]['staticRoutes']]
+            payloads[route_table_id] = get_route_table_payload(routes)
+        scenarios[unhealthy_routers] = {'modified_routeTables': modified_routeTables, 'messages': messages, 'payloads': payloads}
+    return {'model': model, 'scenarios': scenarios}
+
+
+def describe_failover_plans(plans, route_index):
+    '''
+    describe failover plans for preview of changes of route tables before failure of routers
+    :param plans: failover plans returned by compile_failover_plans
+    :param route_index: route index dictionary
+    :return: dictionary as {key:value}, where key - scenario ('all_healthy' or 'unhealthy:<healthchecked IP address of router>'),
+        value - {route table id: list of changed routes with destination prefix, current and new next hop address}
+    '''
+
+    description = {}
+    for unhealthy_routers, plan in plans['scenarios'].items():
+        scenario = 'unhealthy:' + ','.join(sorted(unhealthy_routers)) if unhealthy_routers else 'all_healthy'
+        description[scenario] = {route_table_id: [{'destinationPrefix': prefix, 'nextHopAddress': route_index['routes'][(route_table_id, prefix)]['nextHopAddress'], 'newNextHopAddress': nexthop} for prefix, nexthop in sorted(modified_routes.items())] for route_table_id, modified_routes in sorted(plan['modified_routeTables'].items())}
+    return description
+
+
+def get_routes_version(routes):
+    '''
+    get version of route table routes to detect changes of route table in VPC
+    :param routes: list of static routes sorted by destination prefix
+    :return: version of routes
+    '''
+
+    return hash(json.dumps(routes, sort_keys=True))
+
+
+def refresh_route_tables(all_modified_routeTables, all_routeTables, route_index, routers):
+    '''
+    re-read route tables which are about to be updated and merge changes of next hops into actual routes of route tables
+    if route table was not changed in VPC since it was read, routes of route table are updated as is
+    otherwise routes added, deleted or changed in VPC are kept and only modified routes get new next hops
+    :param all_modified_routeTables: list of route tables (dictionary with route table id, route table name, new next hop address, modified routes and list of static routes)
+    :param all_routeTables: dictionary with route tables and its actual routes in VPC, updated with routes of merged route tables
+    :param route_index: route index dictionary, updated with next hops of routes changed in VPC
+    :param routers: dictionary with router next hops and router healthcheck IP addresses
+    :return: list of route tables which should be updated
+    '''
+
+    refreshed_routeTables = list()
+    vpc_routeTables = get_route_tables([route_table['route_table_id'] for route_table in all_modified_routeTables])
+    for route_table in all_modified_routeTables:
+        route_table_id = route_table['route_table_id']
+        vpc_routeTable = vpc_routeTables.get(route_table_id)
+        if vpc_routeTable is None:
+            # route table could not be read, update it with routes which were read before
+            refreshed_routeTables.append(route_table)
+            continue
+        actual_routes = sorted(vpc_routeTable.get('staticRoutes', list()), key=lambda i: i['destinationPrefix'])
+        actual_version = get_routes_version(actual_routes)
+        if actual_version == all_routeTables[route_table_id]['version']:
+            # route table was not changed in VPC
+            all_routeTables[route_table_id]['version'] = get_routes_version(route_table['routes'])
+            refreshed_routeTables.append(route_table)
+            continue
+
+        print(f"Route table {route_table_id} was changed in VPC. Merging changes of next hops into actual routes.")
+        routes = list()
+        actual_prefixes = set()
+        for ip_route in actual_routes:
+            route_key = (route_table_id, ip_route['destinationPrefix'])
+            actual_prefixes.add(ip_route['destinationPrefix'])
+            if route_key in route_index['routes'] and ip_route.get('nextHopAddress') in routers:
+                if ip_route['destinationPrefix'] not in route_table['modified_routes'] and ip_route['nextHopAddress'] != route_index['routes'][route_key]['nextHopAddress']:
+                    # next hop of route was changed in VPC, keep it
+                    update_route_index(route_index, routers, route_key, ip_route['nextHopAddress'])
+                # route from route index has new next hop if it is modified
+                routes.append(route_index['routes'][route_key])
+            else:
+                if route_key in route_index['routes']:
+                    # next hop of route was changed in VPC to address which is not next hop of router, route is not switched by route-switcher anymore
+                    remove_route_from_index(route_index, routers, route_key)
+                # route is not protected by route-switcher or was added in VPC, keep it as is
+                routes.append(ip_route)
+        for route_key in [(route_table_id, ip_route['destinationPrefix']) for ip_route in all_routeTables[route_table_id]['staticRoutes'] if ip_route['destinationPrefix'] not in actual_prefixes]:
+            if route_key in route_index['routes']:
+                # route was deleted from route table in VPC
+                remove_route_from_index(route_index, routers, route_key)
+        all_routeTables[route_table_id]['staticRoutes'] = routes
+        all_routeTables[route_table_id]['version'] = get_routes_version(routes)
+        if all_routeTables[route_table_id]['version'] == actual_version:
+            # modified routes were deleted in VPC or already have new next hops
+            print(f"Route table {route_table_id} does not require update.")
+            # add custom metric 'route_switcher.table_changed' into metric list for Yandex Monitoring that table is not changed
+            metrics.append({"name": "route_switcher.table_changed", "labels": {"route_switcher_name": function_name, "route_table_name": route_table['name'], "folder_name": folder_name}, "type": "IGAUGE", "value": 0})
+            continue
+        refreshed_routeTables.append(dict(route_table, routes=routes, payload=None))
+    return refreshed_routeTables
+
+
+def revert_failed_route_tables(all_routeTables, route_index, routers):
+    '''
+    returns modified routes of route tables which were not updated to their previous next hops in route index, so that changes of these routes are computed again
+    routes which next hops were changed after failed update are not returned, route tables are re-read and merged before their next update as their actual routes in VPC are unknown
+    :param all_routeTables: dictionary with route tables and its actual routes in VPC
+    :param route_index: route index dictionary
+    :param routers: dictionary with router next hops and router healthcheck IP addresses
+    :return:
+    '''
+
+    for route_table in failed_route_tables:
+        route_table_id = route_table['route_table_id']
+        for prefix, nexthop in route_table['modified_routes'].items():
+            route_key = (route_table_id, prefix)
+            previous_nexthop = route_table['previous_routes'].get(prefix)
+            if route_key in route_index['routes'] and route_index['routes'][route_key]['nextHopAddress'] == nexthop and nexthop in routers and previous_nexthop in routers:
+                update_route_index(route_index, routers, route_key, previous_nexthop)
+        if route_table_id in all_routeTables:
+            all_routeTables[route_table_id]['version'] = None
+    failed_route_tables.clear()
+
+
+def get_instance_security_groups(vm_id, healthchecked_ip):
+    '''
+    get security groups of router network interfaces from Compute API
+    :param vm_id: router vm id
+    :param healthchecked_ip: healthchecked IP address of router
+    :return: dictionary with router interface index and current list of security group ids, or None if error happened
+    '''
+
+    network_interfaces_security_group_ids = {}
+    # get security groups for network interfaces from Compute API
+    try:  
+        r = api_request('GET', compute_endpoint, "/compute/v1/instances/%s" % vm_id)
+    except Exception as e:
+        print(f"Request to get security groups for router {healthchecked_ip} network interfaces failed due to: {e}. Retrying in {cron_interval} minutes...")
+        return     
+    if r.status_code != 200:
+        print(f"Unexpected status code {r.status_code} for getting security groups for router {healthchecked_ip} network interfaces. More details: {r.json().get('message')}. Retrying in {cron_interval} minutes...")
+        return 
+    if 'networkInterfaces' in r.json():
+        for interface in r.json()['networkInterfaces']:
+            # prepare dictionary with router network interfaces with security groups as {key:value}, where key - router interface index, value - current list of security group ids
+            network_interfaces_security_group_ids[interface['index']] = interface['securityGroupIds']
+    else:
+        print(f"There are no network interfaces in router {healthchecked_ip}. Please add required network interfaces. Retrying in {cron_interval} minutes...")
+        return
+    return network_interfaces_security_group_ids
+
+def refresh_security_groups(clusters, routerStatus, current_time):
+    '''
+    reads security groups of router network interfaces from Compute API concurrently for primary and backup routers of clusters without cached security groups,
+    after change of status of routers of cluster or if cached security groups are older than security_groups_reconcile_interval
+    :param clusters: list of clusters with primary and backup routers with vm id
+    :param routerStatus: dictionary with healthchecked IP address of routers and its state
+    :param current_time: time of router status check
+    :return:
+    '''
+
+    instances = security_groups_cache['instances']
+    stale_routers = list()
+    for cluster in clusters:
+        # security groups of routers are read again after change of status of routers of the same cluster
+        cluster_status = {router.healthchecked_ip: routerStatus.get(router.healthchecked_ip) for router in (cluster.primary_router, cluster.backup_router)}
+        for router in (cluster.primary_router, cluster.backup_router):
+            instance = instances.get(router.vm_id)
+            if instance is None or instance['router_status'] != cluster_status or current_time - instance['read_time'] >= security_groups_reconcile_interval:
+                stale_routers.append((router, cluster_status))
+    if not stale_routers:
+        return
+    results = get_executor().map(lambda stale_router: get_instance_security_groups(stale_router[0].vm_id, stale_router[0].healthchecked_ip), stale_routers)
+    for (router, cluster_status), network_interfaces_security_group_ids in zip(stale_routers, results):
+        if network_interfaces_security_group_ids is None:
+            instances.pop(router.vm_id, None)
+        else:
+            instances[router.vm_id] = {'security_group_ids': network_interfaces_security_group_ids, 'read_time': current_time, 'router_status': cluster_status}
+
+def update_cached_security_groups(router_network_interface):
+    '''
+    stores applied security groups of router network interface in cache, cached security groups are read again from Compute API at next check to verify the change
+    :param router_network_interface: dictionary with router vm id, network interface index and list of security group ids
+    :return:
+    '''
+
+    instance = security_groups_cache['instances'].get(router_network_interface['vm_id'])
+    if instance:
+        instance['security_group_ids'][str(router_network_interface['index'])] = router_network_interface['security_group_ids']
+        instance['read_time'] = 0
+
+def get_diff_security_groups(vm_id, healthchecked_ip, config_router_interfaces):
+    '''
+    get difference between current list of security group ids for a router (cached by refresh_security_groups) and list of security group ids in configuration file from bucket to compare with 
+    :return: list of router network interfaces with list of security groups which should be applied
+    '''
+
+    all_modified_router_network_interfaces = list()
+    if vm_id not in security_groups_cache['instances']:
+        # security groups were not read from Compute API due to error
+        return
+    network_interfaces_security_group_ids = security_groups_cache['instances'][vm_id]['security_group_ids']
+
+    for config_interface in config_router_interfaces:
+        if config_interface['index'] is not None:
+            # if there is difference between current security groups for routers and list of security groups in configuration file which we need to compare 
+            if (sorted(network_interfaces_security_group_ids[str(config_interface['index'])]) != sorted(config_interface['security_group_ids'])):
+                # last operation id of updating security groups for network interface of router is stored in state
+                last_operation_id = state_cache['state']['operations'].get(vm_id, {}).get(str(config_interface['index'])) if state_cache['state'] else None
+                all_modified_router_network_interfaces.append({'router_hc_address': healthchecked_ip, 'vm_id': vm_id, 'index': config_interface['index'], 'security_group_ids': config_interface['security_group_ids'], 'last_operation_id': last_operation_id})
+    
+    if all_modified_router_network_interfaces:
+        return all_modified_router_network_interfaces           
+
+    
+def get_cluster_network_interfaces(cluster, routerStatus, failback_blocked):
+    '''
+    get network interfaces of primary and backup routers of cluster which security groups should be switched for router status
+    security groups of routers should be read by refresh_security_groups function before
+    :param cluster: cluster of routers with primary and backup routers with 'vm_id' configuration
+    :param routerStatus: dictionary with healthchecked IP address of routers and its state
+    :param failback_blocked: set of healthchecked IP addresses of routers which routes are not returned to yet
+    :return: list of router network interfaces with list of security groups which should be applied
+    '''
+
+    primary_router = cluster.primary_router
+    backup_router = cluster.backup_router
+    primary_router_hc_address = primary_router.healthchecked_ip
+    backup_router_hc_address = backup_router.healthchecked_ip
+    all_modified_router_network_interfaces = list()
+    primary_router_network_interfaces = list()
+    backup_router_network_interfaces = list()
+    # security groups are not returned to recovered primary router while backup router is healthy until failback is allowed
+    primary_router_healthy = routerStatus[primary_router_hc_address] == 'HEALTHY' and (primary_router_hc_address not in failback_blocked or routerStatus[backup_router_hc_address] != 'HEALTHY')
+    if not primary_router_healthy:
+        if routerStatus[backup_router_hc_address] == 'HEALTHY':
+            # if primary router is not healthy and backup router is healthy
+            # prepare list of primary router network interfaces for updating security groups with security groups of backup router from configuration file 
+            primary_router_network_interfaces = get_diff_security_groups(primary_router.vm_id, primary_router_hc_address, backup_router.interfaces)
+            if primary_router_network_interfaces:
+                all_modified_router_network_interfaces.extend(primary_router_network_interfaces)
+            # prepare list of backup router network interfaces for updating security groups with security groups of primary router from configuration file
+            backup_router_network_interfaces = get_diff_security_groups(backup_router.vm_id, backup_router_hc_address, primary_router.interfaces)
+            if backup_router_network_interfaces:
+                all_modified_router_network_interfaces.extend(backup_router_network_interfaces)
+    else:
+        if routerStatus[backup_router_hc_address] == 'HEALTHY':
+            if back_to_primary == 'true':
+                # if primary router is healthy and backup router is healthy and back_to_primary == 'true'
+                # prepare list of primary router network interfaces for updating security groups with security groups of primary router from configuration file 
+                primary_router_network_interfaces = get_diff_security_groups(primary_router.vm_id, primary_router_hc_address, primary_router.interfaces)
+                if primary_router_network_interfaces:
+                    all_modified_router_network_interfaces.extend(primary_router_network_interfaces)
+                # prepare list of backup router network interfaces for updating security groups with security groups of backup router from configuration file
+                backup_router_network_interfaces = get_diff_security_groups(backup_router.vm_id, backup_router_hc_address, backup_router.interfaces)
+                if backup_router_network_interfaces:
+                    all_modified_router_network_interfaces.extend(backup_router_network_interfaces)
+            else:
+                # if primary router is healthy and backup router is healthy and back_to_primary == 'false'
+                # check if backup router has primary security groups currently
+                backup_router_network_interfaces = get_diff_security_groups(backup_router.vm_id, backup_router_hc_address, primary_router.interfaces)
+                if backup_router_network_interfaces:
+                    # backup router does not have primary security groups currently
+                    # prepare list of primary router network interfaces for updating security groups with security groups of primary router from configuration file 
+                    primary_router_network_interfaces = get_diff_security_groups(primary_router.vm_id, primary_router_hc_address, primary_router.interfaces)
+                    if primary_router_network_interfaces:
+                        all_modified_router_network_interfaces.extend(primary_router_network_interfaces)
+                else:
+                    # prepare list of primary router network interfaces for updating security groups with security groups of backup router from configuration file 
+                    primary_router_network_interfaces = get_diff_security_groups(primary_router.vm_id, primary_router_hc_address, backup_router.interfaces)
+                    if primary_router_network_interfaces:
+                        all_modified_router_network_interfaces.extend(primary_router_network_interfaces)
+        else:
+            # if primary router is healthy and backup router is not healthy
+            # prepare list of primary router network interfaces for updating security groups with security groups of primary router from configuration file 
+            primary_router_network_interfaces = get_diff_security_groups(primary_router.vm_id, primary_router_hc_address, primary_router.interfaces)
+            if primary_router_network_interfaces:
+                all_modified_router_network_interfaces.extend(primary_router_network_interfaces)
+            # prepare list of backup router network interfaces for updating security groups with security groups of backup router from configuration file
+            backup_router_network_interfaces = get_diff_security_groups(backup_router.vm_id, backup_router_hc_address, backup_router.interfaces)
+            if backup_router_network_interfaces:
+                all_modified_router_network_interfaces.extend(backup_router_network_interfaces)
+    return all_modified_router_network_interfaces
+
+def get_state(config):
+    '''
+    gets state of route-switcher from bucket, state object is downloaded only if it was changed in bucket (conditional request with ETag of cached state)
+    if state object does not exist, state is created from routes and operation ids stored in config file by previous versions of route-switcher
+    :param config: configuration dictionary from bucket
+    :return: state dictionary with 'routes' (primary next hops of routes), 'operations' (last operation ids of security groups updates), 'router_status' (last router status) and 'damping' (damping state of routers), or None if error happened
+    '''
+
+    try:
+        if state_cache['etag'] is not None:
+            response = get_s3_client().get_object(Bucket=bucket, Key=state_path, IfNoneMatch=state_cache['etag'])
+        else:
+            response = get_s3_client().get_object(Bucket=bucket, Key=state_path)
+        state = json.loads(response['Body'].read())
+    except Exception as e:
+        error_code = get_storage_error_code(e)
+        if error_code in ('304', 'NotModified'):
+            # state object was not changed in bucket, use cached state
+            return state_cache['state']
+        if error_code not in ('NoSuchKey', '404'):
+            print(f"Request to get state {state_path} in bucket {bucket} failed due to: {e}. Retrying in {cron_interval} minutes...")
+            return
+        # state object does not exist, create state from config file
+        state = {'routes': {}, 'operations': {}}
+        for config_route_table in config['route_tables']:
+            if config_route_table.get('routes'):
+                state['routes'][config_route_table['route_table_id']] = dict(config_route_table['routes'])
+        for router in config.get('routers') or list():
+            for interface in router.get('interfaces') or list():
+                if router.get('vm_id') and interface.get('last_operation_id'):
+                    state['operations'].setdefault(router['vm_id'], {})[str(interface['index'])] = interface['last_operation_id']
+        state_cache['dirty'] = True
+        response = {}
+
+    state.setdefault('routes', {})
+    state.setdefault('operations', {})
+    state.setdefault('router_status', None)
+    state.setdefault('damping', {'routers': {}})
+    # previous versions of route-switcher counted hold down from last change of status of any router
+    transition_time = state['damping'].pop('transition_time', 0)
+    for router in state['damping']['routers'].values():
+        router.setdefault('transition_time', transition_time)
+    state_cache['etag'] = response.get('ETag')
+    state_cache['state'] = state
+    if poll_state['routerStatus'] is None and state['router_status']:
+        # router status from previous launch of function is used to detect change of router status at cold start
+        poll_state['routerStatus'] = state['router_status']
+    return state
+
+def get_shard_state_paths():
+    '''
+    gets paths of states of all shards in bucket, including states of shards which were removed after number of shards was reduced
+    :return: dictionary as {key:value}, where key - shard index, value - path of state of shard in bucket
+    '''
+
+    shard_state_paths = {}
+    continuation_token = None
+    while True:
+        list_arguments = {'Bucket': bucket, 'Prefix': 'route-switcher-state'}
+        if continuation_token:
+            list_arguments['ContinuationToken'] = continuation_token
+        response = get_s3_client().list_objects_v2(**list_arguments)
+        for state_object in response.get('Contents', []):
+            match = re.fullmatch(r'route-switcher-state(?:-shard-(\d+))?\.json', state_object['Key'])
+            if match:
+                shard_state_paths[int(match.group(1) or 0)] = state_object['Key']
+        if not response.get('IsTruncated'):
+            break
+        continuation_token = response['NextContinuationToken']
+    return shard_state_paths
 
-    error_message = None
-    if router_error:
-        error_message = f"Some routers have errors in configuration file in bucket (see more details in log). Waiting for correct routers configuration. Retrying in {cron_interval} minutes..."
-    elif route_table_error:
-        error_message = f"Some route tables have errors in configuration file in bucket or during VPC API request (see more details in log). Waiting for correct route tables configuration. Retrying in {cron_interval} minutes..."
+def import_shard_routes(state, route_table_ids):
+    '''
+    imports primary next hops of routes from states of other shards for route tables which were moved to this shard after change of number of shards
+    states of shards are found in bucket, so route tables of removed shards are imported after number of shards was reduced
+    :param state: state dictionary of this shard
+    :param route_table_ids: list of route table ids without primary next hops in state
+    :return:
+    '''
+
+    if not route_table_ids:
+        return
+    try:
+        shard_state_paths = get_shard_state_paths()
+    except Exception as e:
+        print(f"Request to list states of shards in bucket {bucket} failed due to: {e}.")
+        return
+    for shard in sorted(shard_state_paths):
+        if shard == shard_index:
+            continue
+        try:
+            response = get_s3_client().get_object(Bucket=bucket, Key=shard_state_paths[shard])
+            shard_routes = json.loads(response['Body'].read()).get('routes', {})
+        except Exception as e:
+            if get_storage_error_code(e) not in ('NoSuchKey', '404'):
+                print(f"Request to get state of shard {shard} in bucket {bucket} failed due to: {e}.")
+            continue
+        for route_table_id in route_table_ids:
+            if route_table_id not in state['routes'] and shard_routes.get(route_table_id):
+                print(f"Route table {route_table_id} was moved from shard {shard} to shard {shard_index}.")
+                state['routes'][route_table_id] = shard_routes[route_table_id]
+                state_cache['dirty'] = True
 
-    return {'config':config, 'all_routeTables':all_routeTables, 'routers':routers, 'error_message':error_message}
+def save_state(urgent=False):
+    '''
+    writes changed state to bucket from memory
+    changes which do not affect failover are written at most once per state_write_interval seconds, the rest of changes are written by flush_state function
+    :param urgent: write state immediately, e.g. primary next hops of new routes or operation ids of security groups updates
+    :return:
+    '''
 
+    state_cache['dirty'] = True
+    if urgent or time.time() - state_cache['write_time'] >= state_write_interval:
+        flush_state()
 
-def get_diff_security_groups(vm_id, healthchecked_ip, config_router_interfaces):
+def flush_state():
     '''
-    get difference between current list of security group ids for a router and list of security group ids in configuration file from bucket to compare with 
-    :return: list of router network interfaces with list of security groups which should be applied
+    writes state to bucket if it was changed
+    :return:
     '''
 
-    network_interfaces_security_group_ids = {}
-    all_modified_router_network_interfaces = list()
-    # get security groups for network interfaces from Compute API
-    try:  
-        r = requests.get("https://compute.api.cloud.yandex.net/compute/v1/instances/%s" % vm_id, headers={'Authorization': 'Bearer %s'  % iam_token})
+    if not state_cache['dirty'] or state_cache['state'] is None or dry_run:
+        return
+    try:
+        response = get_s3_client().put_object(Bucket=bucket, Key=state_path, Body=json.dumps(state_cache['state'], separators=(',', ':')).encode(), ContentType='application/json')
     except Exception as e:
-        print(f"Request to get security groups for router {healthchecked_ip} network interfaces failed due to: {e}. Retrying in {cron_interval} minutes...")
-        return     
-    if r.status_code != 200:
-        print(f"Unexpected status code {r.status_code} for getting security groups for router {healthchecked_ip} network interfaces. More details: {r.json().get('message')}. Retrying in {cron_interval} minutes...")
-        return 
-    if 'networkInterfaces' in r.json():
-        for interface in r.json()['networkInterfaces']:
-            # prepare dictionary with router network interfaces with security groups as {key:value}, where key - router interface index, value - current list of security group ids
-            network_interfaces_security_group_ids[interface['index']] = interface['securityGroupIds']
-    else:
-        print(f"There are no network interfaces in router {healthchecked_ip}. Please add required network interfaces. Retrying in {cron_interval} minutes...")
+        print(f"Request to write state {state_path} in bucket {bucket} failed due to: {e}. Retrying in {cron_interval} minutes...")
         return
-    
-    for config_interface in config_router_interfaces:
-        if config_interface['index'] is not None:
-            # if there is difference between current security groups for routers and list of security groups in configuration file which we need to compare 
-            if (sorted(network_interfaces_security_group_ids[str(config_interface['index'])]) != sorted(config_interface['security_group_ids'])):
-                if 'last_operation_id' in config_interface and config_interface['last_operation_id']:
-                    all_modified_router_network_interfaces.append({'router_hc_address': healthchecked_ip, 'vm_id': vm_id, 'index': config_interface['index'], 'security_group_ids': config_interface['security_group_ids'], 'last_operation_id': config_interface['last_operation_id']})
-                else:
-                    all_modified_router_network_interfaces.append({'router_hc_address': healthchecked_ip, 'vm_id': vm_id, 'index': config_interface['index'], 'security_group_ids': config_interface['security_group_ids'], 'last_operation_id': None})
-    
-    if all_modified_router_network_interfaces:
-        return all_modified_router_network_interfaces           
+    # ETag of written state object is used for conditional request of state at next launch of function
+    state_cache['etag'] = response.get('ETag')
+    state_cache['dirty'] = False
+    state_cache['write_time'] = time.time()
 
-    
-def put_config(config, endpoint_url='https://storage.yandexcloud.net'):
+def get_journal_hour_prefix(event_time):
+    '''
+    gets prefix of journal segments with first event in hour of event time
+    :param event_time: time of event
+    :return: prefix of objects in bucket, e.g. 'route-switcher-journal/2024-01-01/12/'
     '''
-    uploads config file to the bucket
-    :param config: configuration dictionary with route tables and load balancer id
-    :param endpoint_url: url of the config
+
+    return '%s/%s/' % (journal_prefix, datetime.datetime.fromtimestamp(event_time, datetime.timezone.utc).strftime('%Y-%m-%d/%H'))
+
+def record_event(event_type, **details):
+    '''
+    adds event into journal, events are written into bucket by flush_journal function
+    :param event_type: type of event, e.g. 'router_status' or 'route_table_update'
+    :param details: details of event
     :return:
     '''
-    session = boto3.session.Session()
-    s3_client = session.client(
-        service_name='s3',
-        endpoint_url=endpoint_url
-    )
 
-    with open('/tmp/config.yaml', 'w') as outfile:
-        yaml.dump(config, outfile, default_flow_style=False)
+    event = dict(details, time=round(time.time(), 3), type=event_type, shard=shard_index)
+    with journal_lock:
+        journal_events.append(event)
+        if len(journal_events) > journal_max_events:
+            del journal_events[:len(journal_events) - journal_max_events]
+
+def flush_journal(urgent=False):
+    '''
+    writes events from memory into bucket as new journal segment, segment is written with 'If-None-Match: *' condition and is never changed
+    events are written at most once per journal_flush_interval seconds, if writing fails events are kept in memory and written with next segment
+    :param urgent: write events immediately, e.g. after failover or before function exit
+    :return:
+    '''
 
+    if dry_run:
+        return
+    with journal_lock:
+        if not journal_events or (not urgent and time.time() - journal_state['flush_time'] < journal_flush_interval):
+            return
+        events = list(journal_events)
+        journal_events.clear()
+    journal_state['flush_time'] = time.time()
+    first_time = min(event['time'] for event in events)
+    last_time = max(event['time'] for event in events)
+    segment_path = get_journal_hour_prefix(first_time) + '%013d-%013d-%d-%s.jsonl' % (first_time * 1000, last_time * 1000, shard_index, uuid.uuid4().hex[:8])
     try:
-        s3_client.upload_file('/tmp/config.yaml', bucket, path)
+        get_s3_client().put_object(Bucket=bucket, Key=segment_path, Body=''.join(json.dumps(event, separators=(',', ':')) + '\n' for event in events).encode(), ContentType='application/x-ndjson', IfNoneMatch='*')
     except Exception as e:
-        print(f"Request to write config file in {bucket} bucket failed due to: {e}. Retrying in {cron_interval} minutes...")
+        print(f"Request to write journal segment {segment_path} in bucket {bucket} failed due to: {e}. Retrying in {journal_flush_interval} seconds...")
+        with journal_lock:
+            journal_events[:0] = events
+            if len(journal_events) > journal_max_events:
+                del journal_events[:len(journal_events) - journal_max_events]
 
 def write_metrics(metrics):
     '''
-    write custom metrics in Yandex Monitoring
+    put custom metrics into queue for writing in Yandex Monitoring by background thread
+    metrics with values which were not changed since last writing are skipped during metrics_resend_interval
     :param metrics: list of metrics to write
     :return:
     '''
+
+    if dry_run:
+        return
+    current_time = time.time()
+    ts = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    changed_metrics = list()
+    with metrics_last_values_lock:
+        for metric in metrics:
+            last_value = metrics_last_values.get(get_metric_key(metric))
+            if last_value is not None and last_value[0] == metric['value'] and current_time - last_value[1] < metrics_resend_interval:
+                continue
+            metric.setdefault('ts', ts)
+            changed_metrics.append(metric)
+    if not changed_metrics:
+        return
+
+    start_metrics_writer()
     try:
-        r = requests.post('https://monitoring.api.cloud.yandex.net/monitoring/v2/data/write?folderId=%s&service=custom' % folder_id,  json={"metrics": metrics}, headers={'Authorization': 'Bearer %s'  % iam_token})
-    except Exception as e:
-        print(f"Request to write metrics failed due to: {e}. Retrying in {cron_interval} minutes...")
+        metrics_queue.put_nowait((folder_id, changed_metrics))
+    except queue.Full:
+        print(f"Queue of metrics is full. {len(changed_metrics)} metrics are not written.")
 
-    if r.status_code != 200:
-        print(f"Unexpected status code {r.status_code} for writing metrics. Retrying in {cron_interval} minutes...")
-    if 'errorMessage' in r.json():
-        print(f"Error of writing metrics. More details: {r.json()['errorMessage']}. Retrying in {cron_interval} minutes...")
+def get_metric_key(metric):
+    '''
+    gets key of metric in metrics_last_values
+    :param metric: metric dictionary
+    :return: tuple (metric name, sorted labels)
+    '''
+
+    return (metric['name'], tuple(sorted(metric['labels'].items())))
+
+def post_metrics(metrics_folder_id, metrics):
+    '''
+    write custom metrics in Yandex Monitoring, request is retried with exponential backoff if it failed
+    :param metrics_folder_id: folder id for metrics
+    :param metrics: list of metrics to write
+    :return: True if metrics were written, otherwise False
+    '''
+
+    for attempt in range(1, metrics_write_attempts + 1):
+        try:
+            r = api_request('POST', monitoring_endpoint, '/monitoring/v2/data/write?folderId=%s&service=custom' % metrics_folder_id, attempts=1, json={"metrics": metrics})
+        except Exception as e:
+            print(f"Request to write metrics failed due to: {e}.")
+        else:
+            if r.status_code == 200:
+                if 'errorMessage' in r.json():
+                    print(f"Error of writing metrics. More details: {r.json()['errorMessage']}.")
+                return True
+            print(f"Unexpected status code {r.status_code} for writing metrics.")
+            if r.status_code != 429 and r.status_code < 500:
+                # request will fail again, do not retry
+                return False
+        if attempt < metrics_write_attempts:
+            time.sleep(0.5 * 2 ** (attempt - 1))
+    return False
+
+def metrics_writer_loop():
+    '''
+    background thread which writes metrics from queue in Yandex Monitoring, all batches of metrics waiting in queue are written by one request
+    :return:
+    '''
+
+    while True:
+        batches = [metrics_queue.get()]
+        while True:
+            try:
+                batches.append(metrics_queue.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            # group metrics by folder id
+            folder_metrics = {}
+            for metrics_folder_id, metrics in batches:
+                folder_metrics.setdefault(metrics_folder_id, list()).extend(metrics)
+            for metrics_folder_id, metrics in folder_metrics.items():
+                if not post_metrics(metrics_folder_id, metrics):
+                    print(f"{len(metrics)} metrics are not written. Retrying in {cron_interval} minutes...")
+                    continue
+                # values are stored only for written metrics, so metrics which were not written are sent again even if their values are not changed
+                write_time = time.time()
+                with metrics_last_values_lock:
+                    for metric in metrics:
+                        metrics_last_values[get_metric_key(metric)] = (metric['value'], write_time)
+        finally:
+            for _ in batches:
+                metrics_queue.task_done()
+
+def start_metrics_writer():
+    '''
+    start background thread for writing metrics if it is not started yet
+    :return:
+    '''
+
+    global metrics_writer
+    if metrics_writer is None or not metrics_writer.is_alive():
+        metrics_writer = threading.Thread(target=metrics_writer_loop, name='metrics-writer', daemon=True)
+        metrics_writer.start()
+
+def flush_metrics(timeout=metrics_flush_timeout):
+    '''
+    wait until all metrics from queue are written in Yandex Monitoring
+    :param timeout: max time in seconds to wait
+    :return:
+    '''
+
+    deadline = time.time() + timeout
+    with metrics_queue.all_tasks_done:
+        while metrics_queue.unfinished_tasks:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                print(f"Timeout of writing metrics. {metrics_queue.unfinished_tasks} batches of metrics are not written.")
+                return
+            metrics_queue.all_tasks_done.wait(remaining)
 
 
 def failover(route_table):
     '''
     changes next hop in route table by using REST API request to VPC API
     :param route_table: route table is dictionary with route table id, new next hop address and list of static routes
-    :return:
+    :return: dictionary with route table id, route table name, operation id and start time of operation, or None if error happened
     '''
 
     print(f"Updating route table {route_table['route_table_id']} with next hop address {route_table['next_hop']}. New route table: {route_table['routes']}")
+    operation_start_time = time.time()
     try:
-        r = requests.patch('https://vpc.api.cloud.yandex.net/vpc/v1/routeTables/%s' % route_table['route_table_id'], json={"updateMask": "staticRoutes", "staticRoutes": route_table['routes'] } ,headers={'Authorization': 'Bearer %s'  % iam_token})
+        # body of request is precompiled in failover plan or prepared from routes
+        r = api_request('PATCH', vpc_endpoint, '/vpc/v1/routeTables/%s' % route_table['route_table_id'], data=route_table.get('payload') or get_route_table_payload(route_table['routes']), headers={'Content-Type': 'application/json'})
+        record_phase('route_table_update', operation_start_time, route_table_name=route_table['name'])
     except Exception as e:
-        print(f"Request to update route table {route_table['route_table_id']} failed due to: {e}. Retrying in {cron_interval} minutes...")
+        print(f"Request to update route table {route_table['route_table_id']} failed due to: {e}.")
+        record_event('route_table_update', route_table_id=route_table['route_table_id'], next_hop=route_table['next_hop'], error=str(e))
         # add custom metric 'route_switcher.table_changed' into metric list for Yandex Monitoring that error happened during table change
-        metrics.append({"name": "route_switcher.table_changed", "labels": {"route_switcher_name": function_name, "route_table_name": route_table['name'], "folder_name": folder_name}, "type": "IGAUGE", "value": 2, "ts": str(datetime.datetime.now(datetime.timezone.utc).isoformat())})
+        metrics.append({"name": "route_switcher.table_changed", "labels": {"route_switcher_name": function_name, "route_table_name": route_table['name'], "folder_name": folder_name}, "type": "IGAUGE", "value": 2})
         return
 
     if r.status_code != 200:
-        print(f"Unexpected status code {r.status_code} for updating route table {route_table['route_table_id']}. More details: {r.json().get('message')}. Retrying in {cron_interval} minutes...")
+        print(f"Unexpected status code {r.status_code} for updating route table {route_table['route_table_id']}. More details: {r.json().get('message')}.")
+        record_event('route_table_update', route_table_id=route_table['route_table_id'], next_hop=route_table['next_hop'], error=f"status code {r.status_code}")
         # add custom metric 'route_switcher.table_changed' into metric list for Yandex Monitoring that error happened during table change
-        metrics.append({"name": "route_switcher.table_changed", "labels": {"route_switcher_name": function_name, "route_table_name": route_table['name'], "folder_name": folder_name}, "type": "IGAUGE", "value": 2, "ts": str(datetime.datetime.now(datetime.timezone.utc).isoformat())})
+        metrics.append({"name": "route_switcher.table_changed", "labels": {"route_switcher_name": function_name, "route_table_name": route_table['name'], "folder_name": folder_name}, "type": "IGAUGE", "value": 2})
         return
 
     if 'id' in r.json():
         operation_id = r.json()['id']
         print(f"Operation {operation_id} for updating route table {route_table['route_table_id']}. More details: {r.json()}")
+        record_event('route_table_update', route_table_id=route_table['route_table_id'], next_hop=route_table['next_hop'], operation_id=operation_id, request_ms=round((time.time() - operation_start_time) * 1000, 1))
         # add custom metric 'route_switcher.table_changed' into metric list for Yandex Monitoring about table change
-        metrics.append({"name": "route_switcher.table_changed", "labels": {"route_switcher_name": function_name, "route_table_name": route_table['name'], "folder_name": folder_name}, "type": "IGAUGE", "value": 1, "ts": str(datetime.datetime.now(datetime.timezone.utc).isoformat())})
+        metrics.append({"name": "route_switcher.table_changed", "labels": {"route_switcher_name": function_name, "route_table_name": route_table['name'], "folder_name": folder_name}, "type": "IGAUGE", "value": 1})
+        return {'route_table_id': route_table['route_table_id'], 'name': route_table['name'], 'operation_id': operation_id, 'start_time': operation_start_time}
     else:
-        print(f"Failed to start operation for updating route table {route_table['route_table_id']}. Retrying in {cron_interval} minutes...")
+        print(f"Failed to start operation for updating route table {route_table['route_table_id']}.")
+        record_event('route_table_update', route_table_id=route_table['route_table_id'], next_hop=route_table['next_hop'], error='operation was not started')
         # add custom metric 'route_switcher.table_changed' into metric list for Yandex Monitoring that error happened during table change
-        metrics.append({"name": "route_switcher.table_changed", "labels": {"route_switcher_name": function_name, "route_table_name": route_table['name'], "folder_name": folder_name}, "type": "IGAUGE", "value": 2, "ts": str(datetime.datetime.now(datetime.timezone.utc).isoformat())})
+        metrics.append({"name": "route_switcher.table_changed", "labels": {"route_switcher_name": function_name, "route_table_name": route_table['name'], "folder_name": folder_name}, "type": "IGAUGE", "value": 2})
+
+
+def get_operation(operation_id):
+    '''
+    get operation status by using REST API request to Operation API
+    :param operation_id: operation id
+    :return: operation dictionary from Operation API or None if error happened
+    '''
+
+    try:
+        r = api_request('GET', operation_endpoint, "/operations/%s" % operation_id)
+    except Exception as e:
+        print(f"Request to get operation {operation_id} failed due to: {e}.")
+        return
+
+    if r.status_code != 200:
+        print(f"Unexpected status code {r.status_code} for getting operation {operation_id}. More details: {r.json().get('message')}.")
+        return
+
+    return r.json()
+
+
+def track_operation(operation_id, done):
+    '''
+    stores status of operation in operation tracker
+    :param operation_id: operation id
+    :param done: True if operation is completed
+    :return:
+    '''
+
+    operation_tracker.pop(operation_id, None)
+    operation_tracker[operation_id] = done
+    while len(operation_tracker) > operation_tracker_size:
+        # remove oldest operation
+        del operation_tracker[next(iter(operation_tracker))]
+
+def poll_operations(operation_ids):
+    '''
+    get status of operations concurrently, operations which are known to be completed from previous requests are not requested again
+    :param operation_ids: list of operation ids
+    :return: dictionary with operation id and operation dictionary from Operation API ({'done': True} for operations completed earlier) or None if error happened
+    '''
+
+    pending_operation_ids = [operation_id for operation_id in dict.fromkeys(operation_ids) if not operation_tracker.get(operation_id)]
+    responses = dict(zip(pending_operation_ids, get_executor().map(get_operation, pending_operation_ids)))
+    for operation_id, response in responses.items():
+        if response is not None:
+            track_operation(operation_id, bool(response.get('done')))
+    return {operation_id: responses[operation_id] if operation_id in responses else {'done': True} for operation_id in operation_ids}
+
+def get_operations_deadline():
+    '''
+    gets time until completion of update operations is waited, it is limited by operation_timeout and by remaining time of function execution,
+    so that state and journal are written and lease is released before function execution is stopped
+    :return: time until completion of update operations is waited
+    '''
+
+    return min(time.time() + operation_timeout, execution_deadline - execution_exit_time)
+
+
+def start_route_table_updates(updates):
+    '''
+    starts update operations of route tables concurrently
+    requests which failed are not sent again as they are already retried by api_request function, route tables which operations failed are updated again by check_route_table_updates function,
+    routes of route tables which were not updated are switched again after next check of router status (see revert_failed_route_tables)
+    :param updates: list of route table updates (see route_table_updates)
+    :return: list of route table updates with started operations
+    '''
+
+    for update in updates:
+        update['attempt'] += 1
+    operations = list()
+    # execute failover function in thread pool concurrently for each modified route table (number of parallel requests is limited for each API)
+    try:
+        operations = list(get_executor().map(failover, [update['route_table'] for update in updates]))
+    except Exception as e:
+        print(f"Request to execute failover function failed due to: {e}.")
+    started_updates = list()
+    for update, operation in zip(updates, operations + [None] * (len(updates) - len(operations))):
+        if operation is not None:
+            update['operation'] = operation
+            started_updates.append(update)
+        else:
+            finish_route_table_update(update, False)
+    return started_updates
+
+
+def finish_route_table_update(update, updated, superseded=False):
+    '''
+    finishes update of route table, when updates of all route tables of failover are finished, completion of failover is recorded
+    failover which route table updates were all replaced by newer updates is not recorded, latency of failover is recorded only if all its route table updates are completed
+    :param update: route table update (see route_table_updates)
+    :param updated: True if route table was updated
+    :param superseded: True if update was replaced by newer update of route table before completion of its operation
+    :return:
+    '''
+
+    failover_state = update['failover']
+    failover_state['pending'] -= 1
+    if superseded:
+        failover_state['superseded_route_tables'].append(update['route_table']['route_table_id'])
+    elif not updated:
+        print(f"Failed to update route table {update['route_table']['route_table_id']}. Retrying after next check of router status...")
+        failover_state['failed_route_tables'].append(update['route_table']['route_table_id'])
+        failed_route_tables.append(update['route_table'])
+    if failover_state['pending']:
+        return
+    if len(failover_state['superseded_route_tables']) == failover_state['route_tables']:
+        # all route tables are updated by newer failover
+        return
+    latency = time.time() - failover_state['status_time']
+    record_event('failover_completed', route_tables=failover_state['route_tables'], failed_route_tables=failover_state['failed_route_tables'], superseded_route_tables=failover_state['superseded_route_tables'], latency_ms=round(latency * 1000, 1))
+    if not failover_state['failed_route_tables'] and not failover_state['superseded_route_tables']:
+        # all route tables were updated, record time from detection of router status change until completion of all route table updates
+        record_timing('route_switcher.failover_latency_ms', {}, latency * 1000)
+    # events of failover are written immediately
+    flush_journal(urgent=True)
+
+
+def check_route_table_updates(wait_deadline):
+    '''
+    checks completion of route table update operations, status of all pending operations is requested concurrently with exponential backoff until wait_deadline
+    route tables which operations failed are updated once again up to route_table_update_attempts times, operations which are not completed until their deadline are not waited anymore
+    operations which are still in progress at wait_deadline are kept in route_table_updates and checked again after next check of router status
+    :param wait_deadline: time until completion of operations is waited, e.g. time of next check of router status
+    :return:
+    '''
+
+    poll_interval = operation_poll_interval
+    while route_table_updates:
+        operation_statuses = poll_operations([update['operation']['operation_id'] for update in route_table_updates])
+        pending_updates = list()
+        retry_updates = list()
+        for update in route_table_updates:
+            operation = update['operation']
+            response = operation_statuses[operation['operation_id']]
+            if response is None or not response.get('done'):
+                if time.time() < update['deadline']:
+                    pending_updates.append(update)
+                else:
+                    print(f"Operation {operation['operation_id']} for updating route table {operation['route_table_id']} is not completed in {time.time() - operation['start_time']:.1f} seconds.")
+                    finish_route_table_update(update, False)
+                continue
+            latency = time.time() - operation['start_time']
+            error = response.get('error')
+            record_timing('route_switcher.operation_latency_ms', {'route_table_name': operation['name']}, latency * 1000)
+            record_event('route_table_operation', route_table_id=operation['route_table_id'], operation_id=operation['operation_id'], latency_ms=round(latency * 1000, 1), error=error)
+            if not error:
+                print(f"Operation {operation['operation_id']} for updating route table {operation['route_table_id']} completed in {latency:.1f} seconds.")
+                finish_route_table_update(update, True)
+                continue
+            print(f"Operation {operation['operation_id']} for updating route table {operation['route_table_id']} failed in {latency:.1f} seconds. More details: {error}")
+            # add custom metric 'route_switcher.table_changed' into metric list for Yandex Monitoring that error happened during table change
+            metrics.append({"name": "route_switcher.table_changed", "labels": {"route_switcher_name": function_name, "route_table_name": operation['name'], "folder_name": folder_name}, "type": "IGAUGE", "value": 2})
+            if update['attempt'] < route_table_update_attempts and time.time() < update['deadline']:
+                retry_updates.append(update)
+            else:
+                finish_route_table_update(update, False)
+        if retry_updates:
+            print(f"Failed to update route tables {[update['route_table']['route_table_id'] for update in retry_updates]}. Retrying...")
+            pending_updates.extend(start_route_table_updates(retry_updates))
+        route_table_updates[:] = pending_updates
+        if not route_table_updates or time.time() >= wait_deadline:
+            break
+        time.sleep(min(poll_interval, max(wait_deadline - time.time(), 0)))
+        poll_interval = min(poll_interval * 2, operation_poll_max_interval)
+
+
+def update_route_tables(all_modified_routeTables, status_time, wait_deadline, deadline):
+    '''
+    starts update of route tables concurrently and waits for completion of update operations until wait_deadline
+    operations which are not completed until wait_deadline are checked by check_route_table_updates function after next checks of router status
+    :param all_modified_routeTables: list of route tables (dictionary with route table id, route table name, new next hop address, priority and list of static routes)
+    :param status_time: time of router status check which detected change of router status
+    :param wait_deadline: time until completion of operations is waited, e.g. time of next check of router status
+    :param deadline: time until route tables are updated and completion of operations is waited
+    :return:
+    '''
+
+    updated_route_table_ids = set(route_table['route_table_id'] for route_table in all_modified_routeTables)
+    for update in [update for update in route_table_updates if update['route_table']['route_table_id'] in updated_route_table_ids]:
+        # new update of route table replaces its previous update which is not completed yet, previous operation is not waited anymore
+        route_table_updates.remove(update)
+        finish_route_table_update(update, False, superseded=True)
+    failover_state = {'status_time': status_time, 'route_tables': len(all_modified_routeTables), 'pending': len(all_modified_routeTables), 'failed_route_tables': list(), 'superseded_route_tables': list()}
+    # route tables with higher priority are updated first
+    updates = [{'route_table': route_table, 'attempt': 0, 'deadline': deadline, 'operation': None, 'failover': failover_state} for route_table in sorted(all_modified_routeTables, key=lambda route_table: -route_table.get('priority', 0))]
+    route_table_updates.extend(start_route_table_updates(updates))
+    # operations are not completed immediately after their start
+    time.sleep(min(operation_poll_interval, max(wait_deadline - time.time(), 0)))
+    check_route_table_updates(wait_deadline)
 
 
 def network_interface_update(router_network_interface):
@@ -382,317 +2300,477 @@ def network_interface_update(router_network_interface):
     :return: operation id for updateNetworkInterface API request
     '''
 
-    if router_network_interface['last_operation_id']:
-        # get last operations updateNetworkInterface for vm id from Compute API
-        try:
-            r = requests.get("https://operation.api.cloud.yandex.net/operations/%s" % router_network_interface['last_operation_id'], headers={'Authorization': 'Bearer %s'  % iam_token})
-        except Exception as e:
-            print(f"Request to get operation {router_network_interface['last_operation_id']} for router {router_network_interface['router_hc_address']} failed due to: {e}.")    
-        if r.status_code != 200:
-            print(f"Unexpected status code {r.status_code} for getting operation {router_network_interface['last_operation_id']} for router {router_network_interface['router_hc_address']}. More details: {r.json().get('message')}.")
-        if 'done' in r.json() and not r.json()['done']:
-            # if last operation for updating this interface is still in progress (done = false) exit from function and do not try to update network interface
-            print(f"Operation id {router_network_interface['last_operation_id']} is still in progress for updating router {router_network_interface['router_hc_address']} network interface index {router_network_interface['index']}.")
-            return {}
-           
     print(f"Updating router {router_network_interface['router_hc_address']} network interface index {router_network_interface['index']} with security groups: {router_network_interface['security_group_ids']}")
     try:
-        r = requests.patch('https://compute.api.cloud.yandex.net/compute/v1/instances/%s/updateNetworkInterface' % router_network_interface['vm_id'], json={"networkInterfaceIndex": str(router_network_interface['index']), "updateMask": "securityGroupIds", "securityGroupIds": router_network_interface['security_group_ids']} ,headers={'Authorization': 'Bearer %s'  % iam_token})
+        r = api_request('PATCH', compute_endpoint, '/compute/v1/instances/%s/updateNetworkInterface' % router_network_interface['vm_id'], json={"networkInterfaceIndex": str(router_network_interface['index']), "updateMask": "securityGroupIds", "securityGroupIds": router_network_interface['security_group_ids']})
     except Exception as e:
         print(f"Request to update router {router_network_interface['router_hc_address']} network interface index {router_network_interface['index']} failed due to: {e}. Retrying in {cron_interval} minutes...")
+        record_event('network_interface_update', router=router_network_interface['router_hc_address'], vm_id=router_network_interface['vm_id'], index=router_network_interface['index'], security_group_ids=router_network_interface['security_group_ids'], error=str(e))
         # add custom metric 'route_switcher.security_groups_changed' into metric list for Yandex Monitoring that error happened during security groups change for router
-        metrics.append({"name": "route_switcher.security_groups_changed", "labels": {"route_switcher_name": function_name, "router_ip": router_network_interface['router_hc_address'], "interface_index": router_network_interface['index'], "folder_name": folder_name}, "type": "IGAUGE", "value": 2, "ts": str(datetime.datetime.now(datetime.timezone.utc).isoformat())})
+        metrics.append({"name": "route_switcher.security_groups_changed", "labels": {"route_switcher_name": function_name, "router_ip": router_network_interface['router_hc_address'], "interface_index": router_network_interface['index'], "folder_name": folder_name}, "type": "IGAUGE", "value": 2})
         return {}
 
     if r.status_code != 200:
         print(f"Unexpected status code {r.status_code} for updating router {router_network_interface['router_hc_address']} network interface index {router_network_interface['index']}. More details: {r.json().get('message')}. Retrying in {cron_interval} minutes...")
+        record_event('network_interface_update', router=router_network_interface['router_hc_address'], vm_id=router_network_interface['vm_id'], index=router_network_interface['index'], security_group_ids=router_network_interface['security_group_ids'], error=f"status code {r.status_code}")
         # add custom metric 'route_switcher.security_groups_changed' into metric list for Yandex Monitoring that error happened during security groups change for router
-        metrics.append({"name": "route_switcher.security_groups_changed", "labels": {"route_switcher_name": function_name, "router_ip": router_network_interface['router_hc_address'], "interface_index": router_network_interface['index'], "folder_name": folder_name}, "type": "IGAUGE", "value": 2, "ts": str(datetime.datetime.now(datetime.timezone.utc).isoformat())})
+        metrics.append({"name": "route_switcher.security_groups_changed", "labels": {"route_switcher_name": function_name, "router_ip": router_network_interface['router_hc_address'], "interface_index": router_network_interface['index'], "folder_name": folder_name}, "type": "IGAUGE", "value": 2})
         return {}
 
-    if 'id' in r.json():
-        operation_id = r.json()['id']
-        print(f"Operation {operation_id} for updating router {router_network_interface['router_hc_address']} network interface index {router_network_interface['index']}. More details: {r.json()}")
+    operation = r.json()
+    if 'id' in operation:
+        operation_id = operation['id']
+        track_operation(operation_id, bool(operation.get('done')))
+        print(f"Operation {operation_id} for updating router {router_network_interface['router_hc_address']} network interface index {router_network_interface['index']}. More details: {operation}")
+        record_event('network_interface_update', router=router_network_interface['router_hc_address'], vm_id=router_network_interface['vm_id'], index=router_network_interface['index'], security_group_ids=router_network_interface['security_group_ids'], operation_id=operation_id)
         # add custom metric 'route_switcher.security_groups_changed' into metric list for Yandex Monitoring about security groups change for router
-        metrics.append({"name": "route_switcher.security_groups_changed", "labels": {"route_switcher_name": function_name, "router_ip": router_network_interface['router_hc_address'], "interface_index": router_network_interface['index'], "folder_name": folder_name}, "type": "IGAUGE", "value": 1, "ts": str(datetime.datetime.now(datetime.timezone.utc).isoformat())})
+        metrics.append({"name": "route_switcher.security_groups_changed", "labels": {"route_switcher_name": function_name, "router_ip": router_network_interface['router_hc_address'], "interface_index": router_network_interface['index'], "folder_name": folder_name}, "type": "IGAUGE", "value": 1})
         return {'vm_id': router_network_interface['vm_id'], 'interface_index': router_network_interface['index'], 'operation_id': operation_id}
     else:
         print(f"Failed to start operation for updating router {router_network_interface['router_hc_address']} network interface index {router_network_interface['index']}. Retrying in {cron_interval} minutes...")
+        record_event('network_interface_update', router=router_network_interface['router_hc_address'], vm_id=router_network_interface['vm_id'], index=router_network_interface['index'], security_group_ids=router_network_interface['security_group_ids'], error='operation was not started')
         # add custom metric 'route_switcher.security_groups_changed' into metric list for Yandex Monitoring that error happened during security groups change for router
-        metrics.append({"name": "route_switcher.security_groups_changed", "labels": {"route_switcher_name": function_name, "router_ip": router_network_interface['router_hc_address'], "interface_index": router_network_interface['index'], "folder_name": folder_name}, "type": "IGAUGE", "value": 2, "ts": str(datetime.datetime.now(datetime.timezone.utc).isoformat())})
+        metrics.append({"name": "route_switcher.security_groups_changed", "labels": {"route_switcher_name": function_name, "router_ip": router_network_interface['router_hc_address'], "interface_index": router_network_interface['index'], "folder_name": folder_name}, "type": "IGAUGE", "value": 2})
         return {}
 
 
+def update_network_interfaces(router_network_interfaces):
+    '''
+    update security groups of router network interfaces concurrently without waiting for completion of operations
+    network interface which last operation of updating is in progress is kept in waiting_network_interfaces and updated at next checks of router status as soon as last operation is completed
+    operation ids of started updates are written in state at once when all update requests are completed, so that next launch of function waits for completion of operations
+    :param router_network_interfaces: list of dictionaries with router vm id, network interface index, list of security group ids and last operation id
+    :return: list of tuples (router network interface, dictionary returned by network_interface_update function)
+    '''
+
+    interface_keys = set((interface['vm_id'], str(interface['index'])) for interface in router_network_interfaces)
+    for interface_key in list(waiting_network_interfaces):
+        if interface_key not in interface_keys:
+            # security groups of network interface should not be switched anymore for actual router status
+            del waiting_network_interfaces[interface_key]
+    operation_statuses = poll_operations([interface['last_operation_id'] for interface in router_network_interfaces if interface['last_operation_id']])
+    ready_interfaces = list()
+    for interface in router_network_interfaces:
+        interface_key = (interface['vm_id'], str(interface['index']))
+        operation = operation_statuses.get(interface['last_operation_id']) if interface['last_operation_id'] else None
+        if operation is not None and not operation.get('done'):
+            # last operation for updating this interface is still in progress
+            if interface_key not in waiting_network_interfaces:
+                print(f"Operation id {interface['last_operation_id']} is still in progress for updating router {interface['router_hc_address']} network interface index {interface['index']}. Waiting for its completion...")
+            waiting_network_interfaces[interface_key] = interface
+        else:
+            waiting_network_interfaces.pop(interface_key, None)
+            ready_interfaces.append(interface)
+
+    results = list()
+    futures = {get_executor().submit(network_interface_update, interface): interface for interface in ready_interfaces}
+    for future in pool.as_completed(futures):
+        interface = futures[future]
+        operation = future.result()
+        results.append((interface, operation))
+        if operation.get('vm_id'):
+            # write operation id of updateNetworkInterface API request in state
+            state_cache['state']['operations'].setdefault(operation['vm_id'], {})[str(operation['interface_index'])] = operation['operation_id']
+            update_cached_security_groups(interface)
+    if any(operation.get('vm_id') for interface, operation in results):
+        save_state(urgent=True)
+    return results
+
+
+def get_lease():
+    '''
+    gets lease object from bucket
+    :return: tuple (lease dictionary, ETag of lease object), lease dictionary is empty if lease object does not exist, or None if error happened
+    '''
+
+    try:
+        response = get_s3_client().get_object(Bucket=bucket, Key=lease_path)
+    except Exception as e:
+        if get_storage_error_code(e) in ('NoSuchKey', '404'):
+            return {}, None
+        print(f"Request to get lease {lease_path} in bucket {bucket} failed due to: {e}. Retrying in {cron_interval} minutes...")
+        return
+
+    try:
+        lease = json.loads(response['Body'].read())
+    except ValueError:
+        # lease object is corrupted and can be overwritten
+        lease = {}
+    return lease, response.get('ETag')
+
+def put_lease(lease, etag):
+    '''
+    writes lease object to bucket with conditional request: lease object is written only if it was not changed since it was read
+    :param lease: lease dictionary with holder id and expiration time
+    :param etag: ETag of lease object which was read from bucket or None if lease object does not exist
+    :return: ETag of written lease object or None if lease object was changed by another launch of function or error happened
+    '''
+
+    if etag is not None:
+        condition = {'IfMatch': etag}
+    else:
+        condition = {'IfNoneMatch': '*'}
+    try:
+        response = get_s3_client().put_object(Bucket=bucket, Key=lease_path, Body=json.dumps(lease).encode(), ContentType='application/json', **condition)
+    except Exception as e:
+        if get_storage_error_code(e) not in ('PreconditionFailed', 'ConditionalRequestConflict', '412', '409'):
+            print(f"Request to write lease {lease_path} in bucket {bucket} failed due to: {e}.")
+        return
+    return response.get('ETag')
+
+def acquire_lease(holder_id, end_time):
+    '''
+    acquires lease for checking router status and updating route tables
+    if lease is held by another launch of function which ends during router_healthcheck_interval, waits for release of lease
+    :param holder_id: id of this launch of function
+    :param end_time: time when this launch of function ends
+    :return: True if lease is acquired, otherwise False
+    '''
+
+    wait_deadline = time.time() + router_healthcheck_interval
+    while True:
+        lease_etag = get_lease()
+        if lease_etag is None:
+            return False
+        lease, etag = lease_etag
+        current_time = time.time()
+        if not lease or lease.get('holder') == holder_id or lease.get('expires', 0) <= current_time:
+            # lease does not exist, released or expired
+            new_lease = {'holder': holder_id, 'expires': current_time + lease_duration, 'ends': end_time}
+            new_etag = put_lease(new_lease, etag)
+            if new_etag is None:
+                print(f"Lease {lease_path} was acquired by another launch of function. Exiting...")
+                return False
+            lease_state.update({'holder': holder_id, 'etag': new_etag, 'expires': new_lease['expires'], 'ends': end_time})
+            return True
+        if lease.get('ends', lease['expires']) - current_time > router_healthcheck_interval or current_time >= wait_deadline:
+            print(f"Route tables are protected by another launch of function {lease.get('holder')}. Exiting...")
+            return False
+        # another launch of function ends soon, wait for release of its lease
+        time.sleep(1)
+
+def renew_lease(valid_until=None):
+    '''
+    renews lease held by this launch of function if less than half of lease duration remains
+    :param valid_until: time until lease should be held at least, e.g. end of waiting for route table update operations
+    :return: True if lease is still held, False if lease was lost
+    '''
+
+    current_time = time.time()
+    if valid_until is None:
+        valid_until = current_time + lease_duration / 2
+    if lease_state['expires'] > valid_until:
+        return True
+    new_lease = {'holder': lease_state['holder'], 'expires': max(current_time + lease_duration, valid_until + lease_duration / 2), 'ends': lease_state['ends']}
+    new_etag = put_lease(new_lease, lease_state['etag'])
+    if new_etag is None:
+        print(f"Lease {lease_path} was lost. Exiting...")
+        lease_state.update({'holder': None, 'etag': None, 'expires': 0})
+        return False
+    lease_state.update({'etag': new_etag, 'expires': new_lease['expires']})
+    return True
+
+def release_lease():
+    '''
+    releases lease held by this launch of function, so that next launch of function can acquire it without waiting for its expiration
+    :return:
+    '''
+
+    if lease_state['etag'] is None:
+        return
+    put_lease({'holder': lease_state['holder'], 'expires': 0, 'ends': 0}, lease_state['etag'])
+    lease_state.update({'holder': None, 'etag': None, 'expires': 0})
+
 def handler(event, context):
     start_time = time.time()
 
-    global iam_token 
-    iam_token = context.token['access_token']
+    # set IAM token for API requests
+    set_iam_token(context.token['access_token'])
     global folder_id
     folder_id = event['event_metadata']['folder_id']
-    global metrics
-
-    # get route tables from VPC
-    config_route_tables_routers = get_config_route_tables_and_routers()
-    if config_route_tables_routers is None:
-        # exit from function as some errors happened when getting route tables
+    # route tables of shard are protected by launch of function with shard index from payload of timer trigger
+    if not set_shard(get_event_shard_index(event)):
         return
-    
-    error_message = config_route_tables_routers['error_message']
-    if error_message is not None:
-        print(error_message)
-        # exit from function as some errors happened when getting route tables
+
+    # update operations are not waited after execution timeout of function
+    global execution_deadline
+    if hasattr(context, 'get_remaining_time_in_millis'):
+        execution_deadline = start_time + context.get_remaining_time_in_millis() / 1000
+
+    # only one launch of function at a time checks router status and updates route tables
+    if not acquire_lease(getattr(context, 'request_id', None) or str(uuid.uuid4()), start_time + cron_interval * 60):
         return
-    
+    try:
+        route_switcher(start_time, cron_interval * 60)
+        if route_table_updates:
+            # wait for completion of route table update operations which are still in progress at the end of function life time
+            check_route_table_updates(execution_deadline - execution_exit_time)
+            write_metrics(metrics)
+    finally:
+        # write changes of state and journal before release of lease
+        flush_state()
+        flush_journal(urgent=True)
+        release_lease()
+        write_timing_metrics()
+        # write metrics from queue before function exit within remaining time of function execution
+        if hasattr(context, 'get_remaining_time_in_millis'):
+            flush_metrics(max(context.get_remaining_time_in_millis() / 1000 - 1, 0))
+        else:
+            flush_metrics()
+
+def get_switchover_labels():
+    '''
+    gets labels of 'route_switcher.switchover' metric, metric of each shard has 'shard' label
+    :return: dictionary with labels
+    '''
+
+    labels = {"route_switcher_name": function_name, "folder_name": folder_name}
+    if shard_count > 1:
+        labels['shard'] = str(shard_index)
+    return labels
+
+def route_switcher(start_time, function_life_time, route_tables_max_age=0):
+    '''
+    checks router status in loop during function life time and fails over if router fails
+    :param start_time: start time of function
+    :param function_life_time: function life time in seconds
+    :param route_tables_max_age: time in seconds since route tables were read during which route tables and route index from route_tables_cache are used instead of reading route tables again
+    :return: True if checking of router status was finished without errors (function life time is over or failover was executed), otherwise None
+    '''
+
+    global metrics
+
+    config_route_tables_routers = route_tables_cache['route_tables']
+    if config_route_tables_routers is None or time.time() - route_tables_cache['read_time'] >= route_tables_max_age:
+        # get route tables from VPC
+        read_time = time.time()
+        config_route_tables_routers = get_config_route_tables_and_routers()
+        if config_route_tables_routers is None:
+            # exit from function as some errors happened when getting route tables
+            return
+
+        error_message = config_route_tables_routers['error_message']
+        if error_message is not None:
+            print(error_message)
+            # exit from function as some errors happened when getting route tables
+            return
+        # route tables are read again, so route index has actual next hops of routes which were not updated before
+        failed_route_tables.clear()
+        route_tables_cache.update({'route_tables': config_route_tables_routers, 'read_time': read_time})
+
+    state = config_route_tables_routers['state']
     all_routeTables = config_route_tables_routers['all_routeTables']
     routers = config_route_tables_routers['routers']
-    function_life_time = cron_interval * 60
+    route_index = config_route_tables_routers['route_index']
+    # config model of routers in route index
+    route_index_model = config_route_tables_routers['model']
     checking_num = 1
     # repeat checking router status in loop 
     # checks router status and fails over if router fails
     while (time.time() - start_time) < function_life_time:
         last_check_time = time.time()
-        # get latest config file from bucket
-        config = get_config()
-        if config is None:
+        # get latest config model from bucket
+        phase_start = time.time()
+        model = get_config()
+        record_phase('config', phase_start)
+        if model is None:
             return
-        if config['updating_tables'] == True:
-            # current changes of next hops in route tables are still running, then wait for a timer
-            current_time = time.time()       
-            if (current_time - start_time + router_healthcheck_interval) < function_life_time:
-                print(f"Another operation for updating route tables is running. Retrying in {router_healthcheck_interval} seconds...")
-                if (current_time - last_check_time) < router_healthcheck_interval:
-                    time.sleep(router_healthcheck_interval - (current_time - last_check_time))
-                checking_num = checking_num + 1
-                continue
-            else:
-                # looks like something goes wrong if during the time of cron_interval (1 min or more) another operation for updating route tables has not been completed
-                # then try to update route tables once again during the next launch of function
-                # set flag of updating tables as False and update config file in bucket 
-                config['updating_tables'] = False
-                put_config(config)
-                return
-        # get router status from NLB
-        routerStatus = get_router_status(config)
+        if model.config_error is not None or model.router_errors:
+            # config file was changed in bucket and has errors, exit from function to check config at next launch
+            print(model.config_error or f"Some routers have errors in configuration file in bucket. Waiting for correct routers configuration. Retrying in {cron_interval} minutes...")
+            return
+        config = model.config
+        if model is not route_index_model:
+            # config was changed in bucket, route index is built again for next hops of routers of changed config
+            routers = model.nexthop_routers
+            route_index = rebuild_route_index(state, all_routeTables, routers)
+            route_index_model = model
+            config_route_tables_routers.update({'routers': routers, 'route_index': route_index, 'model': model})
+        # renew lease, exit from function if lease was acquired by another launch of function
+        if not renew_lease():
+            return
+        # get router status from NLBs of clusters
+        phase_start = time.time()
+        routerStatus = get_router_status(model)
+        status_time = time.time()
+        record_phase('router_status', phase_start)
         if routerStatus is None:
             # exit from function as some errors happened when checking router status
             return
+        # get interval until next check, it depends on changes of router status
+        healthcheck_interval = get_router_healthcheck_interval(routerStatus, last_check_time)
+        # security groups of routers are switched only by shard 0
+        sg_clusters = [cluster for cluster in model.clusters if cluster.primary_router is not None] if shard_index == 0 else list()
+        # routers which routes are not returned to yet after recovery of router
+        failback_blocked, damping_changed = dampen_router_status(routerStatus, state['damping'], status_time, model.router_clusters)
+        if routerStatus != state['router_status']:
+            record_event('router_status', status=dict(routerStatus), previous_status=state['router_status'], probe_failures=dict(probe_state['failures']) if router_probe_port else None)
+        if routerStatus != state['router_status'] or damping_changed:
+            # last router status and damping state are written in state with other changes of state
+            state['router_status'] = dict(routerStatus)
+            save_state()
  
         metrics = list()        
         healthy_nexthops = {}
         unhealthy_nexthops = {}
-        router_vm_ids = {}
-        for router in config['routers']:
-            router_hc_address = router['healthchecked_ip']        
-            router_interfaces = router['interfaces']
-            if routerStatus[router_hc_address] != 'HEALTHY':
+        # clusters with routers in router status
+        checked_clusters = set(model.router_clusters[router_hc_address] for router_hc_address in routerStatus if router_hc_address in model.router_clusters)
+        for router in model.routers:
+            router_hc_address = router.healthchecked_ip
+            if router_hc_address not in routerStatus and model.router_clusters[router_hc_address] not in checked_clusters:
+                # status of routers of cluster is unknown as target states of its NLB could not be read
+                continue
+            if routerStatus.get(router_hc_address) != 'HEALTHY':
                 # add custom metric 'route_switcher.router_state' into metric list for Yandex Monitoring that router state is not healthy
-                metrics.append({"name": "route_switcher.router_state", "labels": {"router_ip": router_hc_address, "folder_name": folder_name}, "type": "IGAUGE", "value": 0, "ts": str(datetime.datetime.now(datetime.timezone.utc).isoformat())})
+                metrics.append({"name": "route_switcher.router_state", "labels": {"router_ip": router_hc_address, "folder_name": folder_name}, "type": "IGAUGE", "value": 0})
                 # prepare dictionary with UNHEALTHY nexthops as {key:value}, where key - nexthop address, value - nexthop address of backup router
-                for interface in router_interfaces:    
-                    unhealthy_nexthops[interface['own_ip']] = interface['backup_peer_ip'] 
+                unhealthy_nexthops.update(router.nexthops)
             else:
                 # add custom metric 'route_switcher.router_state' into metric list for Yandex Monitoring that router state is healthy
-                metrics.append({"name": "route_switcher.router_state", "labels": {"router_ip": router_hc_address, "folder_name": folder_name}, "type": "IGAUGE", "value": 1, "ts": str(datetime.datetime.now(datetime.timezone.utc).isoformat())})
+                metrics.append({"name": "route_switcher.router_state", "labels": {"router_ip": router_hc_address, "folder_name": folder_name}, "type": "IGAUGE", "value": 1})
                 # prepare dictionary with HEALTHY nexthops as {key:value}, where key - nexthop address, value - nexthop address of backup router
-                for interface in router_interfaces:
-                    healthy_nexthops[interface['own_ip']] = interface['backup_peer_ip']
-            # prepare dictionary with VM id of routers as {key:value}, where key - router healthcheck IP address, value - vm id
-            if 'vm_id' in router and router['vm_id']:
-                router_vm_ids[router_hc_address] = {'vm_id': router['vm_id'], 'primary': router['primary'], 'interfaces': router['interfaces']}  
+                healthy_nexthops.update(router.nexthops)
+            # add custom metric 'route_switcher.router_failback_blocked' into metric list for Yandex Monitoring that routes are not returned to recovered router yet
+            metrics.append({"name": "route_switcher.router_failback_blocked", "labels": {"router_ip": router_hc_address, "folder_name": folder_name}, "type": "IGAUGE", "value": int(router_hc_address in failback_blocked)})
+
+        if failed_route_tables:
+            # routes of route tables which were not updated are switched again
+            revert_failed_route_tables(all_routeTables, route_index, routers)
+        plans = route_index['plans']
+        unhealthy_routers = frozenset(router_hc_address for router_hc_address in routerStatus if routerStatus[router_hc_address] != 'HEALTHY')
+        # plans are compiled for status of all routers, routes of clusters missing in router status are not switched by plans
+        plan_used = bool(plans and plans['model'] is model and not failback_blocked and unhealthy_routers in plans['scenarios'] and all(router.healthchecked_ip in routerStatus for router in model.routers))
+        if plan_used:
+            # use precompiled failover plan for this router status
+            plan = plans['scenarios'][unhealthy_routers]
+            modified_routeTables, messages, payloads = plan['modified_routeTables'], plan['messages'], plan['payloads']
+        else:
+            # dictionary with modified route tables as {key:value}, where key - route table id, value - {destination prefix: new next hop address}
+            modified_routeTables, messages = get_route_changes(route_index, routers, healthy_nexthops, unhealthy_nexthops, routerStatus, failback_blocked)
+            payloads = {}
+        for message in messages:
+            print(message)
+        if modified_routeTables:
+            record_event('failover_decision', unhealthy_routers=sorted(unhealthy_routers), failback_blocked=sorted(failback_blocked), plan=plan_used, route_tables=len(modified_routeTables), routes=sum(len(modified_routes) for modified_routes in modified_routeTables.values()), decision_ms=round((time.time() - status_time) * 1000, 1))
+        # previous next hops of modified routes are kept to switch routes again if route table is not updated
+        previous_routeTables = {}
+        for route_table_id, modified_routes in modified_routeTables.items():
+            for prefix, nexthop in modified_routes.items():
+                previous_routeTables.setdefault(route_table_id, {})[prefix] = route_index['routes'][(route_table_id, prefix)]['nextHopAddress']
+                update_route_index(route_index, routers, (route_table_id, prefix), nexthop)
 
-        router_with_changed_status = ""
         all_modified_routeTables = list()
-        for config_route_table in config['route_tables']:
-            routeTable_name = all_routeTables[config_route_table['route_table_id']]['name']
-            routeTable = all_routeTables[config_route_table['route_table_id']]['staticRoutes']
-            routeTable_changes = {'modified':False}
-            routeTable_prefixes = set()
-            for ip_route in routeTable: 
-                # checking if next hop is one of a router addresses
-                if 'nextHopAddress' in ip_route:
-                    if ip_route['nextHopAddress'] in healthy_nexthops or ip_route['nextHopAddress'] in unhealthy_nexthops:
-                        # populate routeTable_prefixes set with route table prefixes
-                        routeTable_prefixes.add(ip_route['destinationPrefix'])
-                        if ip_route['nextHopAddress'] in unhealthy_nexthops:
-                            # get primary router from config stored in bucket
-                            primary_router = config_route_table['routes'][ip_route['destinationPrefix']]
-                            if primary_router in healthy_nexthops and ip_route['nextHopAddress'] != primary_router: 
-                                # if primary router became healthy and backup router is still used as next hop, change next hop address to primary router                     
-                                if router_with_changed_status != routers[primary_router]:
-                                    router_with_changed_status = routers[primary_router]
-                                    print(f"Router {router_with_changed_status} became HEALTHY.")
-                                ip_route.update({'nextHopAddress':primary_router})
-                                routeTable_changes = {'modified':True, 'next_hop':primary_router}
-                            else:
-                                # if primary router is not healthy change next hop address to backup router  
-                                backup_router = unhealthy_nexthops[ip_route['nextHopAddress']]                                
-                                # also check whether backup router address is in healthy next hops
-                                if backup_router in healthy_nexthops:
-                                    if router_with_changed_status != routers[ip_route['nextHopAddress']]:
-                                        router_with_changed_status = routers[ip_route['nextHopAddress']]
-                                        print(f"Router {router_with_changed_status} is UNHEALTHY.")                   
-                                    ip_route.update({'nextHopAddress':backup_router})
-                                    routeTable_changes = {'modified':True, 'next_hop':backup_router}
-                                else:
-                                    print(f"Backup next hop {backup_router} is not healthy. Can not switch next hop {ip_route['nextHopAddress']} for route {ip_route['destinationPrefix']} in route table {config_route_table['route_table_id']}. Retrying in {cron_interval} minutes...")   
-                        else:
-                            # if route-switcher module has 'back_to_primary' input variable set as 'true' we back to primary router after its recovery
-                            if back_to_primary == 'true':
-                                # get primary router from config stored in bucket
-                                primary_router = config_route_table['routes'][ip_route['destinationPrefix']]
-                                if primary_router in healthy_nexthops and ip_route['nextHopAddress'] != primary_router: 
-                                    # if primary router became healthy and backup router is still used as next hop, change next hop address to primary router                     
-                                    if router_with_changed_status != routers[primary_router]:
-                                        router_with_changed_status = routers[primary_router]
-                                        print(f"Router {router_with_changed_status} became HEALTHY.")
-                                    ip_route.update({'nextHopAddress':primary_router})
-                                    routeTable_changes = {'modified':True, 'next_hop':primary_router}
-                               
-            if routeTable_changes['modified']:
+        for route_table_id in all_routeTables:
+            routeTable_name = all_routeTables[route_table_id]['name']
+            if route_table_id in modified_routeTables:
                 # if next hop for some routes was changed add this table to all_modified_routeTables list
-                all_modified_routeTables.append({'route_table_id':config_route_table['route_table_id'], 'name':routeTable_name, 'next_hop':routeTable_changes['next_hop'], 'routes':routeTable})
+                all_modified_routeTables.append({'route_table_id':route_table_id, 'name':routeTable_name, 'next_hop':', '.join(sorted(set(modified_routeTables[route_table_id].values()))), 'modified_routes':modified_routeTables[route_table_id], 'previous_routes':previous_routeTables[route_table_id], 'priority':model.route_table_priorities.get(route_table_id, 0), 'routes':all_routeTables[route_table_id]['staticRoutes'], 'payload':payloads.get(route_table_id)})
             else:
                 # add custom metric 'route_switcher.table_changed' into metric list for Yandex Monitoring that table is not changed
-                metrics.append({"name": "route_switcher.table_changed", "labels": {"route_switcher_name": function_name, "route_table_name": routeTable_name, "folder_name": folder_name}, "type": "IGAUGE", "value": 0, "ts": str(datetime.datetime.now(datetime.timezone.utc).isoformat())})
+                metrics.append({"name": "route_switcher.table_changed", "labels": {"route_switcher_name": function_name, "route_table_name": routeTable_name, "folder_name": folder_name}, "type": "IGAUGE", "value": 0})
+        record_phase('decision', status_time)
  
         
         if all_modified_routeTables: 
-            # set flag of updating tables as True and update config file in bucket 
-            config['updating_tables'] = True
-            put_config(config)
             # add custom custom metric 'route_switcher.switchover' into metric list for Yandex Monitoring that switchover is required
-            metrics.append({"name": "route_switcher.switchover", "labels": {"route_switcher_name": function_name, "folder_name": folder_name}, "type": "IGAUGE", "value": 1, "ts": str(datetime.datetime.now(datetime.timezone.utc).isoformat())})
+            metrics.append({"name": "route_switcher.switchover", "labels": get_switchover_labels(), "type": "IGAUGE", "value": 1})
             # we have a list of all modified route tables 
-            # create and launch a thread pool (with 8 max_workers) to execute failover function asynchronously for each modified route table    
-            with pool.ThreadPoolExecutor(max_workers=8) as executer:
-                try:
-                    executer.map(failover, all_modified_routeTables)
-                except Exception as e:
-                    print(f"Request to execute failover function failed due to: {e}. Retrying in {cron_interval} minutes...")
-
-            # set flag of updating tables as False and update config file in bucket 
-            config['updating_tables'] = False
-            put_config(config)
+            # update route tables and wait for completion of update operations until next check of router status, operations are not waited after execution timeout of function
+            operations_deadline = get_operations_deadline()
+            # lease should be held until all update operations are completed
+            if not renew_lease(operations_deadline):
+                return
+            # re-read modified route tables and merge changes of next hops into actual routes, so changes made in VPC after route tables were read are not overwritten
+            phase_start = time.time()
+            all_modified_routeTables = refresh_route_tables(all_modified_routeTables, all_routeTables, route_index, routers)
+            record_phase('route_tables_refresh', phase_start)
+            if all_modified_routeTables:
+                # operations which are not completed until next check of router status are checked after next checks
+                update_route_tables(all_modified_routeTables, status_time, min(last_check_time + healthcheck_interval, operations_deadline), operations_deadline)
+            # events of failover are written immediately
+            flush_journal(urgent=True)
 
-            if not router_vm_ids:
+            if not sg_clusters:
                 # write metrics into Yandex Monitoring
                 write_metrics(metrics)
-                # exit from function as failover was executed for route tables and there are no security groups configuration for routers in configuration file
-                return
+                if not route_table_updates and not failed_route_tables:
+                    # exit from function as failover was executed for route tables and there are no security groups configuration for routers in configuration file
+                    # router status is checked further while update operations of route tables are in progress or some route tables were not updated
+                    return True
         else:
             # add custom custom metric 'route_switcher.switchover' into metric list for Yandex Monitoring that switchover is not required
-            metrics.append({"name": "route_switcher.switchover", "labels": {"route_switcher_name": function_name, "folder_name": folder_name}, "type": "IGAUGE", "value": 0, "ts": str(datetime.datetime.now(datetime.timezone.utc).isoformat())})
-            if not router_vm_ids:
+            metrics.append({"name": "route_switcher.switchover", "labels": get_switchover_labels(), "type": "IGAUGE", "value": 0})
+            if not sg_clusters:
                 # write metrics into Yandex Monitoring
                 write_metrics(metrics) 
 
-        if router_vm_ids:
-            primary_router_hc_address = ""
-            backup_router_hc_address = ""
+        if sg_clusters:
+            phase_start = time.time()
             all_modified_router_network_interfaces = list()
-            primary_router_network_interfaces = list()
-            backup_router_network_interfaces = list()
-            for router_hc_address in router_vm_ids:
-                if router_vm_ids[router_hc_address]['primary'] == True:
-                    primary_router_hc_address = router_hc_address
-                else:
-                    backup_router_hc_address = router_hc_address
-                
-            if routerStatus[primary_router_hc_address] != 'HEALTHY':
-                if routerStatus[backup_router_hc_address] == 'HEALTHY':
-                    # if primary router is not healthy and backup router is healthy
-                    # prepare list of primary router network interfaces for updating security groups with security groups of backup router from configuration file 
-                    primary_router_network_interfaces = get_diff_security_groups(router_vm_ids[primary_router_hc_address]['vm_id'], primary_router_hc_address, router_vm_ids[backup_router_hc_address]['interfaces'])
-                    if primary_router_network_interfaces:
-                        all_modified_router_network_interfaces.extend(primary_router_network_interfaces)
-                    # prepare list of backup router network interfaces for updating security groups with security groups of primary router from configuration file
-                    backup_router_network_interfaces = get_diff_security_groups(router_vm_ids[backup_router_hc_address]['vm_id'], backup_router_hc_address, router_vm_ids[primary_router_hc_address]['interfaces'])
-                    if backup_router_network_interfaces:
-                        all_modified_router_network_interfaces.extend(backup_router_network_interfaces)
-            else:
-                if routerStatus[backup_router_hc_address] == 'HEALTHY':
-                    if back_to_primary == 'true':
-                        # if primary router is healthy and backup router is healthy and back_to_primary == 'true'
-                        # prepare list of primary router network interfaces for updating security groups with security groups of primary router from configuration file 
-                        primary_router_network_interfaces = get_diff_security_groups(router_vm_ids[primary_router_hc_address]['vm_id'], primary_router_hc_address, router_vm_ids[primary_router_hc_address]['interfaces'])
-                        if primary_router_network_interfaces:
-                            all_modified_router_network_interfaces.extend(primary_router_network_interfaces)
-                        # prepare list of backup router network interfaces for updating security groups with security groups of backup router from configuration file
-                        backup_router_network_interfaces = get_diff_security_groups(router_vm_ids[backup_router_hc_address]['vm_id'], backup_router_hc_address, router_vm_ids[backup_router_hc_address]['interfaces'])
-                        if backup_router_network_interfaces:
-                            all_modified_router_network_interfaces.extend(backup_router_network_interfaces)
-                    else:
-                        # if primary router is healthy and backup router is healthy and back_to_primary == 'false'
-                        # check if backup router has primary security groups currently
-                        backup_router_network_interfaces = get_diff_security_groups(router_vm_ids[backup_router_hc_address]['vm_id'], backup_router_hc_address, router_vm_ids[primary_router_hc_address]['interfaces'])
-                        if backup_router_network_interfaces:
-                            # backup router does not have primary security groups currently
-                            # prepare list of primary router network interfaces for updating security groups with security groups of primary router from configuration file 
-                            primary_router_network_interfaces = get_diff_security_groups(router_vm_ids[primary_router_hc_address]['vm_id'], primary_router_hc_address, router_vm_ids[primary_router_hc_address]['interfaces'])
-                            if primary_router_network_interfaces:
-                                all_modified_router_network_interfaces.extend(primary_router_network_interfaces)
-                        else:
-                            # prepare list of primary router network interfaces for updating security groups with security groups of backup router from configuration file 
-                            primary_router_network_interfaces = get_diff_security_groups(router_vm_ids[primary_router_hc_address]['vm_id'], primary_router_hc_address, router_vm_ids[backup_router_hc_address]['interfaces'])
-                            if primary_router_network_interfaces:
-                                all_modified_router_network_interfaces.extend(primary_router_network_interfaces)
-                else:
-                    # if primary router is healthy and backup router is not healthy
-                    # prepare list of primary router network interfaces for updating security groups with security groups of primary router from configuration file 
-                    primary_router_network_interfaces = get_diff_security_groups(router_vm_ids[primary_router_hc_address]['vm_id'], primary_router_hc_address, router_vm_ids[primary_router_hc_address]['interfaces'])
-                    if primary_router_network_interfaces:
-                        all_modified_router_network_interfaces.extend(primary_router_network_interfaces)
-                    # prepare list of backup router network interfaces for updating security groups with security groups of backup router from configuration file
-                    backup_router_network_interfaces = get_diff_security_groups(router_vm_ids[backup_router_hc_address]['vm_id'], backup_router_hc_address, router_vm_ids[backup_router_hc_address]['interfaces'])
-                    if backup_router_network_interfaces:
-                        all_modified_router_network_interfaces.extend(backup_router_network_interfaces)
+            # read security groups of primary and backup routers of all clusters concurrently if they are not cached
+            refresh_security_groups(sg_clusters, routerStatus, status_time)
+            modified_clusters = set()
+            for cluster in sg_clusters:
+                if cluster.primary_router.healthchecked_ip not in routerStatus or cluster.backup_router.healthchecked_ip not in routerStatus:
+                    # status of routers of cluster is unknown, security groups of cluster are not switched
+                    continue
+                cluster_network_interfaces = get_cluster_network_interfaces(cluster, routerStatus, failback_blocked)
+                if cluster_network_interfaces:
+                    all_modified_router_network_interfaces.extend(cluster_network_interfaces)
+                    modified_clusters.add(cluster)
 
+            record_phase('security_groups_diff', phase_start)
+            for cluster in sg_clusters:
+                if cluster not in modified_clusters:
+                    # add custom metric 'route_switcher.security_groups_changed' into metric list for Yandex Monitoring that security group is not changed for routers of cluster
+                    for router in (cluster.primary_router, cluster.backup_router):
+                        for interface_index in router.interfaces_by_index:
+                            metrics.append({"name": "route_switcher.security_groups_changed", "labels": {"route_switcher_name": function_name, "router_ip": router.healthchecked_ip, "interface_index": interface_index, "folder_name": folder_name}, "type": "IGAUGE", "value": 0})
 
             if all_modified_router_network_interfaces:
                 # update security groups for router network interfaces  
+                # lease should be held until operations of updating network interfaces are completed, operations are not waited after execution timeout of function
+                if not renew_lease(get_operations_deadline()):
+                    return
+                phase_start = time.time()
                 operation_results = list()
-                with pool.ThreadPoolExecutor(max_workers=8) as executer:
-                    try:
-                        # launch execution of updating router network interfaces and receiving return results of function 'network_interface_update' 
-                        operation_results = list(executer.map(network_interface_update, all_modified_router_network_interfaces))
-                    except Exception as e:
-                        print(f"Request to execute network_interface_update function failed due to: {e}. Retrying in {cron_interval} minutes...")  
-                operation_counter = 0
-                if operation_results:
-                    # update config file in bucket with operation id of updateNetworkInterface API request for each router interfaces beeing updated                  
-                    for operation in operation_results:
-                        if 'vm_id' in operation and operation['vm_id']:
-                            for router in config['routers']:
-                                if 'vm_id' in router and router['vm_id'] and router['vm_id'] == operation['vm_id']:
-                                    for router_interface in router['interfaces']:
-                                        if router_interface['index'] == operation['interface_index']: 
-                                            router_interface.update({'last_operation_id': operation['operation_id']})
-                                            operation_counter += 1 
+                try:
+                    # update router network interfaces concurrently, network interfaces which last operations of updating them are in progress are updated at next checks
+                    # operation ids of updateNetworkInterface API requests are written in state in bucket as soon as all update requests are completed
+                    operation_results = update_network_interfaces(all_modified_router_network_interfaces)
+                except Exception as e:
+                    print(f"Request to execute network_interface_update function failed due to: {e}. Retrying in {cron_interval} minutes...")  
+                record_phase('security_groups_update', phase_start)
+                operation_counter = sum(1 for router_network_interface, operation in operation_results if operation.get('vm_id'))
                 # write metrics into Yandex Monitoring
                 write_metrics(metrics)
-                if operation_counter:
-                    # update config file in bucket with operation id of updateNetworkInterface API requests
-                    put_config(config)
+                flush_journal(urgent=True)
+                if operation_counter and not waiting_network_interfaces and not route_table_updates and not failed_route_tables:
                     # exit from function as update for security groups was executed
-                    return
+                    # router status is checked further while network interfaces are waiting for completion of last operations of updating them
+                    return True
             else:
-                # add custom metric 'route_switcher.security_groups_changed' into metric list for Yandex Monitoring that security group is not changed for routers
-                for router_config_interface in router_vm_ids[primary_router_hc_address]['interfaces']:
-                    if router_config_interface['index'] is not None:
-                        metrics.append({"name": "route_switcher.security_groups_changed", "labels": {"route_switcher_name": function_name, "router_ip": primary_router_hc_address, "interface_index": router_config_interface['index'], "folder_name": folder_name}, "type": "IGAUGE", "value": 0, "ts": str(datetime.datetime.now(datetime.timezone.utc).isoformat())})
-                for router_config_interface in router_vm_ids[backup_router_hc_address]['interfaces']:
-                    if router_config_interface['index'] is not None:
-                        metrics.append({"name": "route_switcher.security_groups_changed", "labels": {"route_switcher_name": function_name, "router_ip": backup_router_hc_address, "interface_index": router_config_interface['index'], "folder_name": folder_name}, "type": "IGAUGE", "value": 0, "ts": str(datetime.datetime.now(datetime.timezone.utc).isoformat())})
+                waiting_network_interfaces.clear()
                 # write metrics into Yandex Monitoring
                 write_metrics(metrics)
 
-        current_time = time.time()      
-        if (current_time - start_time + router_healthcheck_interval) < function_life_time:
-            if (current_time - last_check_time) < router_healthcheck_interval:
-                time.sleep(router_healthcheck_interval - (current_time - last_check_time))
+        if route_table_updates:
+            # check completion of route table update operations until next check of router status
+            check_route_table_updates(last_check_time + healthcheck_interval)
+        if route_index['plans'] is None or route_index['plans']['model'] is not model:
+            # compile failover plans for actual next hops of routes while routers are not changed
+            phase_start = time.time()
+            route_index['plans'] = compile_failover_plans(model, route_index, all_routeTables, routers)
+            record_phase('failover_plans', phase_start)
+        # write recorded latencies into Yandex Monitoring
+        write_timing_metrics()
+        flush_journal()
+        if wait_for_next_check(start_time, last_check_time, healthcheck_interval, function_life_time):
             checking_num = checking_num + 1
         else:
             break
-    
-    
\ No newline at end of file
+    return True
+
+
+# record import and initialization time of module at cold start of function
+record_phase('import', module_import_start)
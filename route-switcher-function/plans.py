@@ -0,0 +1,48 @@
+'''
+preview of failover plans of route-switcher: changes of route tables which route-switcher makes if one of routers fails or when all routers are HEALTHY again
+plans are compiled from config in bucket and actual routes in VPC and printed as JSON, so they can be reviewed and compared with previous plans before failure of routers
+
+environment variables are the same as for long-running route-switcher process (daemon.py)
+
+usage: python plans.py > plans.json
+'''
+
+import contextlib
+import json
+import os
+import sys
+
+# log of route-switcher is printed into stderr, only plans are printed into stdout
+with contextlib.redirect_stdout(sys.stderr):
+    import daemon
+    import main
+
+
+def run():
+    '''
+    prints failover plans for route tables of shard SHARD_INDEX
+    :return: exit code
+    '''
+
+    with contextlib.redirect_stdout(sys.stderr):
+        # preview is read-only, it does not write state and metrics of route-switcher
+        main.dry_run = True
+        main.folder_id = os.getenv('FOLDER_ID')
+        if not main.set_shard(main.default_shard_index):
+            return 1
+        if not daemon.refresh_iam_token({'expires_at': 0}):
+            return 1
+        config_route_tables_routers = main.get_config_route_tables_and_routers()
+        if config_route_tables_routers is None:
+            return 1
+        if config_route_tables_routers['error_message'] is not None:
+            print(config_route_tables_routers['error_message'])
+            return 1
+        route_index = config_route_tables_routers['route_index']
+        plans = main.compile_failover_plans(config_route_tables_routers['model'], route_index, config_route_tables_routers['all_routeTables'], config_route_tables_routers['routers'])
+    print(json.dumps(main.describe_failover_plans(plans, route_index), indent=2, sort_keys=True))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(run())
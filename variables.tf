@@ -22,6 +22,12 @@ variable "route_table_list" {
     default     = []
 }
 
+variable "route_table_priorities" {
+    description = "Priorities of route tables as map, where key - route table id, value - priority. Route tables with higher priority are updated first during failover. Default priority is 0."
+    type = map(number)
+    default     = {}
+}
+
 variable "router_healthcheck_port" {
   description = "Healthchecked tcp port of routers"
   type        = number
@@ -52,6 +58,26 @@ variable "routers" {
   default = []
 }
 
+variable "router_clusters" {
+  description = "Additional clusters of routers checked by the same route-switcher function, e.g. router pairs in other availability zones or segments. Map key is name of cluster. Separate NLB is created for each cluster, routers of cluster are specified the same way as in 'routers'. Next hops of routes and security groups are switched only between routers of the same cluster."
+  type = map(object({
+    routers = list(object({
+      vm_id = optional(string) # vm id for router, required for scenario of switching security groups between routers
+      healthchecked_ip = string  # ip address which will be checked by NLB to obtain router status. Usually located in management network.
+      healthchecked_subnet_id = string # subnet id of healthchecked ip address
+      primary = optional(bool, false)           # true if router is primary, required for scenario of switching security groups between routers
+      interfaces = list(object({
+        # 'own_ip', 'backup_peer_ip' attributes required for interface if its ip adress is used as next hop in route table
+        own_ip = optional(string)           # ip address of router interface
+        backup_peer_ip = optional(string)   # ip address of backup router, which will be used to switch next hop for a static route in case of a router failure
+        index = optional(number) # index of network interface, e.g. 1, required for scenario of switching security groups between routers
+        security_group_ids = optional(list(string)) # list of security group ids, required for scenario of switching security groups between routers
+      })) 
+    }))
+  }))
+  default = {}
+}
+
 variable "route_switcher_sa_roles" {
   description = "Roles that are needed for route-switcher service account"
   type        = list(string)
@@ -70,6 +96,72 @@ variable "router_healthcheck_interval" {
   default = 60
 }
 
+variable "router_healthcheck_fast_interval" {
+  description = "Interval in seconds for checking routers status using NLB healthcheck after routers status was changed. Used during 30 seconds after change of routers status, then router_healthcheck_interval is used again."
+  type = number
+  default = 2
+}
+
+variable "router_probe_network_id" {
+  description = "Id of network where route-switcher function is connected to for direct TCP probes of router_healthcheck_port of routers in addition to NLB healthcheck. Direct probes are disabled if not set."
+  type = string
+  default = null
+}
+
+variable "router_probe_failures" {
+  description = "Number of consecutive failed direct TCP probes after which router is considered UNHEALTHY before NLB healthcheck. Routers are probed every second."
+  type = number
+  default = 2
+}
+
+variable "failback_min_checks" {
+  description = "Min number of consecutive checks with HEALTHY status of recovered router before route-switcher returns routes and security groups to router."
+  type = number
+  default = 3
+}
+
+variable "failback_hold_down" {
+  description = "Min time in seconds since last change of status of any router before route-switcher returns routes and security groups to recovered router. Several changes of routers status during this time result in one update of each route table."
+  type = number
+  default = 30
+}
+
+variable "flap_half_life" {
+  description = "Half life in seconds of penalty for change of router status. Routes are not returned to flapping router until its penalty decays. 0 disables flap damping."
+  type = number
+  default = 300
+}
+
+variable "api_concurrency" {
+  description = "Max number of parallel requests to each API by route-switcher function as map, where key - API name (load-balancer, vpc, compute, operation, monitoring), value - max number of parallel requests. Overrides default values."
+  type = map(number)
+  default = {}
+}
+
+variable "api_rate_limits" {
+  description = "Max rate of requests per second to each API by route-switcher function as map, where key - API name (load-balancer, vpc, compute, operation, monitoring), value - max number of requests per second. Rate is not limited for API which is not in map."
+  type = map(number)
+  default = {}
+}
+
+variable "shard_count" {
+  description = "Number of route-switcher shards. Route tables are partitioned across shards by consistent hashing of route table id, each shard is launched by its own trigger and checks routers and updates only its route tables. Security groups of routers are switched by shard 0."
+  type = number
+  default = 1
+}
+
+variable "journal_flush_interval" {
+  description = "Interval in seconds between writes of route-switcher journal of events into bucket. Events of route tables failover are written immediately."
+  type = number
+  default = 60
+}
+
+variable "security_groups_reconcile_interval" {
+  description = "Interval in seconds for reading security groups of routers network interfaces when routers status does not change. Security groups are read after change of routers status and are cached between reads."
+  type = number
+  default = 300
+}
+
 variable "security_group_folder_list" {
   description = "List of folders with security groups which should be switched between primary and backup routers in case of a router failure. Required for scenario of switching security groups between routers."
   type        = list(string)